@@ -18,6 +18,37 @@ def create_app() -> Flask:
     app.config["DATABASE_PRODUCT"] = DATABASE_PRODUCT
     app.config["DATABASE_USER"] = DATABASE_USER
 
+    # === 伺服器端 session：cookie 只放 session id，購物車等內容存在 database/session.db ===
+    # 閒置超過 SESSION_TTL_SEC 秒就過期，過期的 session 會定期清掉
+    app.config["SESSION_TTL_SEC"] = 2 * 60 * 60
+    from core.session_store import init_session_store
+    init_session_store(app)
+
+    # === 產線記憶體模型：派工 / 完工先改記憶體，每 FACTORY_FLUSH_INTERVAL_SEC 秒批次寫回 DB ===
+    app.config["FACTORY_FLUSH_INTERVAL_SEC"] = 2
+    from core.factory_model import init_factory_model
+    init_factory_model(app)
+
+    # === 站點驅動：simulated（依 busy_until 計時完工）或 socket（站點程式經本機 TCP 回報完工事件） ===
+    # 模擬 driver 每次完工失敗的機率（0 = 不失敗）；失敗超過 FACTORY_MAX_ATTEMPTS 次標成異常件
+    app.config["FACTORY_STATION_DRIVER"] = os.environ.get("FACTORY_STATION_DRIVER", "simulated")
+    app.config["FACTORY_DRIVER_HOST"] = "127.0.0.1"
+    app.config["FACTORY_DRIVER_PORT"] = 7070
+    app.config["FACTORY_FAILURE_RATE"] = 0.0
+    app.config["FACTORY_MAX_ATTEMPTS"] = 3
+    from core.station_drivers import init_station_driver
+    init_station_driver(app)
+
+    # === 模擬引擎：inline（在 request 裡跑）/ worker（另外用 `flask factory sim-worker` 啟動獨立 process）/
+    #     spawn（同 worker，create_app 時自己開子 process）；網站和引擎之間走本機 Unix socket ===
+    app.config["FACTORY_SIM_ENGINE"] = os.environ.get("FACTORY_SIM_ENGINE", "inline")
+    app.config["FACTORY_SIM_SOCKET"] = os.environ.get("FACTORY_SIM_SOCKET") or os.path.join(BASE_DIR, "database", "sim_worker.sock")
+    from core.sim_worker import init_sim_worker
+    init_sim_worker(app)
+
+    # === 下單產能控管：任何一站的待做工作超過這麼多秒就不接單（0 = 不限制） ===
+    app.config["FACTORY_ADMISSION_HORIZON_SEC"] = 8 * 60 * 60
+
     # === 載入並註冊 Blueprints ===
     from core.auth_routes import auth_bp
     from core.order_routes import order_bp
@@ -0,0 +1,209 @@
+# core/admission.py
+# 下單的產能控管（admission control / backpressure）：
+# - 每個站點維持一個「尚未完成的工作秒數」：排隊中（pending）的 piece-step 預估秒數 + 加工中工作的剩餘秒數
+# - 第一次使用時從 SQL 建一次（active 訂單的品項件數 × 路線步驟，扣掉已開始 / 完成 / 異常的 piece rows），
+#   之後由下單 / 派工 / 完工 / 訂單關閉增量更新，下單檢查不必再掃訂單
+# - 下單時把新訂單各站的工作秒數加上去；任何一站超過 FACTORY_ADMISSION_HORIZON_SEC 就拒絕，
+#   並估算該站消化到水位以下的最早時間（跳過排定的停機時段）
+# - 狀態是每個 process 一份；和 floor_state 一樣，多 worker 部署時只反映本 process 的變動
+
+from __future__ import annotations
+
+import threading
+from typing import Dict, Optional, Tuple
+
+from .factory_model import factory_model
+from .process_dag import load_route
+from .process_templates import ensure_process_template_schema, get_step_defs
+from .station_availability import load_availability
+
+# 預設：任何一站的待做工作超過 8 小時就不再接單；可用 app.config["FACTORY_ADMISSION_HORIZON_SEC"] 覆蓋（0 = 不限制）
+DEFAULT_HORIZON_SEC = 8 * 60 * 60
+
+
+def order_work(product_db, process_version, lines) -> Dict[str, float]:
+    """
+    一張訂單各站點的工作秒數：lines = [(件數, 路線 {step: preds})]。
+    沒有指定站點的步驟不佔站點產能，不計入。
+    """
+    step_defs = get_step_defs(product_db, process_version)
+    work: Dict[str, float] = {}
+    for qty, route in lines:
+        for step_no in route:
+            d = step_defs.get(step_no)
+            if d and d.station:
+                work[d.station] = work.get(d.station, 0.0) + qty * float(d.estimated_time_sec or 0)
+    return work
+
+
+class AdmissionController:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        # station -> {order_id: 排隊中的工作秒數}
+        self.queued: Dict[str, Dict[str, float]] = {}
+        # station -> (order_id, 這件的工作秒數, busy_until_ms)
+        self.running: Dict[str, Tuple[str, float, int]] = {}
+
+    # ---------- 初始載入 ----------
+    def ensure_loaded(self, order_db, product_db) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self._load(order_db, product_db)
+            self.loaded = True
+
+    def _load(self, order_db, product_db) -> None:
+        # 先把記憶體模型還沒寫回的派工 / 完工寫進 DB，SQL 看到的才是目前狀態
+        if factory_model.loaded:
+            factory_model.flush(order_db)
+        ensure_process_template_schema(product_db)
+
+        self.queued = {}
+        orders = {
+            r["order_id"]: r
+            for r in order_db.execute("""
+                SELECT order_id, amount, step_name, step_deps, process_version
+                FROM order_list
+                WHERE status = 'active'
+            """)
+        }
+        lines: Dict[str, list] = {}
+        for r in order_db.execute("""
+            SELECT i.order_id, i.quantity, i.step_name, i.step_deps
+            FROM order_items i
+            JOIN order_list o ON o.order_id = i.order_id
+            WHERE o.status = 'active'
+        """):
+            lines.setdefault(r["order_id"], []).append((int(r["quantity"]), load_route(r["step_name"], r["step_deps"])))
+
+        # 產線還沒跑過時 core/factory_routes.py 還沒建表 / 補 _ms 欄位
+        tables = {r[0] for r in order_db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        has_pieces = "piece_step_progress" in tables
+        has_busy_ms = "station_state" in tables and "busy_until_ms" in {
+            r[1] for r in order_db.execute("PRAGMA table_info(station_state)")
+        }
+
+        # 已經不是 pending 的 piece rows（加工中 / 完成 / 異常）不算排隊
+        started: Dict[Tuple[str, int], int] = {}
+        if has_pieces:
+            for r in order_db.execute("""
+                SELECT p.order_id, p.step_order, COUNT(*) AS c
+                FROM piece_step_progress p
+                JOIN order_list o ON o.order_id = p.order_id
+                WHERE o.status = 'active' AND p.state <> 'pending'
+                GROUP BY p.order_id, p.step_order
+            """):
+                started[(r["order_id"], int(r["step_order"]))] = int(r["c"])
+
+        for oid, o in orders.items():
+            # 舊訂單沒有 order_items → 整張訂單一個品項
+            order_lines = lines.get(oid) or [(max(1, int(o["amount"] or 1)), load_route(o["step_name"], o["step_deps"]))]
+            step_defs = get_step_defs(product_db, o["process_version"])
+            pieces: Dict[int, int] = {}
+            for qty, route in order_lines:
+                for step_no in route:
+                    pieces[step_no] = pieces.get(step_no, 0) + qty
+            for step_no, n in pieces.items():
+                d = step_defs.get(step_no)
+                left = n - started.get((oid, step_no), 0)
+                if d and d.station and left > 0:
+                    q = self.queued.setdefault(d.station, {})
+                    q[oid] = q.get(oid, 0.0) + left * float(d.estimated_time_sec or 0)
+
+        self.running = {}
+        if has_busy_ms:
+            for r in order_db.execute("""
+                SELECT s.station, s.current_order_id, s.current_step_order, s.busy_until_ms, o.process_version
+                FROM station_state s
+                JOIN order_list o ON o.order_id = s.current_order_id
+                WHERE s.busy_until_ms IS NOT NULL
+            """):
+                d = get_step_defs(product_db, r["process_version"]).get(int(r["current_step_order"]))
+                sec = float(d.estimated_time_sec or 0) if d else 0.0
+                self.running[r["station"]] = (r["current_order_id"], sec, int(r["busy_until_ms"]))
+
+    def invalidate(self) -> None:
+        """下一次使用時從 SQL 重建（例如大量匯入訂單、重設訂單）"""
+        self.loaded = False
+
+    # ---------- 下單 ----------
+    def backlog_sec(self, now_ms: int) -> Dict[str, float]:
+        """各站目前尚未完成的工作秒數（排隊 + 加工中剩餘）"""
+        with self.lock:
+            return self._backlog(now_ms)
+
+    def _backlog(self, now_ms: int) -> Dict[str, float]:
+        out = {st: sum(q.values()) for st, q in self.queued.items()}
+        for st, (_, _, busy_until_ms) in self.running.items():
+            out[st] = out.get(st, 0.0) + max(0, busy_until_ms - now_ms) / 1000
+        return out
+
+    def try_admit(self, order_db, order_id: str, work: Dict[str, float], horizon_sec: float,
+                  now_ms: int) -> Optional[int]:
+        """
+        加入後每一站都不超過 horizon_sec → 預留這張訂單的工作並回傳 None；
+        否則不預留，回傳最早可接單的時間（epoch 毫秒）。
+        """
+        with self.lock:
+            backlog = self._backlog(now_ms)
+            over = {
+                st: backlog.get(st, 0.0) + sec - horizon_sec
+                for st, sec in work.items()
+                if horizon_sec > 0 and backlog.get(st, 0.0) + sec > horizon_sec
+            }
+            if not over:
+                self._add(order_id, work)
+                return None
+
+        # 超量的站點要先消化掉多出來的秒數（停機時段不算）才接得下這張單
+        avail = load_availability(order_db, now_ms)
+        return max(avail.finish_after(st, now_ms, int(sec * 1000)) for st, sec in over.items())
+
+    # ---------- 增量更新（派工程式呼叫；尚未載入時忽略，載入時會從 SQL 算） ----------
+    def _add(self, order_id: str, work: Dict[str, float]) -> None:
+        for st, sec in work.items():
+            if sec > 0:
+                q = self.queued.setdefault(st, {})
+                q[order_id] = q.get(order_id, 0.0) + sec
+
+    def work_added(self, order_id: str, work: Dict[str, float]) -> None:
+        """工作重新排隊（例如異常件重試）"""
+        if not self.loaded:
+            return
+        with self.lock:
+            self._add(order_id, work)
+
+    def work_started(self, station: str, order_id: str, sec: float, busy_until_ms: int) -> None:
+        """派工：這件的工作從排隊移到站點上"""
+        if not self.loaded:
+            return
+        with self.lock:
+            q = self.queued.get(station, {})
+            if order_id in q:
+                q[order_id] -= sec
+                if q[order_id] <= 1e-6:
+                    del q[order_id]
+            self.running[station] = (order_id, sec, busy_until_ms)
+
+    def work_finished(self, station: str, requeue: bool = False) -> None:
+        """完工（或異常）：站點上的工作消失；requeue=True（失敗重排 / 停機中斷）時放回排隊"""
+        if not self.loaded:
+            return
+        with self.lock:
+            job = self.running.pop(station, None)
+            if job and requeue:
+                self._add(job[0], {station: job[1]})
+
+    def order_closed(self, order_id: str) -> None:
+        """訂單完成 / 取消 / 拒絕：排隊中的工作不會再做了"""
+        if not self.loaded:
+            return
+        with self.lock:
+            for q in self.queued.values():
+                q.pop(order_id, None)
+
+
+admission = AdmissionController()
@@ -59,6 +59,8 @@ def login():
             if user and check_password_hash(user["password_hash"], password):
                 # 登入成功
                 session.clear()
+                # 登入後換新的 session id（不沿用登入前的 sid）
+                session.regenerate()
                 session["user_id"] = user["id"]
                 session["account"] = user["account"]
                 session["role"] = user["role"]
@@ -0,0 +1,318 @@
+# core/batch_sim.py
+# 批次模擬（產能評估用，`flask factory simulate-batch`）：
+# - 一組訂單（從 DB 讀 active 訂單，或依參數隨機產生）在虛擬時間裡跑完，全部在記憶體：
+#   自己的 FactoryModel（不寫回 DB）、事件 heap（訂單到達 / 完工 / 停機結束），時間直接跳到下一個事件
+# - 派工用 core/dispatch.py 的同一份規則；每個事件時間點依訂單到達順序，每張未完成的訂單各跑一次派工 pass
+#   （和網站上每張訂單各自 tick 一樣），站點都忙碌時就不再往下找
+# - 另外維護「各站有哪些訂單有可開始的件」，只對派得出去的訂單跑 pass，
+#   積壓上萬張訂單時每個事件也不必掃過全部訂單（結果和逐張跑相同）
+# - 完工可依 failure_rate 失敗重排，超過 max_attempts 的件報廢（error），不會等人工重試；
+#   報廢步驟之後的步驟也一起關掉，訂單不會卡在永遠等不到前置的 pending
+# - 可以用另一個模板版本或覆寫步驟秒數，在 manager_process_templates 正式修改前先評估影響
+# - 輸出：makespan、各站稼動率（扣停機）、訂單延遲（完成 - 交期）、吞吐曲線（每個 bucket 完成的件數）
+
+from __future__ import annotations
+
+import bisect
+import heapq
+import random
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from .dispatch import dispatch_order, station_steps
+from .factory_metrics import _percentiles
+from .factory_model import FactoryModel
+from .process_dag import Route, route_from_stages, successors
+from .process_templates import StepDef
+from .station_availability import Availability
+from .timeutil import fmt_ms
+
+DEFAULT_DUE_HOURS = 24
+DEFAULT_BUCKET_HOURS = 24
+
+# 同一個時間點的事件處理順序：先完工 / 停機結束釋放站點，再放進新訂單，最後才派工
+_FINISH, _WAKE, _RELEASE = 0, 1, 2
+
+
+class SimOrder:
+    def __init__(self, order_id: str, release_ms: int, due_ms: int, lines: List[dict],
+                 step_defs: Dict[int, StepDef]):
+        self.order_id = order_id
+        self.release_ms = release_ms
+        self.due_ms = due_ms
+        # 和 core/factory_routes.py 的 _order_lines 同格式：line_no / quantity / piece_from / piece_to / route
+        self.lines = lines
+        self.step_defs = step_defs
+        self.completed_ms: Optional[int] = None
+
+
+def override_times(step_defs: Dict[int, StepDef], times: Mapping[int, int]) -> Dict[int, StepDef]:
+    """覆寫部分步驟的秒數（不改模板本身）"""
+    if not times:
+        return step_defs
+    return {
+        n: d._replace(estimated_time_sec=int(times[n])) if n in times else d
+        for n, d in step_defs.items()
+    }
+
+
+def synthesize_orders(
+    step_defs: Dict[int, StepDef],
+    count: int,
+    start_ms: int,
+    days: float,
+    max_qty: int = 10,
+    due_hours: float = DEFAULT_DUE_HOURS,
+    seed: Optional[int] = None,
+) -> List[SimOrder]:
+    """
+    隨機產生訂單：到達時間在 days 天內均勻分布，件數 1..max_qty，
+    路線是從模板中隨機挑幾個有站點的步驟、依 step_order 串成線性流程（和下單頁勾選步驟相同）
+    """
+    rng = random.Random(seed)
+    steps = sorted(n for n, d in step_defs.items() if d.station)
+    if not steps:
+        raise ValueError("模板沒有任何指定站點的步驟")
+
+    releases = sorted(start_ms + int(rng.random() * days * 86400 * 1000) for _ in range(count))
+    out = []
+    for i, release_ms in enumerate(releases, start=1):
+        chosen = sorted(rng.sample(steps, rng.randint(1, len(steps))))
+        qty = rng.randint(1, max(1, max_qty))
+        route: Route = route_from_stages([s] for s in chosen)
+        out.append(SimOrder(
+            f"SIM{i:05d}",
+            release_ms,
+            release_ms + int(due_hours * 3600 * 1000),
+            [{"line_no": 1, "quantity": qty, "piece_from": 1, "piece_to": qty, "route": route}],
+            step_defs,
+        ))
+    return out
+
+
+def run_batch(
+    orders: List[SimOrder],
+    start_ms: int,
+    windows: Optional[Dict[str, List[Tuple[int, int]]]] = None,
+    failure_rate: float = 0.0,
+    max_attempts: int = 3,
+    bucket_sec: int = DEFAULT_BUCKET_HOURS * 3600,
+    seed: Optional[int] = None,
+) -> dict:
+    """windows = 停機時段 {station: [(start_ms, end_ms)]}（依開始時間排序）"""
+    wall0 = time.perf_counter()
+    rng = random.Random(seed)
+    avail = Availability(start_ms, windows or {})
+
+    model = FactoryModel()
+    model.loaded = True
+    model.ensure_stations(sorted({d.station for o in orders for d in o.step_defs.values() if d.station}))
+
+    by_id = {o.order_id: o for o in orders}
+    # step_defs 通常整批共用同一份，station_steps 只算一次
+    by_station_of: Dict[int, Dict[str, List[int]]] = {}
+    for o in orders:
+        if id(o.step_defs) not in by_station_of:
+            by_station_of[id(o.step_defs)] = station_steps(o.step_defs)
+
+    # 每一件的路線（判斷可開始 / 整件完成用）：order_id -> piece_no -> route
+    piece_route: Dict[str, Dict[int, Route]] = {}
+    # 訂單還沒結束（pending / running）的 piece-step 數，歸零就是訂單結束
+    open_count: Dict[str, int] = {}
+    # 可開始的 piece-step 數：order_id -> station -> 數量
+    ready: Dict[str, Dict[str, int]] = {}
+    # station -> 有可開始工作的訂單（依到達順序的 rank 排序）；派工只需要看這些訂單
+    queue: Dict[str, List[int]] = {st: [] for st in model.stations}
+    rank_of: Dict[str, int] = {}
+    order_at: List[SimOrder] = []
+
+    def add_ready(oid: str, station: Optional[str], n: int) -> None:
+        if not station:
+            return
+        counts = ready[oid]
+        before = counts.get(station, 0)
+        counts[station] = before + n
+        q = queue[station]
+        if before == 0 and n > 0:
+            bisect.insort(q, rank_of[oid])
+        elif before + n == 0:
+            del q[bisect.bisect_left(q, rank_of[oid])]
+
+    heap: List[tuple] = []
+    seq = 0
+
+    def push(t: int, kind: int, payload) -> None:
+        nonlocal seq
+        seq += 1
+        heapq.heappush(heap, (t, kind, seq, payload))
+
+    for o in orders:
+        push(o.release_ms, _RELEASE, o.order_id)
+    # 停機結束時站點重新可用，要醒來派工
+    for spans in avail.windows.values():
+        for _, e in spans:
+            if e > start_ms:
+                push(e, _WAKE, None)
+
+    busy_ms: Dict[str, int] = {}
+    jobs: Dict[str, int] = {}
+    piece_done_ms: List[int] = []
+    scrapped = 0
+    events = 0
+    now = start_ms
+    # 最後一次完工的時間（停機結束等事件不算 makespan）
+    last_ms = start_ms
+
+    while heap:
+        now = heap[0][0]
+        while heap and heap[0][0] == now:
+            _, kind, _, payload = heapq.heappop(heap)
+            events += 1
+            if kind == _RELEASE:
+                o = by_id[payload]
+                rank_of[o.order_id] = len(order_at)
+                order_at.append(o)
+                ready[o.order_id] = {}
+                pieces = {}
+                routes = {}
+                for ln in o.lines:
+                    for piece_no in range(ln["piece_from"], ln["piece_to"] + 1):
+                        routes[piece_no] = ln["route"]
+                        for step_no, preds in ln["route"].items():
+                            pieces[(piece_no, step_no)] = ["pending", None, None, 0]
+                            if not preds:
+                                add_ready(o.order_id, _station(o, step_no), 1)
+                model.pieces[o.order_id] = pieces
+                piece_route[o.order_id] = routes
+                open_count[o.order_id] = len(pieces)
+                if not pieces:
+                    o.completed_ms = now
+            elif kind == _FINISH:
+                station = payload
+                job, outcome = model.finish(
+                    station, now, ok=rng.random() >= failure_rate, max_attempts=max_attempts
+                )
+                oid, piece_no, step_no = job["order_id"], job["piece_no"], job["step_order"]
+                o = by_id[oid]
+                last_ms = now
+                if outcome == "retry":
+                    add_ready(oid, station, 1)
+                    continue
+                # finished / error 都讓這個 piece-step 結束（報廢的件不再等）
+                open_count[oid] -= 1
+                pieces = model.pieces[oid]
+                route = piece_route[oid][piece_no]
+                if outcome == "error":
+                    scrapped += 1
+                    # 報廢的件後續步驟永遠等不到前置完成：一起關掉（也是 error），訂單才會結束
+                    for nxt in successors(route, step_no):
+                        p = pieces[(piece_no, nxt)]
+                        if p[0] == "pending":
+                            p[0] = "error"
+                            open_count[oid] -= 1
+                else:
+                    # 後續步驟的前置都完成了就變成可開始
+                    for nxt, preds in route.items():
+                        if step_no in preds and pieces[(piece_no, nxt)][0] == "pending" and all(
+                            pieces[(piece_no, q)][0] == "finished" for q in preds
+                        ):
+                            add_ready(oid, _station(o, nxt), 1)
+                    if all(pieces[(piece_no, s)][0] == "finished" for s in route):
+                        piece_done_ms.append(now)
+                if open_count[oid] == 0:
+                    o.completed_ms = now
+
+        # 依到達順序，每張有工作可派給閒置站點的訂單各跑一次派工 pass；其他訂單跑了也派不出去，直接略過
+        last_rank = -1
+        while True:
+            idle = [
+                st for st in model.idle_stations()
+                if queue[st] and not avail.is_down(st, now)
+            ]
+            nxt_rank = None
+            for st in idle:
+                q = queue[st]
+                i = bisect.bisect_right(q, last_rank)
+                if i < len(q) and (nxt_rank is None or q[i] < nxt_rank):
+                    nxt_rank = q[i]
+            if nxt_rank is None:
+                break
+            last_rank = nxt_rank
+            o = order_at[nxt_rank]
+            for station, _, _, busy_until_ms in dispatch_order(
+                model, o.order_id, o.lines, o.step_defs, avail, now, by_station_of[id(o.step_defs)]
+            ):
+                add_ready(o.order_id, station, -1)
+                busy_ms[station] = busy_ms.get(station, 0) + busy_until_ms - now
+                jobs[station] = jobs.get(station, 0) + 1
+                push(busy_until_ms, _FINISH, station)
+
+        # 模擬不寫回 DB
+        model.dirty_pieces.clear()
+        model.dirty_stations.clear()
+
+    return _summarize(orders, model, start_ms, last_ms, avail, busy_ms, jobs, piece_done_ms, scrapped, events,
+                      bucket_sec, time.perf_counter() - wall0)
+
+
+def _station(o: SimOrder, step_no: int) -> Optional[str]:
+    d = o.step_defs.get(step_no)
+    return d.station if d else None
+
+
+def _summarize(orders, model, start_ms, end_ms, avail, busy_ms, jobs, piece_done_ms, scrapped, events,
+               bucket_sec, wall_sec) -> dict:
+    makespan_ms = max(1, end_ms - start_ms)
+
+    stations = []
+    for st in sorted(model.stations):
+        down_ms = sum(
+            max(0, min(e, end_ms) - max(s, start_ms))
+            for s, e in avail.windows.get(st, ())
+        )
+        stations.append({
+            "station": st,
+            "jobs": jobs.get(st, 0),
+            "busy_sec": round(busy_ms.get(st, 0) / 1000, 1),
+            "down_sec": round(down_ms / 1000, 1),
+            "utilization": round(min(1.0, busy_ms.get(st, 0) / max(1, makespan_ms - down_ms)), 4),
+        })
+
+    done = [o for o in orders if o.completed_ms is not None]
+    lateness = np.array([(o.completed_ms - o.due_ms) / 1000 for o in done], dtype=np.float64)
+    lead = np.array([(o.completed_ms - o.release_ms) / 1000 for o in done], dtype=np.float64)
+
+    # 吞吐曲線：每個 bucket 完成的件數與累計
+    n_buckets = max(1, -(-makespan_ms // (bucket_sec * 1000)))
+    counts = np.bincount(
+        (np.array(piece_done_ms, dtype=np.int64) - start_ms) // (bucket_sec * 1000),
+        minlength=n_buckets,
+    )[:n_buckets]
+    cumulative = np.cumsum(counts)
+
+    return {
+        "start": fmt_ms(start_ms),
+        "end": fmt_ms(end_ms),
+        "makespan_sec": round(makespan_ms / 1000, 1),
+        "orders": len(orders),
+        "orders_completed": len(done),
+        "pieces_completed": len(piece_done_ms),
+        "pieces_scrapped": scrapped,
+        "late_orders": int(np.count_nonzero(lateness > 0)),
+        "lateness_sec": _percentiles(lateness),
+        "lead_time_sec": _percentiles(lead),
+        "stations": stations,
+        "bucket_sec": bucket_sec,
+        "throughput": [
+            {
+                "bucket_start": fmt_ms(start_ms + i * bucket_sec * 1000),
+                "pieces_done": int(counts[i]),
+                "cumulative": int(cumulative[i]),
+            }
+            for i in range(n_buckets)
+        ],
+        "events": events,
+        "wall_sec": round(wall_sec, 3),
+    }
@@ -0,0 +1,239 @@
+# core/capacity_plan.py
+# 產能規劃（管理者報表用）：把所有 active 訂單「還沒做的件」投影到未來的時間 bucket，看各站負載是否可行
+# - 需求：每張訂單每個步驟剩下的 pending 件數 × 該訂單模板版本的步驟秒數；加工中的件算到 busy_until 為止
+# - 時間：同一張訂單的步驟依路線（DAG）排，步驟最早開始 = 前面還有剩餘工作的步驟沿最長路徑的單件秒數總和；
+#   同一個步驟的剩餘件數在該站連續做完。不考慮站點之間互相排隊，排隊的效果由「累積待做」表示
+# - 產能：每個 bucket 的秒數扣掉停機時段（station_downtime）
+# - 累積待做（backlog）：超出產能的工作延到下一個 bucket，W_i = max(0, W_{i-1} + 需求_i - 產能_i)，
+#   用 cumsum / minimum.accumulate 一次算完，不逐 bucket 跑 Python 迴圈
+# - 結果快取：下單 / 取消 / 拒絕 / 完成 / 匯入 / 重設 / 異常重試 / 停機異動時 invalidate()；
+#   派工持續在消化工作，另外加上短 TTL
+#   （訂單下單時就綁定模板版本，之後改模板不影響進行中訂單的需求，不需要因模板修改而失效）
+
+from __future__ import annotations
+
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .factory_metrics import _area_before, _merged_downtime
+from .factory_model import factory_model
+from .process_dag import load_route, topo_order
+from .process_templates import ensure_process_template_schema, get_step_defs
+from .timeutil import fmt_ms, now_ms as _now_ms
+
+DEFAULT_DAYS = 7
+DEFAULT_BUCKET_SEC = 60 * 60
+# 派工會持續改變剩餘工作；沒有 invalidate 時最多沿用這麼久
+CACHE_TTL_SEC = 60
+
+# (days, bucket_sec) -> (generation, computed_at_ms, result)
+_PLAN_CACHE: Dict[Tuple[int, int], Tuple[int, int, dict]] = {}
+_generation = 0
+_cache_lock = threading.Lock()
+
+
+def invalidate() -> None:
+    """訂單 / 停機時段異動時呼叫，下次查詢重新計算"""
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _PLAN_CACHE.clear()
+
+
+# -------------------------
+# 資料載入（SQL → 每個 (站點, 開始, 結束) 的工作區間，單位：距離現在的秒數）
+# -------------------------
+def _load_work(order_db, product_db, now: int) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, int]:
+    """回傳（站點名稱, 站點 index, 開始, 結束, active 訂單數）"""
+    ensure_process_template_schema(product_db)
+    tables = {r[0] for r in order_db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+    orders = order_db.execute("""
+        SELECT order_id, amount, step_name, step_deps, process_version
+        FROM order_list
+        WHERE status = 'active'
+    """).fetchall()
+    lines: Dict[str, list] = {}
+    for r in order_db.execute("""
+        SELECT i.order_id, i.quantity, i.step_name, i.step_deps
+        FROM order_items i
+        JOIN order_list o ON o.order_id = i.order_id
+        WHERE o.status = 'active'
+    """):
+        lines.setdefault(r["order_id"], []).append((int(r["quantity"]), load_route(r["step_name"], r["step_deps"])))
+
+    # 已經不是 pending 的件（加工中 / 完成 / 異常）不算剩餘；異常件要管理者重試才會回到排隊
+    started: Dict[Tuple[str, int], int] = {}
+    if "piece_step_progress" in tables:
+        for r in order_db.execute("""
+            SELECT p.order_id, p.step_order, COUNT(*) AS c
+            FROM piece_step_progress p
+            JOIN order_list o ON o.order_id = p.order_id
+            WHERE o.status = 'active' AND p.state <> 'pending'
+            GROUP BY p.order_id, p.step_order
+        """):
+            started[(r["order_id"], int(r["step_order"]))] = int(r["c"])
+
+    names: List[str] = []
+    station, start, end = [], [], []
+
+    def add(name: str, s: float, e: float) -> None:
+        if name not in names:
+            names.append(name)
+        station.append(names.index(name))
+        start.append(s)
+        end.append(e)
+
+    for o in orders:
+        oid = o["order_id"]
+        order_lines = lines.get(oid) or [(max(1, int(o["amount"] or 1)), load_route(o["step_name"], o["step_deps"]))]
+        step_defs = get_step_defs(product_db, o["process_version"])
+
+        # 同一張訂單的多個品項：步驟件數相加，前置步驟取聯集
+        pieces: Dict[int, int] = {}
+        route: Dict[int, Set[int]] = {}
+        for qty, r in order_lines:
+            for step_no, preds in r.items():
+                pieces[step_no] = pieces.get(step_no, 0) + qty
+                route.setdefault(step_no, set()).update(preds)
+
+        left = {s: max(0, n - started.get((oid, s), 0)) for s, n in pieces.items()}
+        offset: Dict[int, float] = {}
+        for s in topo_order({k: tuple(v) for k, v in route.items()}):
+            offset[s] = max(
+                (offset[p] + (step_defs[p].estimated_time_sec if left.get(p) and p in step_defs else 0)
+                 for p in route[s]),
+                default=0.0,
+            )
+            d = step_defs.get(s)
+            if d and d.station and left[s] > 0:
+                add(d.station, offset[s], offset[s] + left[s] * float(d.estimated_time_sec))
+
+    # 加工中的件：站點忙到 busy_until_ms
+    if "station_state" in tables and "busy_until_ms" in {r[1] for r in order_db.execute("PRAGMA table_info(station_state)")}:
+        for r in order_db.execute("""
+            SELECT station, busy_until_ms
+            FROM station_state
+            WHERE busy_until_ms > ?
+        """, (now,)):
+            add(r["station"], 0.0, (int(r["busy_until_ms"]) - now) / 1000)
+
+    return (
+        names,
+        np.array(station, dtype=np.int64),
+        np.array(start, dtype=np.float64),
+        np.array(end, dtype=np.float64),
+        len(orders),
+    )
+
+
+# -------------------------
+# 對外：計算規劃
+# -------------------------
+def compute_plan(
+    order_db,
+    product_db,
+    days: int = DEFAULT_DAYS,
+    bucket_sec: int = DEFAULT_BUCKET_SEC,
+    now: Optional[int] = None,
+) -> dict:
+    """now 為 epoch 毫秒（預設現在）；有快取且未過期時直接回傳快取"""
+    days = max(1, int(days))
+    bucket_sec = max(60, int(bucket_sec))
+    now = int(now if now is not None else _now_ms())
+    key = (days, bucket_sec)
+
+    with _cache_lock:
+        generation = _generation
+        cached = _PLAN_CACHE.get(key)
+        if cached and cached[0] == generation and 0 <= now - cached[1] < CACHE_TTL_SEC * 1000:
+            return {**cached[2], "cached": True}
+
+    if factory_model.loaded:
+        factory_model.flush(order_db)
+    result = _project(order_db, product_db, days, bucket_sec, now)
+
+    with _cache_lock:
+        # 計算期間有 invalidate 的話結果可能已過時，不放進快取
+        if generation == _generation:
+            _PLAN_CACHE[key] = (generation, now, result)
+    return {**result, "cached": False}
+
+
+def _project(order_db, product_db, days: int, bucket_sec: int, now: int) -> dict:
+    names, station, start, end, n_orders = _load_work(order_db, product_db, now)
+
+    # bucket 對齊 bucket_sec 的整數倍（以 epoch 秒計）；第一個 bucket 從現在算起
+    now_s = now / 1000
+    first = int(now_s // bucket_sec) * bucket_sec
+    n_buckets = -(-days * 86400 // bucket_sec)
+    edges = first + np.arange(n_buckets + 1, dtype=np.float64) * bucket_sec
+    edges[0] = now_s
+    horizon_end = float(edges[-1])
+    # 工作區間平移成 epoch 秒
+    start, end = start + now_s, end + now_s
+
+    down = _merged_downtime(order_db, now_s, horizon_end)
+    for st in down:
+        if st not in names:
+            names.append(st)
+
+    k = len(names)
+    demand = np.zeros((k, n_buckets))
+    capacity = np.tile(np.diff(edges), (k, 1))
+    beyond = np.zeros(k)
+    for i in range(k):
+        sel = station == i
+        ss, se = np.sort(start[sel]), np.sort(end[sel])
+        if ss.size:
+            # 和指標報表的 WIP 同一個做法：∫ 工作中區間數，相鄰 edges 相減就是每個 bucket 的工作秒數
+            demand[i] = np.diff(_area_before(ss, np.cumsum(ss), se, np.cumsum(se), edges))
+            beyond[i] = float(np.clip(se - horizon_end, 0, None).sum() - np.clip(ss - horizon_end, 0, None).sum())
+        for a, b in down.get(names[i], ()):
+            capacity[i] -= np.clip(np.minimum(edges[1:], b) - np.maximum(edges[:-1], a), 0, None)
+
+    # 累積待做：W_i = max(0, W_{i-1} + x_i) = S_i - min(0, min_{j<=i} S_j)
+    net = np.cumsum(demand - capacity, axis=1)
+    backlog = net - np.minimum(np.minimum.accumulate(net, axis=1), 0)
+    # 整個 bucket 都停機（產能 0）卻有需求時負載記為 nan（JSON 輸出 None）
+    load = np.divide(demand, capacity, out=np.where(demand > 0, np.nan, 0.0), where=capacity > 0)
+    over_i, over_b = np.nonzero(demand > capacity + 1e-6)
+
+    labels = [fmt_ms(int(t * 1000)) for t in edges[:-1]]
+    order = sorted(range(k), key=lambda i: names[i])
+    return {
+        "start": fmt_ms(now),
+        "end": fmt_ms(int(horizon_end * 1000)),
+        "days": days,
+        "bucket_sec": bucket_sec,
+        "orders": n_orders,
+        "buckets": labels,
+        "stations": [
+            {
+                "station": names[i],
+                "total_demand_sec": round(float(demand[i].sum()), 1),
+                "total_capacity_sec": round(float(capacity[i].sum()), 1),
+                "peak_load": round(float(np.nanmax(load[i], initial=0.0)), 4),
+                "overloaded_buckets": int(np.count_nonzero(over_i == i)),
+                # 規劃期間結束時還做不完的秒數（超出產能累積 + 排到規劃期間之後的工作）
+                "backlog_end_sec": round(float(backlog[i, -1] + beyond[i]), 1),
+                "demand_sec": np.round(demand[i], 1).tolist(),
+                "capacity_sec": np.round(capacity[i], 1).tolist(),
+                "backlog_sec": np.round(backlog[i], 1).tolist(),
+            }
+            for i in order
+        ],
+        "overloaded": [
+            {
+                "station": names[i],
+                "bucket_start": labels[b],
+                "demand_sec": round(float(demand[i, b]), 1),
+                "capacity_sec": round(float(capacity[i, b]), 1),
+                "load": round(float(load[i, b]), 4) if not np.isnan(load[i, b]) else None,
+                "backlog_sec": round(float(backlog[i, b]), 1),
+            }
+            for b, i in sorted(zip(over_b.tolist(), over_i.tolist()), key=lambda x: (x[0], names[x[1]]))
+        ],
+    }
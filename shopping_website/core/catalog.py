@@ -0,0 +1,183 @@
+# core/catalog.py
+# 產品目錄快取（每個 process 一份）：
+# - 產品基本資料（名稱 / 說明 / 單價）幾乎不變 → 存成 immutable 的 Product tuple
+# - 庫存會隨下單 / 盤點變動 → 分開存，只在 stock_version 變了才重抓 id, stock
+# - 版本號存在 product.db 的 catalog_version，寫入端（庫存帳本）在同一個 transaction 內 +1，
+#   多個 worker 之間靠版本號保持一致；版本號最多每 CHECK_INTERVAL 秒才查一次 DB
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .db import get_product_db
+
+# 多久檢查一次 DB 版本號（秒）；本 process 自己寫入時會立刻重查
+CHECK_INTERVAL = 1.0
+
+
+class Product(NamedTuple):
+    id: int
+    name: str
+    description: Optional[str]
+    base_price: int
+
+
+def ensure_catalog_schema(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+          id INTEGER PRIMARY KEY CHECK(id = 1),
+          meta_version INTEGER NOT NULL DEFAULT 1,
+          stock_version INTEGER NOT NULL DEFAULT 1,
+          updated_at TEXT NOT NULL
+        );
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO catalog_version(id, updated_at) VALUES (1, ?)",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),),
+    )
+    conn.commit()
+
+
+def _bump(conn: sqlite3.Connection, column: str) -> None:
+    conn.execute(
+        f"UPDATE catalog_version SET {column} = {column} + 1, updated_at = ? WHERE id = 1",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),),
+    )
+    # 本 process 下一次讀取一定重查版本號（commit 之後就會看到新版本；rollback 則版本不變）
+    _cache.force_check = True
+
+
+def bump_stock_version(conn: sqlite3.Connection) -> None:
+    """庫存有變動時呼叫（不 commit，和庫存寫入同一個 transaction）"""
+    _bump(conn, "stock_version")
+
+
+def bump_meta_version(conn: sqlite3.Connection) -> None:
+    """產品基本資料（名稱 / 單價…）有變動時呼叫（不 commit）"""
+    _bump(conn, "meta_version")
+
+
+class _CatalogCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta_version = 0
+        self.stock_version = 0
+        self.updated_at: Optional[str] = None
+        self.products: Tuple[Product, ...] = ()
+        self.by_id: Dict[int, Product] = {}
+        self.stock: Dict[int, int] = {}
+        self.checked_at = 0.0
+        self.force_check = True
+        # /api/products 的回應內容：((meta_version, stock_version), body bytes)
+        self.api_body: Optional[Tuple[Tuple[int, int], bytes]] = None
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        if not self.force_check and now - self.checked_at < CHECK_INTERVAL:
+            return
+
+        with self.lock:
+            if not self.force_check and time.monotonic() - self.checked_at < CHECK_INTERVAL:
+                return
+            self.force_check = False
+
+            conn = get_product_db()
+            try:
+                if not self.meta_version:
+                    # 第一次載入：版本表可能還不存在
+                    ensure_catalog_schema(conn)
+                v = conn.execute(
+                    "SELECT meta_version, stock_version, updated_at FROM catalog_version WHERE id = 1"
+                ).fetchone()
+
+                if int(v["meta_version"]) != self.meta_version:
+                    rows = conn.execute(
+                        "SELECT id, name, description, base_price FROM products ORDER BY id"
+                    ).fetchall()
+                    self.products = tuple(
+                        Product(int(r["id"]), r["name"], r["description"], r["base_price"] or 0)
+                        for r in rows
+                    )
+                    self.by_id = {p.id: p for p in self.products}
+                    self.meta_version = int(v["meta_version"])
+                    # 產品清單變了，庫存也一起重抓
+                    self.stock_version = 0
+
+                if int(v["stock_version"]) != self.stock_version:
+                    self.stock = {
+                        int(r["id"]): int(r["stock"] or 0)
+                        for r in conn.execute("SELECT id, stock FROM products")
+                    }
+                    self.stock_version = int(v["stock_version"])
+
+                self.updated_at = v["updated_at"]
+            finally:
+                conn.close()
+                self.checked_at = time.monotonic()
+
+
+_cache = _CatalogCache()
+
+
+def get_products() -> List[dict]:
+    """產品清單 + 目前庫存（給模板 / API 用的 dict）"""
+    _cache.refresh()
+    stock = _cache.stock
+    return [dict(p._asdict(), stock=stock.get(p.id, 0)) for p in _cache.products]
+
+
+def get_product(product_id: int) -> Optional[Product]:
+    _cache.refresh()
+    return _cache.by_id.get(int(product_id))
+
+
+def get_stock(product_id: int) -> int:
+    _cache.refresh()
+    return _cache.stock.get(int(product_id), 0)
+
+
+def invalidate() -> None:
+    """強制下一次讀取重查版本號（例如直接改了 DB）"""
+    _cache.force_check = True
+
+
+def catalog_etag() -> str:
+    """目錄版本對應的 ETag（任何產品資料或庫存變動都會改變）"""
+    _cache.refresh()
+    return f"catalog-{_cache.meta_version}-{_cache.stock_version}"
+
+
+def catalog_last_modified() -> Optional[datetime]:
+    """最後一次變動時間（本地時間 → aware datetime，給 Last-Modified 用）"""
+    _cache.refresh()
+    if not _cache.updated_at:
+        return None
+    return datetime.strptime(_cache.updated_at, "%Y-%m-%d %H:%M:%S").astimezone()
+
+
+def products_api_body() -> bytes:
+    """
+    /api/products 的 JSON（id, name, base_price, stock），
+    同一個版本只序列化一次，之後直接回傳同一份 bytes。
+    """
+    _cache.refresh()
+    version = (_cache.meta_version, _cache.stock_version)
+    cached = _cache.api_body
+    if cached and cached[0] == version:
+        return cached[1]
+
+    stock = _cache.stock
+    body = json.dumps(
+        [
+            {"id": p.id, "name": p.name, "base_price": p.base_price, "stock": stock.get(p.id, 0)}
+            for p in _cache.products
+        ],
+        ensure_ascii=False,
+    ).encode("utf-8")
+    _cache.api_body = (version, body)
+    return body
@@ -7,6 +7,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 USER_DB_PATH = os.path.join(BASE_DIR, "database", "User_Data.db")
 PRODUCT_DB_PATH = os.path.join(BASE_DIR, "database", "product.db")
 ORDER_MGMT_DB_PATH = os.path.join(BASE_DIR, "database", "order_management.db")
+SESSION_DB_PATH = os.path.join(BASE_DIR, "database", "session.db")
 
 
 def get_user_db():
@@ -27,3 +28,10 @@ def get_order_mgmt_db():
     conn.row_factory = sqlite3.Row
     return conn
 
+
+
+def get_session_db():
+    """伺服器端 session（購物車等）用的 DB:session.db"""
+    conn = sqlite3.connect(SESSION_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
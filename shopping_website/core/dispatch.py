@@ -0,0 +1,89 @@
+# core/dispatch.py
+# 派工規則：一張訂單的一次派工 pass。網站的 tick（core/factory_routes.py）和批次模擬（core/batch_sim.py）
+# 共用同一份，批次模擬評估出來的結果才和實際產線一致
+# - 只派給閒置、現在沒停機、加工期間也不會碰到停機的站點
+# - 站點在自己負責的步驟裡挑「可開始」的件：自己是 pending、所有前置步驟都 finished
+# - 多個品項 / 步驟都能做時，已開始比例最低的品項優先（品項輪流使用站點），再依步驟、品項編號
+# - 派出去的件直接在傳入的 FactoryModel 上 start（只改記憶體；站點不再閒置或件不再 pending 時 start 會拒絕）；
+#   driver / 看板 / 產能控管等副作用由呼叫端處理
+
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from .process_templates import StepDef
+from .station_availability import Availability
+
+
+def station_steps(step_defs: Dict[int, StepDef]) -> Dict[str, List[int]]:
+    """station -> 這個站點負責的 step_order（由小到大）"""
+    out: Dict[str, List[int]] = {}
+    for step_no, d in step_defs.items():
+        if d.station:
+            out.setdefault(d.station, []).append(step_no)
+    for steps in out.values():
+        steps.sort()
+    return out
+
+
+def dispatch_order(
+    model,
+    order_id: str,
+    lines: List[dict],
+    step_defs: Dict[int, StepDef],
+    avail: Availability,
+    now_ms: int,
+    by_station: Optional[Dict[str, List[int]]] = None,
+) -> List[Tuple[str, int, int, int]]:
+    """
+    lines 為訂單的品項（line_no / quantity / piece_from / piece_to / route）。
+    by_station = station_steps(step_defs)，呼叫端已算好時可傳入（批次模擬每個事件都會呼叫）。
+    回傳派出去的工作 [(station, piece_no, step_order, busy_until_ms)]。
+    """
+    if by_station is None:
+        by_station = station_steps(step_defs)
+
+    # 各品項在每一步已開始（running + finished）的件數
+    progress = model.line_step_progress(order_id, lines)
+    started = {k: v["done"] + v["running"] for k, v in progress.items()}
+
+    out: List[Tuple[str, int, int, int]] = []
+    for station in model.idle_stations():
+        step_list = by_station.get(station, [])
+        if not step_list or avail.is_down(station, now_ms):
+            continue
+
+        best_job = None  # (sort key, piece_no, step_no, line_no)
+
+        for step_no in step_list:
+            if not avail.fits(station, now_ms, int(step_defs[step_no].estimated_time_sec) * 1000):
+                continue
+            for ln in lines:
+                if step_no not in ln["route"]:
+                    continue
+
+                # 同一件的並行分支可以同時在不同站點加工
+                piece_no = model.next_ready_piece(
+                    order_id, step_no, ln["route"][step_no], ln["piece_from"], ln["piece_to"]
+                )
+                if piece_no is None:
+                    continue
+
+                ratio = started.get((ln["line_no"], step_no), 0) / ln["quantity"]
+                key = (ratio, step_no, ln["line_no"])
+                if best_job is None or key < best_job[0]:
+                    best_job = (key, piece_no, step_no, ln["line_no"])
+
+        if not best_job:
+            continue
+
+        _, piece_no, step_no, line_no = best_job
+        busy_until_ms = now_ms + int(step_defs[step_no].estimated_time_sec) * 1000
+
+        # 站點 / 件在挑選之後被別的派工拿走時 start 會拒絕，這個站點這次就不派
+        if not model.start(station, order_id, piece_no, step_no, now_ms, busy_until_ms):
+            continue
+        started[(line_no, step_no)] = started.get((line_no, step_no), 0) + 1
+        out.append((station, piece_no, step_no, busy_until_ms))
+
+    return out
@@ -0,0 +1,360 @@
+# core/factory_metrics.py
+# 產線指標（管理者報表用），資料來源是 piece_step_progress 的 started_at_ms / finished_at_ms：
+# - 站點稼動率：時間窗內各站加工秒數 /（時間窗長度 - 停機秒數）；停機時段來自 station_downtime
+# - 各步驟 cycle time 百分位數（finished_at - started_at）
+# - 排隊等待時間：可開始（同一件上一個完成的步驟 / 下單時間）到真正開始的秒數
+# - WIP：時間窗內平均「已開始、尚未全部完成」的件數（時間加權）
+#
+# 做法：
+# - SQL 只負責用整數毫秒欄位篩出時間窗內的資料（走索引、不解析字串），計算全部用 NumPy 陣列（不逐列跑 Python 迴圈）
+# - 時間窗切成固定長度的 bucket；已經過去的 bucket 結果不會再變，算一次就快取，
+#   之後只需要補算新的 bucket（目前進行中的 bucket 不快取）
+# - piece 紀錄被刪除 / 還原時，過去的 bucket 也會變：bump_generation 把 order DB 的 metrics_generation +1，
+#   每個 process（網站各 worker、模擬引擎）算指標前比對世代，變了就清掉自己的快取
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .process_templates import ensure_process_template_schema, get_step_defs
+from .station_availability import downtime_between
+from .timeutil import fmt_ms, now_ms, to_ms
+
+DEFAULT_WINDOW_SEC = 60 * 60
+DEFAULT_BUCKET_SEC = 5 * 60
+PERCENTILES = (50, 90, 95)
+# 最多快取幾個 bucket
+CACHE_SIZE = 5000
+
+# (bucket_sec, bucket_start) -> bucket summary
+_BUCKET_CACHE: "OrderedDict[Tuple[int, int], dict]" = OrderedDict()
+_cache_lock = threading.Lock()
+# _BUCKET_CACHE 是哪個 metrics_generation 算出來的
+_cache_generation: Optional[int] = None
+
+
+def _fmt(sec: float) -> str:
+    return fmt_ms(int(sec * 1000))
+
+
+def invalidate() -> None:
+    """清掉本 process 快取的 bucket（其他 process 要靠 bump_generation）"""
+    with _cache_lock:
+        _BUCKET_CACHE.clear()
+
+
+def ensure_metrics_schema(order_db) -> None:
+    """建立 metrics_generation（只有 id=1 一列；不 commit）"""
+    order_db.execute("""
+        CREATE TABLE IF NOT EXISTS metrics_generation (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          generation INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    order_db.execute("INSERT OR IGNORE INTO metrics_generation(id, generation) VALUES (1, 0)")
+
+
+def bump_generation(order_db) -> None:
+    """piece 紀錄被刪除 / 重設 / 還原時呼叫（不 commit，和刪改同一個 transaction）：所有 process 的快取失效"""
+    ensure_metrics_schema(order_db)
+    order_db.execute("UPDATE metrics_generation SET generation = generation + 1 WHERE id = 1")
+    invalidate()
+
+
+def _generation(order_db) -> int:
+    try:
+        row = order_db.execute("SELECT generation FROM metrics_generation WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+
+# -------------------------
+# 資料載入（SQL → NumPy 陣列，時間單位：epoch 秒）
+# -------------------------
+def _load_steps(order_db, product_db, t0: float, t1: float, now: float) -> dict:
+    """
+    時間窗 [t0, t1) 內有關的 piece-step：
+    start / finish（未完成用 now）/ ready（可開始時間）/ 站點 index / 步驟
+    """
+    rows = order_db.execute("""
+        SELECT
+          p.started_at_ms / 1000.0 AS s,
+          COALESCE(p.finished_at_ms / 1000.0, -1) AS f,
+          COALESCE(
+            (SELECT MAX(q.finished_at_ms)
+             FROM piece_step_progress q
+             WHERE q.order_id = p.order_id AND q.piece_no = p.piece_no
+               AND q.finished_at_ms <= p.started_at_ms),
+            o.date_ms,
+            p.started_at_ms
+          ) / 1000.0 AS r,
+          p.step_order AS step,
+          COALESCE(o.process_version, 1) AS v
+        FROM piece_step_progress p
+        JOIN order_list o ON o.order_id = p.order_id
+        WHERE p.started_at_ms < ?
+          AND (p.finished_at_ms IS NULL OR p.finished_at_ms >= ?)
+    """, (int(t1 * 1000), int(t0 * 1000))).fetchall()
+
+    n = len(rows)
+    data = np.array(rows, dtype=np.float64).reshape(n, 5)
+    start, finish, ready, step, version = data.T
+    finished = finish >= 0
+    finish = np.where(finished, finish, now)
+
+    # (版本, 步驟) → 站點：不同組合很少，只對 unique 值查一次
+    keys = version.astype(np.int64) * 100000 + step.astype(np.int64)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    ensure_process_template_schema(product_db)
+    stations: List[str] = []
+    station_of_key = np.empty(len(uniq), dtype=np.int64)
+    for i, k in enumerate(uniq):
+        d = get_step_defs(product_db, int(k // 100000)).get(int(k % 100000))
+        name = d.station if d and d.station else "(未指定站點)"
+        if name not in stations:
+            stations.append(name)
+        station_of_key[i] = stations.index(name)
+
+    return {
+        "start": start,
+        "finish": finish,
+        "finished": finished,
+        "ready": np.minimum(ready, start),
+        "step": step.astype(np.int64),
+        "station": station_of_key[inverse] if n else np.empty(0, dtype=np.int64),
+        "stations": stations,
+    }
+
+
+def _load_pieces(order_db, t0: float, t1: float, now: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    每一件的（第一個步驟開始, 全部完成）時間與是否已完成；
+    尚未完成的件結束時間用 now（取消 / 拒絕的訂單不再算在製品）
+    """
+    # 先用索引挑出可能落在區間內的件（區間內有步驟完成，或訂單仍 active），
+    # 再只對這些件 GROUP BY；成本跟區間內的件數有關，不隨全部歷史成長
+    rows = order_db.execute("""
+        WITH cand(order_id, piece_no) AS (
+          SELECT order_id, piece_no FROM piece_step_progress WHERE finished_at_ms >= ?
+          UNION
+          SELECT p.order_id, p.piece_no
+          FROM order_list o
+          JOIN piece_step_progress p ON p.order_id = o.order_id
+          WHERE o.status = 'active'
+        )
+        SELECT
+          MIN(p.started_at_ms) / 1000.0 AS s,
+          CASE WHEN SUM(p.finished_at_ms IS NULL) > 0 THEN ?
+               ELSE MAX(p.finished_at_ms) / 1000.0 END AS f,
+          SUM(p.finished_at_ms IS NULL) = 0 AS done
+        FROM cand c
+        JOIN piece_step_progress p ON p.order_id = c.order_id AND p.piece_no = c.piece_no
+        JOIN order_list o ON o.order_id = p.order_id
+        GROUP BY p.order_id, p.piece_no
+        HAVING MIN(p.started_at_ms) < ?
+           AND (
+             (done AND MAX(p.finished_at_ms) >= ?)
+             OR (NOT done AND MAX(o.status) = 'active')
+           )
+    """, (int(t0 * 1000), now, int(t1 * 1000), int(t0 * 1000))).fetchall()
+    data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return data[:, 0], data[:, 1], data[:, 2] > 0
+
+
+# -------------------------
+# 每個 bucket 的彙總（可合併）
+# -------------------------
+def _overlap(start: np.ndarray, end: np.ndarray, a: float, b: float) -> np.ndarray:
+    return np.clip(np.minimum(end, b) - np.maximum(start, a), 0, None)
+
+
+def _area_before(sorted_start: np.ndarray, cs_start: np.ndarray, sorted_end: np.ndarray, cs_end: np.ndarray,
+                 t: np.ndarray) -> np.ndarray:
+    """∫_{-∞}^{t} WIP(τ) dτ，對多個 t 一次算（searchsorted + prefix sum）"""
+    if sorted_start.size == 0:
+        return np.zeros_like(t)
+    ks = np.searchsorted(sorted_start, t, side="left")
+    ke = np.searchsorted(sorted_end, t, side="left")
+    s_sum = np.where(ks > 0, cs_start[np.maximum(ks - 1, 0)], 0.0)
+    e_sum = np.where(ke > 0, cs_end[np.maximum(ke - 1, 0)], 0.0)
+    return (ks * t - s_sum) - (ke * t - e_sum)
+
+
+def _summarize_buckets(steps: dict, pieces: Tuple[np.ndarray, np.ndarray, np.ndarray], edges: np.ndarray) -> List[dict]:
+    start, finish, finished = steps["start"], steps["finish"], steps["finished"]
+    station, step = steps["station"], steps["step"]
+    names = steps["stations"]
+    wait = start - steps["ready"]
+    duration = finish - start
+
+    p_start, p_end, p_done = pieces
+    ss, se = np.sort(p_start), np.sort(p_end)
+    wip_area = np.diff(_area_before(ss, np.cumsum(ss), se, np.cumsum(se), edges.astype(np.float64)))
+
+    out = []
+    for i in range(len(edges) - 1):
+        a, b = float(edges[i]), float(edges[i + 1])
+
+        # 稼動：各站在這個 bucket 內的加工秒數
+        busy = np.bincount(station, weights=_overlap(start, finish, a, b), minlength=len(names))
+
+        # cycle time 以完成時間歸屬 bucket；排隊等待以開始時間歸屬 bucket
+        done = finished & (finish >= a) & (finish < b)
+        began = (start >= a) & (start < b)
+
+        out.append({
+            "busy": {names[k]: float(busy[k]) for k in np.flatnonzero(busy)},
+            "cycle": {int(s): duration[done & (step == s)] for s in np.unique(step[done])},
+            "wait": {names[int(k)]: wait[began & (station == k)] for k in np.unique(station[began])},
+            "wip_area": float(wip_area[i]),
+            "pieces_done": int(np.count_nonzero(p_done & (p_end >= a) & (p_end < b))),
+        })
+    return out
+
+
+def _percentiles(values: np.ndarray) -> dict:
+    if values.size == 0:
+        return {"count": 0, "mean": None, **{f"p{p}": None for p in PERCENTILES}}
+    qs = np.percentile(values, PERCENTILES)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 2),
+        **{f"p{p}": round(float(q), 2) for p, q in zip(PERCENTILES, qs)},
+    }
+
+
+def _merged_downtime(order_db, t0: float, t1: float) -> Dict[str, List[Tuple[float, float]]]:
+    """時間窗內各站的停機時段（截到 [t0, t1]，同一站重疊的時段先合併；單位：epoch 秒）"""
+    windows: Dict[str, List[Tuple[float, float]]] = {}
+    for station, s_ms, e_ms in downtime_between(order_db, int(t0 * 1000), int(t1 * 1000)):
+        windows.setdefault(station, []).append((max(t0, s_ms / 1000), min(t1, e_ms / 1000)))
+
+    out: Dict[str, List[Tuple[float, float]]] = {}
+    for station, spans in windows.items():
+        merged: List[Tuple[float, float]] = []
+        for s, e in sorted(spans):
+            if merged and s <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+            else:
+                merged.append((s, e))
+        out[station] = merged
+    return out
+
+
+def _downtime_sec(order_db, t0: float, t1: float) -> Dict[str, float]:
+    """時間窗內各站停機秒數；停機時段可能事後修改，不進 bucket 快取"""
+    return {
+        station: sum(e - s for s, e in spans)
+        for station, spans in _merged_downtime(order_db, t0, t1).items()
+    }
+
+
+# -------------------------
+# 對外：計算時間窗指標
+# -------------------------
+def compute_metrics(
+    order_db,
+    product_db,
+    window_sec: int = DEFAULT_WINDOW_SEC,
+    bucket_sec: int = DEFAULT_BUCKET_SEC,
+    now: Optional[datetime] = None,
+) -> dict:
+    bucket_sec = max(1, int(bucket_sec))
+    window_sec = max(bucket_sec, int(window_sec))
+    now_s = (to_ms(now) if now is not None else now_ms()) / 1000
+
+    # bucket 對齊 bucket_sec 的整數倍；最後一個 bucket 是目前進行中的
+    last_start = int(now_s // bucket_sec) * bucket_sec
+    n_buckets = -(-window_sec // bucket_sec)
+    starts = [last_start - i * bucket_sec for i in range(n_buckets - 1, -1, -1)]
+
+    global _cache_generation
+    generation = _generation(order_db)
+    summaries: Dict[int, dict] = {}
+    with _cache_lock:
+        if generation != _cache_generation:
+            _BUCKET_CACHE.clear()
+            _cache_generation = generation
+        for b in starts[:-1]:
+            cached = _BUCKET_CACHE.get((bucket_sec, b))
+            if cached is not None:
+                _BUCKET_CACHE.move_to_end((bucket_sec, b))
+                summaries[b] = cached
+
+    missing = [b for b in starts if b not in summaries]
+    if missing:
+        # 缺的 bucket 一次載入（從最早缺的到現在）
+        t0, t1 = missing[0], missing[-1] + bucket_sec
+        steps = _load_steps(order_db, product_db, t0, t1, now_s)
+        pieces = _load_pieces(order_db, t0, t1, now_s)
+        # missing 不一定連續：整段一起算，只保留缺的 bucket
+        all_edges = np.arange(t0, t1 + bucket_sec, bucket_sec, dtype=np.float64)
+        # 進行中的 bucket 只算到現在
+        all_edges[-1] = min(all_edges[-1], now_s)
+        computed = _summarize_buckets(steps, pieces, all_edges)
+        by_start = {int(all_edges[i]): computed[i] for i in range(len(computed))}
+        with _cache_lock:
+            for b in missing:
+                summaries[b] = by_start[b]
+                if b != last_start:
+                    _BUCKET_CACHE[(bucket_sec, b)] = by_start[b]
+            while len(_BUCKET_CACHE) > CACHE_SIZE:
+                _BUCKET_CACHE.popitem(last=False)
+
+    # 合併 bucket
+    window_start = float(starts[0])
+    elapsed = max(1.0, now_s - window_start)
+    busy: Dict[str, float] = {}
+    cycle: Dict[int, List[np.ndarray]] = {}
+    wait: Dict[str, List[np.ndarray]] = {}
+    wip_area = 0.0
+    pieces_done = 0
+    series = []
+    for b in starts:
+        s = summaries[b]
+        for k, v in s["busy"].items():
+            busy[k] = busy.get(k, 0.0) + v
+        for k, v in s["cycle"].items():
+            cycle.setdefault(k, []).append(v)
+        for k, v in s["wait"].items():
+            wait.setdefault(k, []).append(v)
+        wip_area += s["wip_area"]
+        pieces_done += s["pieces_done"]
+        span = min(bucket_sec, max(1.0, now_s - b))
+        series.append({
+            "bucket_start": _fmt(b),
+            "wip": round(s["wip_area"] / span, 2),
+            "pieces_done": s["pieces_done"],
+        })
+
+    down = _downtime_sec(order_db, window_start, now_s)
+    station_names = sorted(set(busy) | set(wait) | set(down))
+    return {
+        "window_start": _fmt(window_start),
+        "window_end": _fmt(now_s),
+        "bucket_sec": bucket_sec,
+        "stations": [
+            {
+                "station": st,
+                "busy_sec": round(busy.get(st, 0.0), 1),
+                "down_sec": round(down.get(st, 0.0), 1),
+                "utilization": round(min(1.0, busy.get(st, 0.0) / max(1.0, elapsed - down.get(st, 0.0))), 4),
+                "wait_sec": _percentiles(np.concatenate(wait.get(st, [np.empty(0)]))),
+            }
+            for st in station_names
+        ],
+        "steps": [
+            {"step_order": k, "cycle_sec": _percentiles(np.concatenate(v))}
+            for k, v in sorted(cycle.items())
+        ],
+        "wip_avg": round(wip_area / elapsed, 2),
+        "pieces_done": pieces_done,
+        "series": series,
+    }
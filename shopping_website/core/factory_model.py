@@ -0,0 +1,524 @@
+# core/factory_model.py
+# 產線即時狀態的記憶體模型（write-behind）：
+# - 站點占用、各 piece-step 的狀態以記憶體為準，派工 / 完工只改記憶體並標記 dirty
+# - dirty 的列每 FACTORY_FLUSH_INTERVAL_SEC 秒在同一個 transaction 內批次寫回
+#   piece_step_progress / station_state（背景執行緒 + 行程結束時各寫一次），不再每次派工就 commit
+# - 啟動時從 DB 重建；因為每次寫回都是一個 transaction，DB 一定是某個一致的時間點，
+#   重建時再修正「running 但沒有站點在做」/「站點指向不是 running 的件」，crash 後可直接接著跑
+# - simulate 頁面 / tick 的進度彙總直接讀記憶體；指標報表 / trace 匯出讀 DB 前先寫回一次，
+#   訂單紀錄頁的進度最多落後一個寫回間隔
+# - 完成的訂單在 tick 裡直接移出記憶體；取消 / 退單等其他關單路徑由每次寫回時對照 order_list.status 移除
+# - 完工由站點驅動（core/station_drivers.py）回報事件；回報失敗就 attempts+1 退回 pending 重排，
+#   超過重試上限標成 error，等管理者手動重試；站點停機時正在做的件直接退回 pending（不算一次失敗）
+# - 狀態是每個 process 一份；多 worker 部署時同一張訂單必須固定由同一個 process 派工
+
+from __future__ import annotations
+
+import atexit
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .db import get_order_mgmt_db
+from .timeutil import fmt_ms
+
+# 多久寫回一次 DB（秒）；可用 app.config["FACTORY_FLUSH_INTERVAL_SEC"] 覆蓋
+DEFAULT_FLUSH_INTERVAL_SEC = 2.0
+
+log = logging.getLogger(__name__)
+
+# (order_id, piece_no, step_order)
+PieceKey = Tuple[str, int, int]
+
+
+class FactoryModel:
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL_SEC):
+        self.flush_interval = float(flush_interval)
+        self.lock = threading.RLock()
+        # 寫回 DB 時持有；重設訂單等直接改 DB 的動作也要拿這把鎖，避免被進行中的寫回蓋掉
+        self.flush_lock = threading.Lock()
+        self.loaded = False
+        # station -> {"order_id", "piece_no", "step_order", "busy_until_ms"}（閒置時值為 None）
+        self.stations: Dict[str, Optional[dict]] = {}
+        # order_id -> {(piece_no, step_order): [state, started_at_ms, finished_at_ms, attempts]}
+        self.pieces: Dict[str, Dict[Tuple[int, int], list]] = {}
+        self.dirty_pieces: Set[PieceKey] = set()
+        self.dirty_stations: Set[str] = set()
+        # 每次狀態改變 +1（core/tick_gate.py 用來判斷上次 tick 的結果是否還有效）
+        self.version = 0
+        self._flusher: Optional[threading.Thread] = None
+
+    # ---------- 啟動 / 重建 ----------
+    def ensure_loaded(self, order_db) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self._recover(order_db)
+            self.version += 1
+            self.loaded = True
+            self._start_flusher()
+
+    def _recover(self, order_db) -> None:
+        """從 DB 重建站點占用，並修正上次沒寫回完整的狀態（一個 transaction）"""
+        self.stations = {}
+        self.pieces = {}
+        self.dirty_pieces.clear()
+        self.dirty_stations.clear()
+
+        jobs = {}
+        for r in order_db.execute("""
+            SELECT station, current_order_id, current_piece_no, current_step_order, busy_until_ms
+            FROM station_state
+        """):
+            self.stations[r["station"]] = None
+            if r["current_order_id"] and r["current_piece_no"] is not None and r["busy_until_ms"] is not None:
+                jobs[r["station"]] = {
+                    "order_id": str(r["current_order_id"]),
+                    "piece_no": int(r["current_piece_no"]),
+                    "step_order": int(r["current_step_order"]),
+                    "busy_until_ms": int(r["busy_until_ms"]),
+                }
+
+        running = {
+            (str(r["order_id"]), int(r["piece_no"]), int(r["step_order"]))
+            for r in order_db.execute(
+                "SELECT order_id, piece_no, step_order FROM piece_step_progress WHERE state='running'"
+            )
+        }
+
+        held = set()
+        for station, job in jobs.items():
+            key = (job["order_id"], job["piece_no"], job["step_order"])
+            if key in running:
+                self.stations[station] = job
+                held.add(key)
+
+        # 站點指向不是 running 的件 → 釋放；running 但沒有站點在做 → 退回 pending 重做
+        stale = [st for st in jobs if self.stations[st] is None]
+        orphans = running - held
+        if stale:
+            order_db.executemany("""
+                UPDATE station_state
+                SET current_order_id=NULL, current_piece_no=NULL, current_step_order=NULL,
+                    busy_until=NULL, busy_until_ms=NULL
+                WHERE station=?
+            """, [(st,) for st in stale])
+        if orphans:
+            order_db.executemany("""
+                UPDATE piece_step_progress
+                SET state='pending', started_at=NULL, started_at_ms=NULL
+                WHERE order_id=? AND piece_no=? AND step_order=? AND state='running'
+            """, list(orphans))
+        order_db.commit()
+
+        # 站點正在做的訂單先載入，完工時才有記憶體狀態可以更新
+        for oid in {job["order_id"] for job in self.stations.values() if job}:
+            self.load_order(order_db, oid)
+        if stale or orphans:
+            log.warning("factory model recovered: %d stale stations, %d orphan running pieces", len(stale), len(orphans))
+
+    def reload(self, order_db, replace: Callable[[], None]) -> None:
+        """
+        整個 DB 被換掉時（還原快照）：持有寫回鎖執行 replace()，
+        丟掉還沒寫回的變動（它們屬於被換掉的狀態）並從 DB 重建
+        """
+        with self.flush_lock, self.lock:
+            replace()
+            self._recover(order_db)
+            self.version += 1
+
+    def ensure_stations(self, stations: Iterable[str]) -> None:
+        with self.lock:
+            for st in stations:
+                if st not in self.stations:
+                    self.stations[st] = None
+                    self.version += 1
+
+    def has_stations(self, stations: Iterable[str]) -> bool:
+        with self.lock:
+            return all(st in self.stations for st in stations)
+
+    # ---------- 訂單 ----------
+    def has_order(self, order_id: str) -> bool:
+        return order_id in self.pieces
+
+    def load_order(self, order_db, order_id: str) -> None:
+        """把一張訂單的 piece rows 讀進記憶體（之後這張訂單的狀態以記憶體為準）"""
+        rows = order_db.execute("""
+            SELECT piece_no, step_order, state, started_at_ms, finished_at_ms, attempts
+            FROM piece_step_progress
+            WHERE order_id=?
+        """, (order_id,)).fetchall()
+        with self.lock:
+            if order_id in self.pieces:
+                return
+            self.pieces[order_id] = {
+                (int(r["piece_no"]), int(r["step_order"])): [
+                    r["state"], r["started_at_ms"], r["finished_at_ms"], int(r["attempts"] or 0),
+                ]
+                for r in rows
+            }
+            self.version += 1
+
+    def unload_order(self, order_id: str) -> None:
+        """訂單已完成且寫回後從記憶體移除（之後再檢視會重新從 DB 載入）"""
+        with self.lock:
+            if not any(k[0] == order_id for k in self.dirty_pieces):
+                self.pieces.pop(order_id, None)
+                self.version += 1
+
+    def reset_order(self, order_db, order_id: str) -> List[str]:
+        """
+        刪除這張訂單的所有 piece rows 並釋放它占用的站點（直接寫 DB 並 commit）。
+        回傳被釋放的站點。
+        """
+        with self.flush_lock, self.lock:
+            self.pieces.pop(order_id, None)
+            self.dirty_pieces = {k for k in self.dirty_pieces if k[0] != order_id}
+            freed = [st for st, job in self.stations.items() if job and job["order_id"] == order_id]
+            for st in freed:
+                self.stations[st] = None
+                self.dirty_stations.discard(st)
+            self.version += 1
+
+            order_db.execute("""
+                UPDATE station_state
+                SET current_order_id=NULL, current_piece_no=NULL, current_step_order=NULL,
+                    busy_until=NULL, busy_until_ms=NULL, updated_at=?
+                WHERE current_order_id=?
+            """, (fmt_ms(int(time.time() * 1000)), order_id))
+            order_db.execute("DELETE FROM piece_step_progress WHERE order_id=?", (order_id,))
+            order_db.commit()
+        return freed
+
+    # ---------- 派工 / 完工（只改記憶體） ----------
+    def finish(self, station: str, at_ms: int, ok: bool = True, max_attempts: int = 1,
+               expect: Optional[dict] = None) -> Optional[Tuple[dict, str]]:
+        """
+        站點回報完工，回傳（原本的工作, 結果），並釋放站點：
+        - 成功：running -> finished（結果 "finished"）
+        - 失敗：attempts+1；未達 max_attempts 退回 pending 重排（"retry"），否則標成 "error"
+        expect 帶事件裡的 order_id / piece_no / step_order；和站點目前的工作不符（已收回的舊工作）時忽略，回傳 None
+        """
+        with self.lock:
+            job = self._current_job(station, expect)
+            if job is None:
+                return None
+
+            outcome = "finished"
+            piece = self.pieces.get(job["order_id"], {}).get((job["piece_no"], job["step_order"]))
+            if piece is not None and piece[0] == "running":
+                if ok:
+                    piece[0] = "finished"
+                    piece[2] = at_ms
+                else:
+                    piece[3] += 1
+                    outcome = "error" if piece[3] >= max_attempts else "retry"
+                    piece[0] = "error" if outcome == "error" else "pending"
+                    piece[1] = None
+                self.dirty_pieces.add((job["order_id"], job["piece_no"], job["step_order"]))
+            self._release(station)
+            return job, outcome
+
+    def confirm_start(self, station: str, at_ms: int, expect: Optional[dict] = None) -> bool:
+        """站點回報實際開工時間（派工時先記的是派工時間）"""
+        with self.lock:
+            job = self._current_job(station, expect)
+            if job is None:
+                return False
+            piece = self.pieces.get(job["order_id"], {}).get((job["piece_no"], job["step_order"]))
+            if piece is None or piece[0] != "running":
+                return False
+            piece[1] = at_ms
+            self.dirty_pieces.add((job["order_id"], job["piece_no"], job["step_order"]))
+            self.version += 1
+            return True
+
+    def interrupt(self, station: str) -> Optional[dict]:
+        """站點停機：正在做的件退回 pending（不算失敗次數）並釋放站點，回傳被中斷的工作"""
+        with self.lock:
+            job = self.stations.get(station)
+            if not job:
+                return None
+            piece = self.pieces.get(job["order_id"], {}).get((job["piece_no"], job["step_order"]))
+            if piece is not None and piece[0] == "running":
+                piece[0] = "pending"
+                piece[1] = None
+                self.dirty_pieces.add((job["order_id"], job["piece_no"], job["step_order"]))
+            self._release(station)
+            return job
+
+    def retry_errors(self, order_id: str) -> List[Tuple[int, int]]:
+        """把這張訂單 error 的件退回 pending 並清除失敗次數，回傳 [(piece_no, step_order)]"""
+        out = []
+        with self.lock:
+            for (piece_no, step_no), p in self.pieces.get(order_id, {}).items():
+                if p[0] != "error":
+                    continue
+                p[0], p[1], p[3] = "pending", None, 0
+                self.dirty_pieces.add((order_id, piece_no, step_no))
+                out.append((piece_no, step_no))
+            if out:
+                self.version += 1
+        return out
+
+    def _current_job(self, station: str, expect: Optional[dict]) -> Optional[dict]:
+        job = self.stations.get(station)
+        if not job:
+            return None
+        if expect and any(expect.get(k) is not None and expect[k] != job[k] for k in ("order_id", "piece_no", "step_order")):
+            return None
+        return job
+
+    def _release(self, station: str) -> None:
+        self.stations[station] = None
+        self.dirty_stations.add(station)
+        self.version += 1
+
+    def idle_stations(self) -> List[str]:
+        with self.lock:
+            return sorted(st for st, job in self.stations.items() if job is None)
+
+    def jobs(self) -> Dict[str, dict]:
+        """station -> 目前的工作（只含忙碌中的站點）"""
+        with self.lock:
+            return {st: dict(job) for st, job in sorted(self.stations.items()) if job is not None}
+
+    def next_ready_piece(self, order_id: str, step_no: int, preds: tuple, piece_from: int, piece_to: int) -> Optional[int]:
+        """件號範圍內，此步驟中最小的「可開始」件號：自己是 pending，且所有前置步驟都已 finished"""
+        pieces = self.pieces.get(order_id)
+        if not pieces:
+            return None
+        for piece_no in range(piece_from, piece_to + 1):
+            p = pieces.get((piece_no, step_no))
+            if p is None or p[0] != "pending":
+                continue
+            if all((pieces.get((piece_no, q)) or ("",))[0] == "finished" for q in preds):
+                return piece_no
+        return None
+
+    def start(self, station: str, order_id: str, piece_no: int, step_no: int, now_ms: int, busy_until_ms: int) -> bool:
+        """
+        站點開始加工這件；站點已經不是閒置、或這件已經不是 pending（別的派工先做了）時不動作，回傳 False
+        """
+        with self.lock:
+            p = self.pieces.get(order_id, {}).get((piece_no, step_no))
+            if station not in self.stations or self.stations[station] is not None or p is None or p[0] != "pending":
+                return False
+            p[0] = "running"
+            if p[1] is None:
+                p[1] = now_ms
+            self.dirty_pieces.add((order_id, piece_no, step_no))
+            self.stations[station] = {
+                "order_id": order_id,
+                "piece_no": piece_no,
+                "step_order": step_no,
+                "busy_until_ms": busy_until_ms,
+            }
+            self.dirty_stations.add(station)
+            self.version += 1
+            return True
+
+    # ---------- 讀取（simulate / tick 用） ----------
+    def line_step_progress(self, order_id: str, lines: List[dict]) -> Dict[tuple, Dict[str, int]]:
+        """(line_no, step_order) -> {"done", "running", "error", "total"}"""
+        out: Dict[tuple, Dict[str, int]] = {}
+        with self.lock:
+            pieces = self.pieces.get(order_id, {})
+            for ln in lines:
+                for (piece_no, step_no), p in pieces.items():
+                    if not ln["piece_from"] <= piece_no <= ln["piece_to"]:
+                        continue
+                    agg = out.setdefault((ln["line_no"], step_no), {"done": 0, "running": 0, "error": 0, "total": 0})
+                    agg["total"] += 1
+                    if p[0] == "finished":
+                        agg["done"] += 1
+                    elif p[0] == "running":
+                        agg["running"] += 1
+                    elif p[0] == "error":
+                        agg["error"] += 1
+        return out
+
+    def line_pieces_done(self, order_id: str, lines: List[dict]) -> Dict[int, int]:
+        """line_no -> 所有步驟都完成的件數"""
+        with self.lock:
+            unfinished = {piece_no for (piece_no, _), p in self.pieces.get(order_id, {}).items() if p[0] != "finished"}
+            all_pieces = {piece_no for piece_no, _ in self.pieces.get(order_id, {})}
+        done = all_pieces - unfinished
+        return {
+            ln["line_no"]: sum(1 for n in done if ln["piece_from"] <= n <= ln["piece_to"])
+            for ln in lines
+        }
+
+    def remaining_work(self, order_id: str) -> Dict[int, int]:
+        """step_order -> 尚未完成（pending / running）的件數，ETA 估算用；error 的件要人工重試，不計入"""
+        out: Dict[int, int] = {}
+        with self.lock:
+            for (_, step_no), p in self.pieces.get(order_id, {}).items():
+                if p[0] in ("pending", "running"):
+                    out[step_no] = out.get(step_no, 0) + 1
+        return out
+
+    def error_pieces(self, order_id: str) -> List[Tuple[int, int, int]]:
+        """[(piece_no, step_order, attempts)]"""
+        with self.lock:
+            return sorted(
+                (piece_no, step_no, p[3])
+                for (piece_no, step_no), p in self.pieces.get(order_id, {}).items()
+                if p[0] == "error"
+            )
+
+    def is_completed(self, order_id: str) -> bool:
+        with self.lock:
+            pieces = self.pieces.get(order_id)
+            return bool(pieces) and all(p[0] == "finished" for p in pieces.values())
+
+    def state(self) -> dict:
+        """debug 用：站點占用與 running 的件"""
+        with self.lock:
+            return {
+                "stations": [
+                    {"station": st, **(job or {})}
+                    for st, job in sorted(self.stations.items())
+                ],
+                "running": [
+                    {"order_id": oid, "piece_no": piece_no, "step_order": step_no}
+                    for oid, pieces in sorted(self.pieces.items())
+                    for (piece_no, step_no), p in sorted(pieces.items())
+                    if p[0] == "running"
+                ],
+                "dirty": {"pieces": len(self.dirty_pieces), "stations": len(self.dirty_stations)},
+            }
+
+    # ---------- 寫回 DB ----------
+    def flush(self, order_db=None) -> int:
+        """
+        把 dirty 的列在一個 transaction 內寫回，回傳寫回筆數；失敗時保留 dirty 下次再寫。
+        寫回後順便把已經不是 active 的訂單（取消 / 退單 / 批次處理，可能是別的 process 改的）移出記憶體
+        """
+        with self.flush_lock:
+            own = order_db is None
+            if own:
+                order_db = get_order_mgmt_db()
+            try:
+                written = self._write_dirty(order_db)
+                self._drop_closed_orders(order_db)
+                return written
+            finally:
+                if own:
+                    order_db.close()
+
+    def _write_dirty(self, order_db) -> int:
+        with self.lock:
+            if not self.dirty_pieces and not self.dirty_stations:
+                return 0
+            piece_rows = []
+            for key in self.dirty_pieces:
+                p = self.pieces.get(key[0], {}).get((key[1], key[2]))
+                if p is None:
+                    continue
+                state, started_ms, finished_ms, attempts = p
+                piece_rows.append((
+                    state,
+                    fmt_ms(started_ms) if started_ms is not None else None, started_ms,
+                    fmt_ms(finished_ms) if finished_ms is not None else None, finished_ms,
+                    attempts,
+                    *key,
+                ))
+            now_str = fmt_ms(int(time.time() * 1000))
+            station_rows = []
+            for st in self.dirty_stations:
+                job = self.stations.get(st)
+                if job:
+                    station_rows.append((
+                        job["order_id"], job["piece_no"], job["step_order"],
+                        fmt_ms(job["busy_until_ms"]), job["busy_until_ms"], now_str, st,
+                    ))
+                else:
+                    station_rows.append((None, None, None, None, None, now_str, st))
+            dirty_pieces, dirty_stations = self.dirty_pieces, self.dirty_stations
+            self.dirty_pieces, self.dirty_stations = set(), set()
+
+        try:
+            order_db.executemany("""
+                UPDATE piece_step_progress
+                SET state=?, started_at=?, started_at_ms=?, finished_at=?, finished_at_ms=?, attempts=?
+                WHERE order_id=? AND piece_no=? AND step_order=?
+            """, piece_rows)
+            order_db.executemany("""
+                UPDATE station_state
+                SET current_order_id=?, current_piece_no=?, current_step_order=?,
+                    busy_until=?, busy_until_ms=?, updated_at=?
+                WHERE station=?
+            """, station_rows)
+            order_db.commit()
+        except Exception:
+            order_db.rollback()
+            with self.lock:
+                self.dirty_pieces |= dirty_pieces
+                self.dirty_stations |= dirty_stations
+            raise
+        return len(piece_rows) + len(station_rows)
+
+    def _drop_closed_orders(self, order_db) -> None:
+        """
+        記憶體裡不再 active 的訂單移除（呼叫端持有 flush_lock，重設訂單不會同時把它改回 active）；
+        站點還在做它的件、或還有沒寫回的變動時先留著，等下一次寫回
+        """
+        with self.lock:
+            loaded = list(self.pieces)
+        if not loaded:
+            return
+        placeholders = ",".join("?" * len(loaded))
+        active = {
+            r[0]
+            for r in order_db.execute(
+                f"SELECT order_id FROM order_list WHERE COALESCE(status, 'active')='active' AND order_id IN ({placeholders})",
+                loaded,
+            )
+        }
+        with self.lock:
+            busy = {k[0] for k in self.dirty_pieces} | {job["order_id"] for job in self.stations.values() if job}
+            closed = [oid for oid in loaded if oid not in active and oid not in busy and oid in self.pieces]
+            for oid in closed:
+                del self.pieces[oid]
+            if closed:
+                self.version += 1
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    log.exception("factory model flush failed")
+
+        self._flusher = threading.Thread(target=run, name="factory-model-flush", daemon=True)
+        self._flusher.start()
+
+
+factory_model = FactoryModel()
+
+
+def _flush_at_exit() -> None:
+    if factory_model.loaded:
+        try:
+            factory_model.flush()
+        except Exception:
+            log.exception("factory model flush at exit failed")
+
+
+atexit.register(_flush_at_exit)
+
+
+def init_factory_model(app) -> FactoryModel:
+    """依 app.config 設定寫回間隔"""
+    factory_model.flush_interval = float(app.config.get("FACTORY_FLUSH_INTERVAL_SEC", DEFAULT_FLUSH_INTERVAL_SEC))
+    return factory_model
@@ -2,17 +2,58 @@
 # 站點並行流水線：同時允許多個 step running（不同 station 同時加工不同件）
 # done/total：每一步顯示已完成件數 / 總件數（例如 1/6）
 # 強化：simulate 頁面載入時會自動 tick 一次（只針對這張訂單），避免前端 JS 沒打到 tick 而一直 0/5
+# 製程路線是 DAG（core/process_dag.py）：同一件的步驟只要前置步驟都完成就能開始，並行分支可同時在不同站點加工
+# 每個品項（order_items）有自己的路線與件號範圍；派工時各品項輪流使用站點，進度用 GROUP BY 一次彙總
+# 站點狀態改變時（派工 / 完工 / 新增待加工件）通知 core/floor_state.py，管理者看板不必每次查 SQL
+# 站點占用 / piece 狀態以 core/factory_model.py 的記憶體模型為準，定期批次寫回 DB（write-behind）
+# 站點停機（core/station_availability.py）：每次 tick 讀一次停機快照；停機中的站點不派工、正在做的件退回重排，
+# 派工時若加工期間會碰到排定的停機也先不派；完工可能失敗，超過 FACTORY_MAX_ATTEMPTS 次標成 error
+# 完工由站點驅動（core/station_drivers.py）回報：driver 執行緒推來 finish 事件就立刻更新狀態並為該訂單補派工，
+# 不必等下一次 tick；tick 仍會 poll 一次（模擬 driver 依 tick 的時鐘補發到點的完工）
+# 派工 / 完工 / 重排時同步更新 core/admission.py 的各站待做工作秒數（下單的產能控管用）
+# 模擬狀態可以整份快照 / 還原（core/sim_snapshot.py）；還原後記憶體模型、driver 工作與各種快取一起重建
+# 同一張訂單的 tick 經過 core/tick_gate.py 合併：同時進來的共用一次執行；狀態沒變、也還沒到下一個到點事件時直接回傳
+# FACTORY_SIM_ENGINE=worker / spawn 時模擬在獨立 process 跑（core/sim_worker.py，`flask factory sim-worker`）：
+# 網站的 API 把 init / reset / retry / 快轉 / 快照轉成命令送過去，tick 只送通知不等結果；
+# simulate 頁面讀引擎發布的畫面資料快取，網站 process 不載入記憶體模型、也不接 driver
 
 from __future__ import annotations
 
+import json
+import logging
 import os
+import signal
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
+import click
 from flask import Blueprint, render_template, session, current_app, request, abort, jsonify
+from werkzeug.exceptions import HTTPException
 
 from . import login_required
+from .admission import admission
+from .batch_sim import DEFAULT_BUCKET_HOURS, DEFAULT_DUE_HOURS, SimOrder, override_times, run_batch, synthesize_orders
+from .capacity_plan import invalidate as invalidate_plan
+from .factory_metrics import bump_generation as bump_metrics_generation, invalidate as invalidate_metrics
+from .dispatch import dispatch_order
+from .factory_model import factory_model
+from .floor_state import floor
+from .inventory import ensure_inventory_schema
+from .order_routes import ensure_order_items_schema, ensure_order_list_schema
+from .process_dag import Route, critical_path_sec, load_route, parse_stages, topo_order
+from .process_templates import StepDef, current_version, ensure_process_template_schema, get_step_defs
+from .station_availability import Availability, ensure_downtime_schema, load_availability
+from .sim_snapshot import default_name, list_snapshots, restore_snapshot, save_snapshot, snapshot_dir, snapshot_path
+from .sim_worker import (
+    DEFAULT_TIMEOUT_SEC, SimWorkerError, SimWorkerServer, SimWorkerUnavailable, get_sim_client, mark_serving, socket_path,
+)
+from .station_drivers import DEFAULT_SOCKET_HOST, DEFAULT_SOCKET_PORT, get_station_driver, run_standin
+from .tick_gate import TickGate
+from .timeutil import advance_clock, ensure_ms_columns, ensure_sim_clock_schema, fmt_ms, from_ms, now_ms, reload_clock, to_ms
 
 factory_bp = Blueprint("factory", __name__, url_prefix="/factory")
 
@@ -20,6 +61,31 @@ factory_bp = Blueprint("factory", __name__, url_prefix="/factory")
 _ORDER_DB_FILENAME = "order_management.db"
 _PRODUCT_DB_FILENAME = "product.db"
 _COMPLETE_STATUS = "completed"
+# 每個 piece-step 最多嘗試次數；可用 app.config 覆蓋
+DEFAULT_MAX_ATTEMPTS = 3
+
+# 快轉一次最多幾秒（7 天）
+MAX_FAST_FORWARD_SEC = 7 * 24 * 60 * 60
+# 模擬引擎多久檢查一次到點事件 / 發布畫面資料；simulate 頁面多久沒看就不再發布那張訂單
+SIM_PUBLISH_INTERVAL_SEC = 0.25
+SIM_WATCH_TTL_SEC = 60
+# 跑很久、不排進引擎命令佇列的命令（另外開執行緒，逾時也放寬）
+SIM_SLOW_COMMANDS = ("fast_forward",)
+SIM_SLOW_TIMEOUT_SEC = 600
+
+log = logging.getLogger(__name__)
+
+# tick 合併：狀態版本用記憶體模型的 version
+tick_gate = TickGate(lambda: factory_model.version)
+
+# 模擬狀態鎖：完工套用 + 派工是對共用站點狀態的「讀取閒置站點 → 挑件 → start」，同一時間只能有一個在跑。
+# request 的 tick、driver 執行緒的事件、reset / retry / 還原快照、快轉的每一輪，
+# 以及引擎的命令 / 主迴圈（含發布狀態）都要拿這把鎖；可重入，事件 handler 內還會再 tick
+_sim_lock = threading.RLock()
+
+# 同一時間只允許一個快轉
+_fast_forward_lock = threading.Lock()
+
 
 
 # -------------------------
@@ -36,25 +102,77 @@ def _conn(path: str) -> sqlite3.Connection:
 
 
 def _now() -> datetime:
-    return datetime.now()
+    """模擬時鐘（含快轉的時鐘差，見 core/timeutil.py）"""
+    return from_ms(now_ms())
 
 
-def _fmt(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+def _parse_step_chain(s: str) -> List[int]:
+    """路線字串內的所有步驟（"1 -> 4 | 5 -> 9" → [1, 4, 5, 9]）"""
+    return [step_no for stage in parse_stages(s) for step_no in stage]
 
 
-def _parse_step_chain(s: str) -> List[int]:
-    if not s:
-        return []
-    out: List[int] = []
-    for part in s.split("->"):
-        part = part.strip()
-        if part.isdigit():
-            out.append(int(part))
-    return out
+def _order_route(o) -> Route:
+    """訂單的製程路線：step_deps（前置步驟集合）優先，舊訂單由 step_name 推得線性路線"""
+    return load_route(o["step_name"], o["step_deps"])
+
+
+# -------------------------
+# 模擬引擎 client（FACTORY_SIM_ENGINE=worker / spawn）
+# -------------------------
+# order_id -> 引擎發布的 simulate 頁面資料（見 _simulate_view）
+_sim_views: Dict[str, dict] = {}
+
+
+def _on_sim_event(event: dict) -> None:
+    """
+    client 讀取執行緒呼叫：狀態版本變了（狀態變動都發生在引擎）就讓看板 / 產能控管下次從 DB 重建，
+    畫面資料快取直接用發布的內容更新
+    """
+    kind = event.get("event")
+    if kind in ("connected", "disconnected", "version"):
+        floor.invalidate()
+        admission.invalidate()
+        if kind != "version":
+            _sim_views.clear()
+        return
+    if kind != "views":
+        return
+    _sim_views.update(event.get("views") or {})
+    for order_id in event.get("dropped") or ():
+        _sim_views.pop(order_id, None)
+
+
+def _sim_client():
+    """模擬交給獨立 process 時回傳 client；inline 模式或本 process 就是引擎時回傳 None"""
+    return get_sim_client(current_app, _on_sim_event)
+
+
+def _sim_call(client, cmd: str, timeout: float = DEFAULT_TIMEOUT_SEC, **args) -> dict:
+    """送命令給引擎並等結果；引擎回報的錯誤照原狀態碼 abort，連不上回 503"""
+    try:
+        return client.call(cmd, timeout, **args)
+    except SimWorkerError as e:
+        abort(e.status, e.message)
+    except SimWorkerUnavailable as e:
+        abort(503, str(e))
+
+
+def invalidate_ticks() -> None:
+    """tick 結果快取失效（停機時段異動時）；模擬在引擎時一併通知引擎"""
+    tick_gate.invalidate()
+    client = _sim_client()
+    if client is not None:
+        try:
+            client.notify("invalidate")
+        except SimWorkerUnavailable:
+            log.warning("sim worker unavailable; tick cache not invalidated")
 
 
 def _ensure_tables(order_db: sqlite3.Connection) -> None:
+    # 0) order_list 補欄位（process_version 等）、訂單明細 order_items
+    ensure_order_list_schema(order_db)
+    ensure_order_items_schema(order_db)
+
     # 1) piece_step_progress（若不存在就建立）
     order_db.execute("""
         CREATE TABLE IF NOT EXISTS piece_step_progress (
@@ -99,154 +217,233 @@ def _ensure_tables(order_db: sqlite3.Connection) -> None:
     if "updated_at" not in cols:
         add_col("ALTER TABLE station_state ADD COLUMN updated_at TEXT;")
 
-    order_db.commit()
+    # 4) 整數 epoch 毫秒欄位（見 core/timeutil.py）：到點判斷 / 區間查詢走索引，不解析字串
+    if ensure_ms_columns(order_db, "station_state", {"busy_until": "busy_until_ms"}):
+        order_db.execute("CREATE INDEX IF NOT EXISTS idx_station_state_busy_until_ms ON station_state(busy_until_ms);")
+    if ensure_ms_columns(order_db, "piece_step_progress", {"started_at": "started_at_ms", "finished_at": "finished_at_ms"}):
+        order_db.execute("CREATE INDEX IF NOT EXISTS idx_psp_started_at_ms ON piece_step_progress(started_at_ms);")
+        order_db.execute("CREATE INDEX IF NOT EXISTS idx_psp_finished_at_ms ON piece_step_progress(finished_at_ms);")
 
+    # 5) 失敗重試次數 + 站點停機時段 + 模擬時鐘（快轉的時鐘差，見 core/timeutil.py）
+    psp_cols = {r["name"] for r in order_db.execute("PRAGMA table_info(piece_step_progress)").fetchall()}
+    if "attempts" not in psp_cols:
+        add_col("ALTER TABLE piece_step_progress ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;")
+    ensure_downtime_schema(order_db)
+    ensure_sim_clock_schema(order_db)
 
-def _ensure_station_rows(order_db: sqlite3.Connection, product_db: sqlite3.Connection) -> None:
-    rows = product_db.execute("""
-        SELECT DISTINCT station
-        FROM standard_process
-        WHERE station IS NOT NULL AND TRIM(station) <> ''
-        ORDER BY station
-    """).fetchall()
-    for r in rows:
-        order_db.execute("INSERT OR IGNORE INTO station_state(station) VALUES (?)", (r["station"],))
     order_db.commit()
 
-
-def _get_est_sec(product_db: sqlite3.Connection, step_order: int) -> int:
-    r = product_db.execute("""
-        SELECT estimated_time_sec
-        FROM standard_process
-        WHERE step_order=?
-    """, (step_order,)).fetchone()
-    if not r:
-        return 5
-    try:
-        return int(r["estimated_time_sec"] or 5)
-    except Exception:
-        return 5
-
-
-def _get_step_station_map(product_db: sqlite3.Connection) -> Dict[int, str]:
-    rows = product_db.execute("""
-        SELECT step_order, station
-        FROM standard_process
-    """).fetchall()
-    mp: Dict[int, str] = {}
-    for r in rows:
-        mp[int(r["step_order"])] = (r["station"] or "").strip()
-    return mp
-
-
-def _get_step_defs(product_db: sqlite3.Connection, chain: List[int]) -> List[dict]:
-    placeholders = ",".join(["?"] * len(chain))
-    rows = product_db.execute(f"""
-        SELECT step_order, step_name, station, description, estimated_time_sec
-        FROM standard_process
-        WHERE step_order IN ({placeholders})
-    """, chain).fetchall()
-
-    by_no = {int(r["step_order"]): dict(r) for r in rows}
-    return [by_no[n] for n in chain if n in by_no]
-
-
-def _ensure_piece_rows(order_db: sqlite3.Connection, order_id: str, chain: List[int], amount: int) -> None:
-    amount = max(1, int(amount or 1))
-    for piece_no in range(1, amount + 1):
-        for step_no in chain:
-            order_db.execute("""
-                INSERT OR IGNORE INTO piece_step_progress(order_id, piece_no, step_order, state)
-                VALUES (?, ?, ?, 'pending')
-            """, (order_id, piece_no, step_no))
+    # 6) 第一次使用時由 DB 重建記憶體模型（含 crash 後的狀態修正），並把站點事件接到排程器
+    #    模擬交給獨立 process 時由引擎負責，網站 process 不載入
+    if _sim_client() is None:
+        factory_model.ensure_loaded(order_db)
+        _ensure_driver()
+
+
+def _ensure_driver() -> None:
+    """第一次使用時註冊站點事件 handler，並把重建出來的進行中工作交給 driver 計時 / 追蹤"""
+    driver = get_station_driver()
+    if driver.bound:
+        return
+    driver.bind(_make_event_handler(current_app._get_current_object()))
+    for station, job in factory_model.jobs().items():
+        driver.start_job(station, job)
+
+
+def _ensure_station_rows(order_db: sqlite3.Connection, step_defs: Dict[int, StepDef]) -> None:
+    stations = sorted({d.station for d in step_defs.values() if d.station})
+    # 記憶體模型已經有這些站點 → DB 也已經有，不必每次 tick 都開寫入 transaction
+    if factory_model.has_stations(stations):
+        return
+    order_db.executemany(
+        "INSERT OR IGNORE INTO station_state(station) VALUES (?)",
+        [(st,) for st in stations],
+    )
     order_db.commit()
+    factory_model.ensure_stations(stations)
 
 
-def _piece_is_running(order_db: sqlite3.Connection, order_id: str, piece_no: int) -> bool:
-    r = order_db.execute("""
-        SELECT 1
-        FROM piece_step_progress
-        WHERE order_id=? AND piece_no=? AND state='running'
-        LIMIT 1
-    """, (order_id, piece_no)).fetchone()
-    return r is not None
-
-
-def _prev_step(chain: List[int], step_no: int) -> Optional[int]:
-    if step_no not in chain:
-        return None
-    idx = chain.index(step_no)
-    if idx == 0:
-        return None
-    return chain[idx - 1]
+def _order_step_defs(product_db: sqlite3.Connection, order_row) -> Dict[int, StepDef]:
+    """
+    訂單下單時固定的製程模板版本 → 步驟定義（step_order -> StepDef）。
+    版本內容不會變，get_step_defs 會永久快取，不必每次 tick 查 standard_process。
+    """
+    ensure_process_template_schema(product_db)
+    return get_step_defs(product_db, order_row["process_version"])
 
 
-def _is_order_completed(order_db: sqlite3.Connection, order_id: str, last_step: int, amount: int) -> bool:
-    r = order_db.execute("""
-        SELECT COUNT(*) AS c
-        FROM piece_step_progress
-        WHERE order_id=? AND step_order=? AND state='finished'
-    """, (order_id, last_step)).fetchone()
-    return int(r["c"] or 0) >= max(1, int(amount or 1))
+def _order_lines(order_db: sqlite3.Connection, o) -> List[dict]:
+    """
+    訂單的各品項：件號範圍 + 製程路線。
+    舊訂單沒有 order_items → 視為一個品項，涵蓋 1~amount 件、使用訂單層級的路線。
+    """
+    rows = order_db.execute("""
+        SELECT line_no, product_name, quantity, piece_from, piece_to, step_name, step_deps
+        FROM order_items
+        WHERE order_id=?
+        ORDER BY line_no
+    """, (o["order_id"],)).fetchall()
+    if rows:
+        return [
+            {
+                "line_no": int(r["line_no"]),
+                "product_name": r["product_name"] or "",
+                "quantity": int(r["quantity"]),
+                "piece_from": int(r["piece_from"]),
+                "piece_to": int(r["piece_to"]),
+                "step_name": r["step_name"] or "",
+                "route": load_route(r["step_name"], r["step_deps"]),
+            }
+            for r in rows
+        ]
 
+    try:
+        amount = max(1, int(o["amount"] or 1))
+    except Exception:
+        amount = 1
+    return [{
+        "line_no": 1,
+        "product_name": o["product"] or "",
+        "quantity": amount,
+        "piece_from": 1,
+        "piece_to": amount,
+        "step_name": o["step_name"] or "",
+        "route": _order_route(o),
+    }]
+
+
+def _lines_chain(lines: List[dict]) -> List[int]:
+    """所有品項用到的步驟（依各品項的拓撲順序合併、去重）"""
+    return list(dict.fromkeys(step_no for ln in lines for step_no in topo_order(ln["route"])))
+
+
+def _ensure_piece_rows(
+    order_db: sqlite3.Connection,
+    order_id: str,
+    lines: List[dict],
+    step_defs: Dict[int, StepDef],
+) -> None:
+    """每個品項只建立自己件號範圍 × 自己路線的步驟；實際新增的件數依站點通知看板"""
+    by_station: Dict[str, List[tuple]] = {}
+    for ln in lines:
+        for step_no in ln["route"]:
+            d = step_defs.get(step_no)
+            rows = by_station.setdefault(d.station if d else "", [])
+            rows.extend((order_id, piece_no, step_no) for piece_no in range(ln["piece_from"], ln["piece_to"] + 1))
+
+    added: Dict[str, int] = {}
+    for station, rows in by_station.items():
+        cur = order_db.executemany(
+            """
+            INSERT OR IGNORE INTO piece_step_progress(order_id, piece_no, step_order, state)
+            VALUES (?, ?, ?, 'pending')
+            """,
+            rows,
+        )
+        if station and cur.rowcount > 0:
+            added[station] = cur.rowcount
+    order_db.commit()
+    floor.pieces_queued(order_id, added)
 
-def _complete_due_jobs(order_db: sqlite3.Connection) -> None:
-    """把 busy_until 到點的 station 完成當前工作（running -> finished），並釋放 station。"""
-    now = _now()
 
-    running_stations = order_db.execute("""
-        SELECT station, current_order_id, current_piece_no, current_step_order, busy_until
-        FROM station_state
-        WHERE current_order_id IS NOT NULL AND busy_until IS NOT NULL
-    """).fetchall()
+def _load_order_pieces(
+    order_db: sqlite3.Connection,
+    order_id: str,
+    lines: List[dict],
+    step_defs: Dict[int, StepDef],
+) -> None:
+    """訂單第一次被派工 / 檢視時建立 piece rows 並載入記憶體模型，之後都讀記憶體"""
+    if factory_model.has_order(order_id):
+        return
+    _ensure_piece_rows(order_db, order_id, lines, step_defs)
+    factory_model.load_order(order_db, order_id)
 
-    for ss in running_stations:
-        try:
-            end_dt = datetime.fromisoformat(str(ss["busy_until"]))
-        except Exception:
-            continue
-        if now < end_dt:
-            continue
 
-        order_id = str(ss["current_order_id"])
-        piece_no = int(ss["current_piece_no"])
-        step_no = int(ss["current_step_order"])
+def _availability(order_db: sqlite3.Connection) -> Availability:
+    """這次 tick 的停機快照（每次 tick 只查這一次）"""
+    return load_availability(order_db, to_ms(_now()))
 
-        order_db.execute("""
-            UPDATE piece_step_progress
-            SET state='finished', finished_at=?
-            WHERE order_id=? AND piece_no=? AND step_order=? AND state='running'
-        """, (_fmt(now), order_id, piece_no, step_no))
 
-        order_db.execute("""
-            UPDATE station_state
-            SET current_order_id=NULL, current_piece_no=NULL, current_step_order=NULL, busy_until=NULL, updated_at=?
-            WHERE station=?
-        """, (_fmt(now), ss["station"]))
+def _apply_station_event(event: dict) -> Optional[str]:
+    """
+    站點事件套用到記憶體模型（start：更新開工時間；finish：完工 / 失敗重排 / error，並釋放站點）。
+    回傳需要補派工的 order_id；過期事件（站點已收回或換了工作）回傳 None。
+    """
+    station = event["station"]
+    at_ms = int(event.get("at_ms") or to_ms(_now()))
+    if event["type"] == "start":
+        factory_model.confirm_start(station, at_ms, expect=event)
+        return None
 
-    order_db.commit()
+    result = factory_model.finish(
+        station,
+        at_ms,
+        ok=bool(event.get("ok", True)),
+        max_attempts=int(current_app.config.get("FACTORY_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        expect=event,
+    )
+    if result is None:
+        return None
+    job, outcome = result
+    floor.station_idle(station)
+    admission.work_finished(station, requeue=outcome == "retry")
+    if outcome == "retry":
+        floor.pieces_queued(job["order_id"], {station: 1})
+    return job["order_id"]
+
+
+def _make_event_handler(app):
+    """driver 執行緒呼叫：套用事件後馬上為同一張訂單跑一次 tick（派下一件 / 判斷訂單完成）；整段持有模擬狀態鎖"""
+    def handle(event: dict) -> None:
+        with app.app_context(), _sim_lock:
+            order_id = _apply_station_event(event)
+            if not order_id:
+                return
+            order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+            product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+            try:
+                _tick_once_for_order(order_db, product_db, order_id)
+            finally:
+                order_db.close()
+                product_db.close()
+    return handle
 
 
-def _dispatch_for_focus_order(order_db: sqlite3.Connection, product_db: sqlite3.Connection, focus_order_id: str) -> List[dict]:
+def _complete_due_jobs(order_db: sqlite3.Connection, avail: Availability) -> None:
+    """
+    1) 停機中的站點：正在做的件退回 pending、收回 driver 的工作並釋放站點
+    2) driver 已到點的完工事件（模擬 driver 依這次 tick 的時鐘判斷）
+    只改記憶體，定期寫回。
+    """
+    driver = get_station_driver()
+    for station, job in factory_model.jobs().items():
+        if avail.is_down(station):
+            factory_model.interrupt(station)
+            driver.cancel_job(station)
+            admission.work_finished(station, requeue=True)
+            floor.station_idle(station)
+            floor.pieces_queued(job["order_id"], {station: 1})
+
+    for event in driver.poll(avail.now_ms):
+        _apply_station_event(event)
+
+
+def _dispatch_for_focus_order(
+    order_db: sqlite3.Connection,
+    product_db: sqlite3.Connection,
+    focus_order_id: str,
+    avail: Availability,
+) -> List[dict]:
     """
     只針對 focus_order_id 派工（避免你只有一單但前端 tick 沒打到/或之後多單時派錯單）。
+    選件規則在 core/dispatch.py（批次模擬共用）；這裡負責讀訂單、交給 driver、通知看板 / 產能控管。
     回傳 dispatched list。
     """
-    now = _now()
-    step_station = _get_step_station_map(product_db)
-
-    # station -> step_orders
-    station_steps: Dict[str, List[int]] = {}
-    for step_no, st in step_station.items():
-        if not st:
-            continue
-        station_steps.setdefault(st, []).append(step_no)
-    for st in station_steps:
-        station_steps[st].sort()
+    now_ms = to_ms(_now())
 
     # 讀這張訂單
     o = order_db.execute("""
-        SELECT order_id, step_name, amount, status
+        SELECT order_id, product, step_name, step_deps, amount, status, process_version
         FROM order_list
         WHERE status='active' AND order_id=?
         LIMIT 1
@@ -254,97 +451,28 @@ def _dispatch_for_focus_order(order_db: sqlite3.Connection, product_db: sqlite3.
     if not o:
         return []
 
-    chain = _parse_step_chain(o["step_name"] or "")
-    if not chain:
-        return []
+    # 步驟定義用訂單固定的模板版本（記憶體快取）
+    step_defs = _order_step_defs(product_db, o)
 
-    try:
-        amount = max(1, int(o["amount"] or 1))
-    except Exception:
-        amount = 1
-
-    _ensure_piece_rows(order_db, focus_order_id, chain, amount)
+    lines = [ln for ln in _order_lines(order_db, o) if ln["route"]]
+    if not lines:
+        return []
 
-    # idle stations
-    idle = order_db.execute("""
-        SELECT station
-        FROM station_state
-        WHERE current_order_id IS NULL
-        ORDER BY station
-    """).fetchall()
+    _load_order_pieces(order_db, focus_order_id, lines, step_defs)
 
     dispatched: List[dict] = []
-
-    for st_row in idle:
-        station = str(st_row["station"])
-        step_list = station_steps.get(station, [])
-        if not step_list:
-            continue
-
-        best_job = None  # (piece_no, step_no, est)
-
-        for step_no in step_list:
-            if step_no not in chain:
-                continue
-            prev = _prev_step(chain, step_no)
-
-            cand = order_db.execute("""
-                SELECT piece_no
-                FROM piece_step_progress
-                WHERE order_id=? AND step_order=? AND state='pending'
-                ORDER BY piece_no ASC
-            """, (focus_order_id, step_no)).fetchall()
-
-            for r in cand:
-                piece_no = int(r["piece_no"])
-
-                # 同一件不允許同時跑兩個 step
-                if _piece_is_running(order_db, focus_order_id, piece_no):
-                    continue
-
-                # 前一步要 finished 才能進入此步（第一步除外）
-                if prev is None:
-                    ok = True
-                else:
-                    pr = order_db.execute("""
-                        SELECT state
-                        FROM piece_step_progress
-                        WHERE order_id=? AND piece_no=? AND step_order=?
-                    """, (focus_order_id, piece_no, prev)).fetchone()
-                    ok = (pr is not None and pr["state"] == "finished")
-
-                if not ok:
-                    continue
-
-                est = _get_est_sec(product_db, step_no)
-                best_job = (piece_no, step_no, est)
-                break
-
-            if best_job:
-                break
-
-        if not best_job:
-            continue
-
-        piece_no, step_no, est = best_job
-
-        # pending -> running
-        order_db.execute("""
-            UPDATE piece_step_progress
-            SET state='running', started_at=COALESCE(started_at, ?)
-            WHERE order_id=? AND piece_no=? AND step_order=? AND state='pending'
-        """, (_fmt(now), focus_order_id, piece_no, step_no))
-
-        end_time = now + timedelta(seconds=int(est))
-
-        # station 占用
-        order_db.execute("""
-            UPDATE station_state
-            SET current_order_id=?, current_piece_no=?, current_step_order=?, busy_until=?, updated_at=?
-            WHERE station=?
-        """, (focus_order_id, piece_no, step_no, end_time.isoformat(sep=" "), _fmt(now), station))
-
-        order_db.commit()
+    for station, piece_no, step_no, busy_until_ms in dispatch_order(
+        factory_model, focus_order_id, lines, step_defs, avail, now_ms
+    ):
+        end_time = from_ms(busy_until_ms)
+        get_station_driver().start_job(station, {
+            "order_id": focus_order_id,
+            "piece_no": piece_no,
+            "step_order": step_no,
+            "busy_until_ms": busy_until_ms,
+        })
+        admission.work_started(station, focus_order_id, float(step_defs[step_no].estimated_time_sec), busy_until_ms)
+        floor.station_busy(station, focus_order_id, piece_no, step_no, end_time)
 
         dispatched.append({
             "station": station,
@@ -357,29 +485,75 @@ def _dispatch_for_focus_order(order_db: sqlite3.Connection, product_db: sqlite3.
     return dispatched
 
 
-def _tick_once_for_order(order_db: sqlite3.Connection, product_db: sqlite3.Connection, focus_order_id: str) -> List[dict]:
+def _order_eta_ms(order_id: str, step_defs: Dict[int, StepDef], avail: Availability) -> Optional[int]:
+    """
+    預計完成時間（瓶頸站估算）：各站把這張訂單剩下的件做完所需的加工時間，
+    從現在開始累積、跳過停機時段，取最晚完成的站點。error 的件要人工重試，不計入。
+    """
+    work_ms: Dict[str, int] = {}
+    for step_no, count in factory_model.remaining_work(order_id).items():
+        d = step_defs.get(step_no)
+        if d and d.station:
+            work_ms[d.station] = work_ms.get(d.station, 0) + count * int(d.estimated_time_sec) * 1000
+    if not work_ms:
+        return None
+    return max(avail.finish_after(station, avail.now_ms, ms) for station, ms in work_ms.items())
+
+
+def _next_due_ms(avail: Availability) -> Optional[int]:
+    """下一個會改變派工結果的時間點：最早的完工時間、停機開始或結束；都沒有時回傳 None"""
+    due = [job["busy_until_ms"] for job in factory_model.jobs().values()]
+    due += [t for windows in avail.windows.values() for span in windows for t in span if t > avail.now_ms]
+    return min(due, default=None)
+
+
+def _tick_coalesced(
+    order_db: sqlite3.Connection,
+    product_db: sqlite3.Connection,
+    focus_order_id: str,
+    avail: Availability,
+) -> Tuple[List[dict], str]:
+    """經過 tick_gate 跑 _tick_once_for_order，回傳（dispatched, 來源 run / shared / idle）"""
+    def run():
+        dispatched = _tick_once_for_order(order_db, product_db, focus_order_id, avail)
+        # 和 api_tick 同一個 key，結果格式也要一樣（彼此會共用）
+        return {"ok": True, "order_id": focus_order_id, "dispatched": dispatched}, _next_due_ms(avail)
+
+    result, source = tick_gate.run(focus_order_id, avail.now_ms, run)
+    return result["dispatched"], source
+
+
+def _tick_once_for_order(
+    order_db: sqlite3.Connection,
+    product_db: sqlite3.Connection,
+    focus_order_id: str,
+    avail: Optional[Availability] = None,
+) -> List[dict]:
     """
     一次 tick：
-    1) 完成到點的 station
+    0) 讀一次停機快照（呼叫端已經讀過就直接用）
+    1) 停機站點中斷、完成到點的 station
     2) 只針對 focus_order_id 派工
     3) 若訂單最後一步全 finished -> 改 status=completed
     """
-    _complete_due_jobs(order_db)
+    if avail is None:
+        avail = _availability(order_db)
 
-    dispatched = _dispatch_for_focus_order(order_db, product_db, focus_order_id)
+    # 不同訂單的 tick 也共用站點狀態：完工 + 派工 + 完成判斷整段持有模擬狀態鎖（tick_gate 只合併同一張訂單的回應）
+    with _sim_lock:
+        _complete_due_jobs(order_db, avail)
 
-    # 檢查是否完成整張訂單
-    o = order_db.execute("SELECT step_name, amount FROM order_list WHERE order_id=?", (focus_order_id,)).fetchone()
-    if o:
-        chain = _parse_step_chain(o["step_name"] or "")
-        if chain:
-            try:
-                amount = max(1, int(o["amount"] or 1))
-            except Exception:
-                amount = 1
-            if _is_order_completed(order_db, focus_order_id, chain[-1], amount):
-                order_db.execute("UPDATE order_list SET status=? WHERE order_id=?", (_COMPLETE_STATUS, focus_order_id))
-                order_db.commit()
+        dispatched = _dispatch_for_focus_order(order_db, product_db, focus_order_id, avail)
+
+        # 檢查是否完成整張訂單（所有件的所有步驟都 finished）；完成時先把進度寫回，再改訂單狀態
+        if factory_model.is_completed(focus_order_id):
+            factory_model.flush(order_db)
+            order_db.execute("UPDATE order_list SET status=? WHERE order_id=?", (_COMPLETE_STATUS, focus_order_id))
+            order_db.commit()
+            factory_model.unload_order(focus_order_id)
+            floor.order_closed(focus_order_id)
+            admission.order_closed(focus_order_id)
+            invalidate_plan()
 
     return dispatched
 
@@ -387,6 +561,119 @@ def _tick_once_for_order(order_db: sqlite3.Connection, product_db: sqlite3.Conne
 # -------------------------
 # page: simulate
 # -------------------------
+def _simulate_view(
+    order_db: sqlite3.Connection,
+    product_db: sqlite3.Connection,
+    order_id: str,
+    viewer: Optional[str] = None,
+    tick: bool = True,
+) -> dict:
+    """
+    simulate 頁面的資料：{"customer_name", "order_info", "steps", "items"}（可 JSON 化，引擎發布的也是這份）。
+    viewer 不是 None 時只允許該帳號看自己的訂單；tick=True 時先替這張訂單 tick 一次。
+    """
+    _ensure_tables(order_db)
+
+    o = order_db.execute("""
+        SELECT order_id, customer_name, product, step_name, step_deps, note, status, amount, process_version
+        FROM order_list
+        WHERE order_id=?
+    """, (order_id,)).fetchone()
+    if not o:
+        abort(404, "order not found")
+
+    step_defs = _order_step_defs(product_db, o)
+    _ensure_station_rows(order_db, step_defs)
+
+    # ✅ 權限：非 admin 只能看自己的訂單（避免改網址偷看）
+    if viewer is not None and ((not viewer) or ((o["customer_name"] or "") != viewer)):
+        abort(403)
+
+    lines = [ln for ln in _order_lines(order_db, o) if ln["route"]]
+    chain = _lines_chain(lines)
+    if not chain:
+        abort(400, "this order has empty step_name (step chain)")
+
+    amount = sum(ln["quantity"] for ln in lines)
+
+    _load_order_pieces(order_db, order_id, lines, step_defs)
+
+    # ⭐ 不靠前端：頁面載入先自動 tick 一次，保證至少 Step1 會開始跑（停機快照和 ETA 共用）
+    avail = _availability(order_db)
+    if tick:
+        _tick_coalesced(order_db, product_db, order_id, avail)
+
+    # 聚合：品項 × 步驟的 done / running / total（讀記憶體模型），再彙總到整張訂單
+    progress = factory_model.line_step_progress(order_id, lines)
+    pieces_done = factory_model.line_pieces_done(order_id, lines)
+
+    steps = []
+    for step_no in chain:
+        if step_no not in step_defs:
+            continue
+        agg = {"done": 0, "running": 0, "error": 0, "total": 0}
+        preds = set()
+        for ln in lines:
+            if step_no in ln["route"]:
+                preds.update(ln["route"][step_no])
+                for k, v in progress.get((ln["line_no"], step_no), {}).items():
+                    agg[k] += v
+
+        s = dict(step_defs[step_no]._asdict(), preds=sorted(preds))
+        s["done_qty"] = agg["done"]
+        s["total_qty"] = agg["total"]
+        s["error_qty"] = agg["error"]
+        s["station_down_until"] = (
+            fmt_ms(avail.down_until(s["station"], avail.now_ms)) if s.get("station") and avail.is_down(s["station"]) else ""
+        )
+
+        if agg["total"] and agg["done"] >= agg["total"]:
+            s["state"] = "finished"
+        elif agg["running"] > 0:
+            s["state"] = "running"
+        else:
+            s["state"] = "pending"
+        steps.append(s)
+
+    items = [
+        {
+            "line_no": ln["line_no"],
+            "product_name": ln["product_name"],
+            "quantity": ln["quantity"],
+            "piece_from": ln["piece_from"],
+            "piece_to": ln["piece_to"],
+            "route": ln["step_name"],
+            "done_qty": pieces_done.get(ln["line_no"], 0),
+        }
+        for ln in lines
+    ]
+
+    # tick 可能剛把訂單改成 completed
+    status = order_db.execute("SELECT status FROM order_list WHERE order_id=?", (order_id,)).fetchone()["status"]
+    order_info = {
+        "order_id": o["order_id"],
+        "note": o["note"] or "無備註",
+        "status": (status or "").lower(),
+        "amount": amount,
+        "route": o["step_name"] or "",
+        # 單件最短完成時間：並行分支只算最慢的那條（各品項取最長）
+        "lead_time_sec": max(
+            critical_path_sec(ln["route"], {n: d.estimated_time_sec for n, d in step_defs.items()})
+            for ln in lines
+        ),
+        "eta": fmt_ms(_order_eta_ms(order_id, step_defs, avail)),
+        "error_count": sum(s["error_qty"] for s in steps),
+    }
+    return {"customer_name": o["customer_name"] or "", "order_info": order_info, "steps": steps, "items": items}
+
+
+def _viewer() -> Optional[str]:
+    """admin 看得到所有訂單（None）；其他人只能看自己帳號的訂單"""
+    if session.get("role") == "admin":
+        return None
+    return session.get("account") or session.get("username") or session.get("full_name") or ""
+
+
 @factory_bp.route("/simulate")
 @login_required
 def simulate():
@@ -394,146 +681,427 @@ def simulate():
     if not order_id:
         abort(400, "need ?order_id=...")
 
+    viewer = _viewer()
+    client = _sim_client()
+    if client is not None:
+        # 模擬在引擎：讀發布的快取（第一次看這張訂單才等引擎回覆），再送 tick 通知讓它繼續跑
+        view = _sim_views.get(order_id)
+        if view is None:
+            view = _sim_views[order_id] = _sim_call(client, "view", order_id=order_id)
+        if viewer is not None and ((not viewer) or view["customer_name"] != viewer):
+            abort(403)
+        try:
+            client.notify("tick", order_id=order_id)
+        except SimWorkerUnavailable as e:
+            abort(503, str(e))
+    else:
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            view = _simulate_view(order_db, product_db, order_id, viewer)
+        finally:
+            order_db.close()
+            product_db.close()
+
+    order_info = dict(
+        view["order_info"],
+        user_name=view["customer_name"] or (session.get("account") or session.get("full_name") or session.get("username", "Demo User")),
+    )
+    return render_template("factory/simulate.html", order_info=order_info, steps=view["steps"], items=view["items"])
+
+
+# -------------------------
+# API: init / reset / tick (GET/POST 都可)
+# -------------------------
+def _init_order(order_db: sqlite3.Connection, product_db: sqlite3.Connection, order_id: str) -> dict:
+    _ensure_tables(order_db)
+
+    o = order_db.execute("""
+        SELECT order_id, product, step_name, step_deps, amount, process_version
+        FROM order_list
+        WHERE order_id=?
+    """, (order_id,)).fetchone()
+    if not o:
+        abort(404, "order not found")
+
+    step_defs = _order_step_defs(product_db, o)
+    _ensure_station_rows(order_db, step_defs)
+
+    lines = [ln for ln in _order_lines(order_db, o) if ln["route"]]
+    chain = _lines_chain(lines)
+    if not chain:
+        abort(400, "empty step chain")
+
+    amount = sum(ln["quantity"] for ln in lines)
+
+    _load_order_pieces(order_db, order_id, lines, step_defs)
+    return {
+        "ok": True,
+        "order_id": order_id,
+        "amount": amount,
+        "steps": chain,
+        "items": [
+            {"line_no": ln["line_no"], "pieces": [ln["piece_from"], ln["piece_to"]], "route": ln["step_name"]}
+            for ln in lines
+        ],
+    }
+
+
+@factory_bp.route("/api/init/<order_id>", methods=["GET", "POST"])
+@login_required
+def api_init(order_id: str):
+    client = _sim_client()
+    if client is not None:
+        return jsonify(_sim_call(client, "init", order_id=order_id))
+
     order_db = _conn(_db_path(_ORDER_DB_FILENAME))
     product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
     try:
-        _ensure_tables(order_db)
-        _ensure_station_rows(order_db, product_db)
-
-        o = order_db.execute("""
-            SELECT order_id, customer_name, step_name, note, status, amount
-            FROM order_list
-            WHERE order_id=?
-        """, (order_id,)).fetchone()
-        if not o:
-            abort(404, "order not found")
+        return jsonify(_init_order(order_db, product_db, order_id))
 
-        # ✅ 權限：非 admin 只能看自己的訂單（避免改網址偷看）
-        if session.get("role") != "admin":
-            me = session.get("account") or session.get("username") or session.get("full_name")
-            if (not me) or ((o["customer_name"] or "") != me):
-                abort(403)
+    finally:
+        order_db.close()
+        product_db.close()
 
-        chain = _parse_step_chain(o["step_name"] or "")
-        if not chain:
-            abort(400, "this order has empty step_name (step chain)")
 
-        try:
-            amount = max(1, int(o["amount"] or 1))
-        except Exception:
-            amount = 1
-
-        _ensure_piece_rows(order_db, order_id, chain, amount)
-
-        # ⭐ 不靠前端：頁面載入先自動 tick 一次，保證至少 Step1 會開始跑
-        _tick_once_for_order(order_db, product_db, order_id)
-
-        steps = _get_step_defs(product_db, chain)
-
-        # 聚合：每個 step done / running
-        agg: Dict[int, Dict[str, int]] = {}
-        for step_no in chain:
-            done = order_db.execute("""
-                SELECT COUNT(*) AS c
-                FROM piece_step_progress
-                WHERE order_id=? AND step_order=? AND state='finished'
-            """, (order_id, step_no)).fetchone()["c"]
-
-            running = order_db.execute("""
-                SELECT COUNT(*) AS c
-                FROM piece_step_progress
-                WHERE order_id=? AND step_order=? AND state='running'
-            """, (order_id, step_no)).fetchone()["c"]
-
-            agg[step_no] = {"done": int(done or 0), "running": int(running or 0)}
-
-        for s in steps:
-            step_no = int(s["step_order"])
-            done_qty = agg.get(step_no, {}).get("done", 0)
-            running_qty = agg.get(step_no, {}).get("running", 0)
-
-            s["done_qty"] = done_qty
-            s["total_qty"] = amount
-
-            if done_qty >= amount:
-                s["state"] = "finished"
-            elif running_qty > 0:
-                s["state"] = "running"
-            else:
-                s["state"] = "pending"
-
-        order_info = {
-            "order_id": o["order_id"],
-            "user_name": o["customer_name"] or (session.get("account") or session.get("full_name") or session.get("username", "Demo User")),
-            "note": o["note"] or "無備註",
-            "status": (o["status"] or "").lower(),
-            "amount": amount,
-        }
+def _reset_order(order_db: sqlite3.Connection, order_id: str) -> dict:
+    _ensure_tables(order_db)
+
+    with _sim_lock:
+        busy = factory_model.reset_order(order_db, order_id)
+
+        floor.order_closed(order_id)
+        for station in busy:
+            get_station_driver().cancel_job(station)
+            floor.station_idle(station)
+    # 刪掉的紀錄可能已算進快取的指標 bucket（所有 process 都要重算）；訂單回到全部未開始，產能控管重新計算
+    bump_metrics_generation(order_db)
+    order_db.commit()
+    admission.invalidate()
+    invalidate_plan()
 
-        return render_template("factory/simulate.html", order_info=order_info, steps=steps)
+    return {"ok": True, "order_id": order_id}
+
+
+@factory_bp.route("/api/reset/<order_id>", methods=["GET", "POST"])
+@login_required
+def api_reset(order_id: str):
+    client = _sim_client()
+    if client is not None:
+        result = _sim_call(client, "reset", order_id=order_id)
+        # 本 process 的快取也要跟著重算
+        _sim_views.pop(order_id, None)
+        floor.invalidate()
+        invalidate_metrics()
+        admission.invalidate()
+        invalidate_plan()
+        return jsonify(result)
+
+    order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+    try:
+        return jsonify(_reset_order(order_db, order_id))
 
     finally:
         order_db.close()
-        product_db.close()
 
 
-# -------------------------
-# API: init / reset / tick (GET/POST 都可)
-# -------------------------
-@factory_bp.route("/api/init/<order_id>", methods=["GET", "POST"])
+def _retry_order_errors(order_db: sqlite3.Connection, product_db: sqlite3.Connection, order_id: str) -> Optional[int]:
+    """error 的件退回 pending（記憶體模型，定期寫回）並通知看板排隊件數；訂單不存在回傳 None"""
+    client = _sim_client()
+    if client is not None:
+        retried = _sim_call(client, "retry", order_id=order_id)["retried"]
+        _sim_views.pop(order_id, None)
+        floor.invalidate()
+        admission.invalidate()
+        invalidate_plan()
+        return retried
+
+    o = order_db.execute("""
+        SELECT order_id, product, step_name, step_deps, amount, process_version
+        FROM order_list
+        WHERE order_id=?
+    """, (order_id,)).fetchone()
+    if not o:
+        return None
+
+    step_defs = _order_step_defs(product_db, o)
+    with _sim_lock:
+        _load_order_pieces(order_db, order_id, [ln for ln in _order_lines(order_db, o) if ln["route"]], step_defs)
+        retried = factory_model.retry_errors(order_id)
+    by_station: Dict[str, int] = {}
+    work: Dict[str, float] = {}
+    for _, step_no in retried:
+        d = step_defs.get(step_no)
+        if d and d.station:
+            by_station[d.station] = by_station.get(d.station, 0) + 1
+            work[d.station] = work.get(d.station, 0.0) + float(d.estimated_time_sec or 0)
+    floor.pieces_queued(order_id, by_station)
+    admission.work_added(order_id, work)
+    invalidate_plan()
+    return len(retried)
+
+
+@factory_bp.route("/api/retry/<order_id>", methods=["POST"])
 @login_required
-def api_init(order_id: str):
+def api_retry(order_id: str):
+    """把超過重試上限（error）的件退回 pending 重新排程（管理者）"""
+    if session.get("role") != "admin":
+        abort(403)
+
     order_db = _conn(_db_path(_ORDER_DB_FILENAME))
     product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
     try:
         _ensure_tables(order_db)
-        _ensure_station_rows(order_db, product_db)
-
-        o = order_db.execute("""
-            SELECT order_id, step_name, amount
-            FROM order_list
-            WHERE order_id=?
-        """, (order_id,)).fetchone()
-        if not o:
+        retried = _retry_order_errors(order_db, product_db, order_id)
+        if retried is None:
             abort(404, "order not found")
+        return jsonify({"ok": True, "order_id": order_id, "retried": retried})
 
-        chain = _parse_step_chain(o["step_name"] or "")
-        if not chain:
-            abort(400, "empty step chain")
+    finally:
+        order_db.close()
+        product_db.close()
 
-        try:
-            amount = max(1, int(o["amount"] or 1))
-        except Exception:
-            amount = 1
 
-        _ensure_piece_rows(order_db, order_id, chain, amount)
-        return jsonify({"ok": True, "order_id": order_id, "amount": amount, "steps": chain})
+# -------------------------
+# API: 快轉模擬時鐘（管理者）
+# -------------------------
+def _ticking_orders(order_db: sqlite3.Connection) -> List[str]:
+    """已經開始跑（載入記憶體模型）且仍 active 的訂單，依下單時間排序"""
+    return [
+        r["order_id"]
+        for r in order_db.execute("SELECT order_id FROM order_list WHERE status='active' ORDER BY date_ms, order_id")
+        if factory_model.has_order(r["order_id"])
+    ]
+
+
+def _fast_forward(order_db: sqlite3.Connection, product_db: sqlite3.Connection, seconds: int) -> dict:
+    """
+    模擬時鐘往前快轉 seconds 秒（只支援 simulated driver）：依序跳到每個到點事件（完工 / 停機開始或結束），
+    每個時間點替已開始的 active 訂單各 tick 一次，結果和一直開著這些訂單的 simulate 頁面相同。
+    時鐘差存在 sim_clock 表，各 process 的 now_ms() 都會加上（報表、看板、產能控管看到的是同一個時鐘）。
+    """
+    if get_station_driver().name != "simulated":
+        abort(400, "快轉只支援 simulated driver")
+    # 兩個快轉交錯推進同一個時鐘會快轉錯秒數：同一時間只跑一個
+    if not _fast_forward_lock.acquire(blocking=False):
+        abort(409, "已經有快轉在執行")
+    try:
+        return _run_fast_forward(order_db, product_db, seconds)
+    finally:
+        _fast_forward_lock.release()
+
+
+def _run_fast_forward(order_db: sqlite3.Connection, product_db: sqlite3.Connection, seconds: int) -> dict:
+    _ensure_tables(order_db)
+
+    t0 = time.perf_counter()
+    target_ms = to_ms(_now()) + seconds * 1000
+    rounds = dispatched = 0
+    while True:
+        # 每一輪（tick + 推進時鐘）持有模擬狀態鎖，輪與輪之間放開，其他命令 / driver 事件不必等整段快轉
+        with _sim_lock:
+            avail = _availability(order_db)
+            for order_id in _ticking_orders(order_db):
+                dispatched += len(_tick_once_for_order(order_db, product_db, order_id, avail))
+            rounds += 1
+            if avail.now_ms >= target_ms:
+                break
+            nxt = _next_due_ms(avail)
+            step_to = target_ms if nxt is None else min(max(nxt, avail.now_ms + 1), target_ms)
+            # 每一輪都寫回 DB：之後寫進 DB 的時間都用推進後的時鐘，重新啟動 / 其他 process 也要看到
+            advance_clock(order_db, step_to - avail.now_ms)
+
+    return {
+        "ok": True,
+        "seconds": seconds,
+        "clock": fmt_ms(to_ms(_now())),
+        "rounds": rounds,
+        "dispatched": dispatched,
+        "ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+
+
+@factory_bp.route("/api/fast-forward", methods=["POST"])
+@login_required
+def api_fast_forward():
+    """?seconds=...：模擬時鐘快轉"""
+    if session.get("role") != "admin":
+        abort(403)
+    try:
+        seconds = int(request.values.get("seconds") or 0)
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= MAX_FAST_FORWARD_SEC:
+        return jsonify({"ok": False, "message": f"seconds 必須介於 1 ~ {MAX_FAST_FORWARD_SEC}"}), 400
+
+    client = _sim_client()
+    if client is not None:
+        # 快轉可能要跑很久：引擎另外開執行緒跑（不擋其他命令），逾時放寬；期間網站頁面仍讀快取
+        result = _sim_call(client, "fast_forward", timeout=SIM_SLOW_TIMEOUT_SEC, seconds=seconds)
+        floor.invalidate()
+        admission.invalidate()
+        invalidate_plan()
+        return jsonify(result)
+
+    order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+    product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+    try:
+        return jsonify(_fast_forward(order_db, product_db, seconds))
 
     finally:
         order_db.close()
         product_db.close()
 
 
-@factory_bp.route("/api/reset/<order_id>", methods=["GET", "POST"])
+# -------------------------
+# API: 模擬狀態快照 / 還原（管理者）
+# -------------------------
+def _save_snapshot(order_db: sqlite3.Connection, product_db: sqlite3.Connection, path: str) -> int:
+    """先把記憶體模型還沒寫回的變動寫進 DB 再備份（連同庫存帳本位置），回傳檔案大小"""
+    _ensure_tables(order_db)
+    ensure_inventory_schema(product_db)
+    factory_model.flush(order_db)
+    return save_snapshot(order_db, product_db, path)
+
+
+def _restore_snapshot(order_db: sqlite3.Connection, product_db: sqlite3.Connection, path: str) -> None:
+    """
+    從快照換回模擬狀態與訂單 status、沖銷之後的訂單庫存異動，再重建記憶體模型；
+    driver 收回舊工作、改追蹤快照裡的進行中工作。
+    舊格式（沒有帳本位置）的快照、快照之後有新訂單時回 409。
+    """
+    _ensure_tables(order_db)
+    ensure_inventory_schema(product_db)
+    driver = get_station_driver()
+    with _sim_lock:
+        old_jobs = factory_model.jobs()
+        try:
+            factory_model.reload(order_db, lambda: restore_snapshot(order_db, product_db, path))
+        except ValueError as e:
+            abort(409, str(e))
+        # 快照裡的 sim_clock 也換回快照當時的時鐘；piece 紀錄整個換掉，所有 process 的指標快取都失效
+        ensure_sim_clock_schema(order_db)
+        bump_metrics_generation(order_db)
+        order_db.commit()
+        reload_clock()
+        for station in old_jobs:
+            driver.cancel_job(station)
+        for station, job in factory_model.jobs().items():
+            driver.start_job(station, job)
+    # 訂單 / piece 狀態整個換掉：看板、產能控管、報表、tick 結果都從 DB 重算
+    _invalidate_after_restore()
+
+
+def _invalidate_after_restore() -> None:
+    floor.invalidate()
+    admission.invalidate()
+    invalidate_metrics()
+    invalidate_plan()
+    tick_gate.invalidate()
+    _sim_views.clear()
+
+
+@factory_bp.route("/api/snapshots", methods=["GET"])
 @login_required
-def api_reset(order_id: str):
-    order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+def api_snapshots():
+    if session.get("role") != "admin":
+        abort(403)
+    return jsonify({"ok": True, "snapshots": list_snapshots(snapshot_dir(current_app))})
+
+
+@factory_bp.route("/api/snapshot", methods=["POST"])
+@login_required
+def api_snapshot():
+    """建立快照：?name=...（空白用時間戳記命名；同名覆蓋）"""
+    if session.get("role") != "admin":
+        abort(403)
+    name = (request.values.get("name") or "").strip() or default_name()
     try:
-        _ensure_tables(order_db)
+        path = snapshot_path(snapshot_dir(current_app), name)
+    except ValueError as e:
+        return jsonify({"ok": False, "message": str(e)}), 400
+
+    t0 = time.perf_counter()
+    client = _sim_client()
+    if client is not None:
+        size = _sim_call(client, "snapshot", path=path)["bytes"]
+    else:
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            size = _save_snapshot(order_db, product_db, path)
+        finally:
+            order_db.close()
+            product_db.close()
+    return jsonify({"ok": True, "name": name, "bytes": size, "ms": round((time.perf_counter() - t0) * 1000, 1)})
 
-        order_db.execute("""
-            UPDATE station_state
-            SET current_order_id=NULL, current_piece_no=NULL, current_step_order=NULL, busy_until=NULL, updated_at=?
-            WHERE current_order_id=?
-        """, (_fmt(_now()), order_id))
 
-        order_db.execute("DELETE FROM piece_step_progress WHERE order_id=?", (order_id,))
-        order_db.commit()
+@factory_bp.route("/api/restore/<name>", methods=["POST"])
+@login_required
+def api_restore(name: str):
+    if session.get("role") != "admin":
+        abort(403)
+    try:
+        path = snapshot_path(snapshot_dir(current_app), name)
+    except ValueError as e:
+        return jsonify({"ok": False, "message": str(e)}), 400
+    if not os.path.exists(path):
+        abort(404, "snapshot not found")
+
+    t0 = time.perf_counter()
+    client = _sim_client()
+    if client is not None:
+        _sim_call(client, "restore", path=path)
+        # 引擎重建了自己的狀態；本 process 的快取也要從 DB 重算
+        _invalidate_after_restore()
+    else:
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            _restore_snapshot(order_db, product_db, path)
+        finally:
+            order_db.close()
+            product_db.close()
+    return jsonify({"ok": True, "name": name, "ms": round((time.perf_counter() - t0) * 1000, 1)})
+
+
+def _tick_request(
+    order_db: sqlite3.Connection,
+    product_db: sqlite3.Connection,
+    focus_order_id: Optional[str],
+) -> Tuple[dict, Optional[int]]:
+    """api_tick 的一次 tick，回傳（結果, 下一個到點時間）給 tick_gate"""
+    _ensure_tables(order_db)
+    avail = _availability(order_db)
+
+    if not focus_order_id:
+        # 仍會先完成到點的工作，但不主動派新工（避免跑錯單）
+        with _sim_lock:
+            _complete_due_jobs(order_db, avail)
+        return {"ok": True, "dispatched": [], "msg": "need ?order_id=... to dispatch"}, _next_due_ms(avail)
+
+    o = order_db.execute(
+        "SELECT process_version FROM order_list WHERE order_id=?", (focus_order_id,)
+    ).fetchone()
+    if o:
+        _ensure_station_rows(order_db, _order_step_defs(product_db, o))
 
-        return jsonify({"ok": True, "order_id": order_id})
+    dispatched = _tick_once_for_order(order_db, product_db, focus_order_id, avail)
+    return {"ok": True, "order_id": focus_order_id, "dispatched": dispatched}, _next_due_ms(avail)
 
-    finally:
-        order_db.close()
+
+def _tick_gated(focus_order_id: Optional[str]) -> Tuple[dict, str]:
+    """經過 tick_gate 跑 _tick_request（idle 時不開 DB），回傳（結果, 來源 run / shared / idle）"""
+    def run():
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            return _tick_request(order_db, product_db, focus_order_id)
+        finally:
+            order_db.close()
+            product_db.close()
+
+    return tick_gate.run(focus_order_id or "", to_ms(_now()), run)
 
 
 @factory_bp.route("/api/tick", methods=["GET", "POST"])
@@ -543,47 +1111,307 @@ def api_tick():
     支援：
     - /api/tick?order_id=xxx 只跑這張單（你在 simulate 頁面就用這個）
     - 沒帶 order_id：不做派工（避免未來多單時亂跑），你要全域排程再擴充
+    同一張訂單的 tick 經過 tick_gate 合併（回應的 coalesced：run / shared / idle）；
+    idle 時不開 DB，直接回傳上次的結果。模擬在引擎時只送出通知（coalesced：worker），不等結果
     """
     focus_order_id = request.args.get("order_id")
 
+    client = _sim_client()
+    if client is not None:
+        try:
+            client.notify("tick", order_id=focus_order_id)
+        except SimWorkerUnavailable as e:
+            abort(503, str(e))
+        return jsonify({"ok": True, "order_id": focus_order_id, "dispatched": [], "coalesced": "worker"})
+
+    result, source = _tick_gated(focus_order_id)
+    return jsonify({**result, "coalesced": source})
+
+
+# Debug：看 station 是否占用 / 是否有 running（記憶體模型的狀態）
+@factory_bp.route("/api/debug/state", methods=["GET"])
+@login_required
+def api_debug_state():
+    client = _sim_client()
+    if client is not None:
+        return jsonify(_sim_call(client, "state"))
+
     order_db = _conn(_db_path(_ORDER_DB_FILENAME))
-    product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
     try:
         _ensure_tables(order_db)
-        _ensure_station_rows(order_db, product_db)
+        return jsonify(factory_model.state())
+    finally:
+        order_db.close()
 
-        if not focus_order_id:
-            # 仍會先完成到點的工作，但不主動派新工（避免跑錯單）
-            _complete_due_jobs(order_db)
-            return jsonify({"ok": True, "dispatched": [], "msg": "need ?order_id=... to dispatch"})
 
-        dispatched = _tick_once_for_order(order_db, product_db, focus_order_id)
-        return jsonify({"ok": True, "order_id": focus_order_id, "dispatched": dispatched})
+# -------------------------
+# 模擬引擎（`flask factory sim-worker`）：命令、自己推進到點事件、發布畫面資料
+# -------------------------
+# 引擎端：order_id -> 最後一次被看（view / tick 命令）的時間；上次發布的畫面資料與狀態版本
+_watched: Dict[str, float] = {}
+_published: Dict[str, dict] = {}
+_published_version = -1
+
 
+def _engine_command(app, cmd: str, args: dict) -> dict:
+    """
+    引擎命令執行緒呼叫：每個命令各開一次 DB；abort 轉成 SimWorkerError 回給網站。
+    快轉以外的命令整個持有模擬狀態鎖（和主迴圈、driver 事件互斥）；快轉自己每一輪拿一次
+    """
+    with app.app_context():
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            if cmd == "fast_forward":
+                return _fast_forward(order_db, product_db, int(args.get("seconds") or 0))
+            with _sim_lock:
+                return _engine_locked_command(order_db, product_db, cmd, args)
+        except HTTPException as e:
+            raise SimWorkerError(e.code or 500, e.description or "")
+        finally:
+            order_db.close()
+            product_db.close()
+
+
+def _engine_locked_command(order_db: sqlite3.Connection, product_db: sqlite3.Connection, cmd: str, args: dict) -> dict:
+    """持有模擬狀態鎖時執行的命令（_watched / _published 也只在鎖內改）"""
+    order_id = args.get("order_id")
+    if cmd in ("view", "tick") and order_id:
+        _watched[order_id] = time.time()
+
+    if cmd == "init":
+        return _init_order(order_db, product_db, order_id)
+    if cmd == "view":
+        view = _published[order_id] = _simulate_view(order_db, product_db, order_id, args.get("viewer"), tick=False)
+        return view
+    if cmd == "tick":
+        result, source = _tick_gated(order_id)
+        return {**result, "coalesced": source}
+    if cmd == "reset":
+        _published.pop(order_id, None)
+        return _reset_order(order_db, order_id)
+    if cmd == "retry":
+        _ensure_tables(order_db)
+        return {"retried": _retry_order_errors(order_db, product_db, order_id)}
+    if cmd == "snapshot":
+        return {"bytes": _save_snapshot(order_db, product_db, args["path"])}
+    if cmd == "restore":
+        _restore_snapshot(order_db, product_db, args["path"])
+        _published.clear()
+        return {}
+    if cmd == "invalidate":
+        tick_gate.invalidate()
+        return {}
+    if cmd == "state":
+        _ensure_tables(order_db)
+        return factory_model.state()
+    raise SimWorkerError(400, f"unknown command: {cmd}")
+
+
+def _engine_step(app, server: SimWorkerServer) -> None:
+    """
+    引擎主迴圈每 SIM_PUBLISH_INTERVAL_SEC 秒一次（整段持有模擬狀態鎖）：
+    1) 有到點事件（完工 / 停機開始或結束；快轉後依模擬時鐘）就替已開始的 active 訂單各 tick 一次，不必等頁面
+    2) 狀態版本變了就寫回 DB、發布新版本，再重算最近有人看的訂單畫面資料，只發布有變動的
+    """
+    global _published_version
+    with app.app_context(), _sim_lock:
+        order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+        product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
+        try:
+            # 表格 / 記憶體模型在引擎啟動時已經準備好
+            avail = _availability(order_db)
+            nxt = _next_due_ms(avail)
+            if nxt is not None and nxt <= avail.now_ms:
+                for order_id in _ticking_orders(order_db):
+                    _tick_once_for_order(order_db, product_db, order_id, avail)
+
+            now = time.time()
+            dropped = [oid for oid, t in list(_watched.items()) if now - t > SIM_WATCH_TTL_SEC]
+            for order_id in dropped:
+                _watched.pop(order_id, None)
+                _published.pop(order_id, None)
+
+            version = factory_model.version
+            if version == _published_version and not dropped:
+                return
+            _published_version = version
+            # 網站的看板 / 產能控管會從 DB 重建，先寫回再發布新版本（不管有沒有人開著 simulate 頁面）
+            factory_model.flush(order_db)
+            server.publish({"event": "version", "version": version})
+
+            views: Dict[str, dict] = {}
+            for order_id in list(_watched):
+                try:
+                    view = _simulate_view(order_db, product_db, order_id, tick=False)
+                except HTTPException:
+                    # 訂單被刪除 / 沒有步驟：網站端拿掉快取，下次看頁面時再問引擎
+                    _watched.pop(order_id, None)
+                    _published.pop(order_id, None)
+                    dropped.append(order_id)
+                    continue
+                if view != _published.get(order_id):
+                    views[order_id] = _published[order_id] = view
+                # 已完成的訂單最後發布一次就不再追蹤
+                if view["order_info"]["status"] == _COMPLETE_STATUS:
+                    _watched.pop(order_id, None)
+                    _published.pop(order_id, None)
+
+            if views or dropped:
+                server.publish({"event": "views", "version": version, "views": views, "dropped": dropped})
+        finally:
+            order_db.close()
+            product_db.close()
+
+
+@factory_bp.cli.command("sim-worker")
+@click.option("--socket", "path", default=None, help="Unix socket 路徑（預設 FACTORY_SIM_SOCKET）")
+def sim_worker_command(path):
+    """模擬引擎：網站設 FACTORY_SIM_ENGINE=worker 時，派工 / 完工 / 寫回都在這個 process 跑"""
+    mark_serving()
+    app = current_app._get_current_object()
+    path = path or socket_path(app)
+
+    # 記憶體模型、driver 在這個 process 載入
+    order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+    try:
+        _ensure_tables(order_db)
     finally:
         order_db.close()
-        product_db.close()
 
+    server = SimWorkerServer(path, lambda cmd, args: _engine_command(app, cmd, args), slow=SIM_SLOW_COMMANDS)
+    try:
+        server.start()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"模擬引擎執行中：{path}（Ctrl+C 結束）")
+    # 被 terminate（spawn 模式網站結束時）也要走正常結束：移除 socket、寫回記憶體模型
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while True:
+            time.sleep(SIM_PUBLISH_INTERVAL_SEC)
+            try:
+                _engine_step(app, server)
+            except Exception:
+                log.exception("sim worker step failed")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+# -------------------------
+# CLI：站點替身（FACTORY_STATION_DRIVER=socket 時，沒有實體站點可用它回報完工事件）
+# -------------------------
+@factory_bp.cli.command("station-standin")
+@click.option("--host", default=DEFAULT_SOCKET_HOST, show_default=True)
+@click.option("--port", default=DEFAULT_SOCKET_PORT, show_default=True, type=int)
+@click.option("--speed", default=1.0, show_default=True, help="加工速度倍率（2 = 兩倍速）")
+@click.option("--failure-rate", default=0.0, show_default=True, help="回報失敗的機率")
+def station_standin_command(host, port, speed, failure_rate):
+    click.echo(f"站點替身連線到 {host}:{port}（Ctrl+C 結束）")
+    run_standin(host, port, speed=speed, failure_rate=failure_rate)
+
+
+# -------------------------
+# CLI：批次模擬（虛擬時間、全部在記憶體，不動 DB；派工規則和網站相同）
+# -------------------------
+def _parse_step_times(values) -> Dict[int, int]:
+    """--set-time 3=40 → {3: 40}"""
+    out: Dict[int, int] = {}
+    for v in values:
+        step, _, sec = v.partition("=")
+        try:
+            out[int(step)] = int(sec)
+        except ValueError:
+            raise click.BadParameter(f"格式應為 STEP=SEC：{v}", param_hint="--set-time")
+    return out
+
+
+def _batch_orders_from_db(order_db, product_db, start_ms: int, version: Optional[int], times: Dict[int, int],
+                          due_hours: float) -> List[SimOrder]:
+    """DB 裡 active 的訂單全部從頭開始做（不看目前的進度），到達時間都是 start_ms；交期 = 下單時間 + due_hours"""
+    out = []
+    for o in order_db.execute("""
+        SELECT order_id, product, step_name, step_deps, amount, process_version, date_ms
+        FROM order_list
+        WHERE status='active'
+        ORDER BY date_ms, order_id
+    """).fetchall():
+        lines = [ln for ln in _order_lines(order_db, o) if ln["route"]]
+        if not lines:
+            continue
+        step_defs = override_times(get_step_defs(product_db, version or o["process_version"]), times)
+        placed_ms = int(o["date_ms"] or start_ms)
+        out.append(SimOrder(o["order_id"], start_ms, placed_ms + int(due_hours * 3600 * 1000), lines, step_defs))
+    return out
+
+
+@factory_bp.cli.command("simulate-batch")
+@click.option("--synthetic", default=0, show_default=True, help="隨機產生幾張訂單（0 = 用 DB 裡 active 的訂單）")
+@click.option("--days", default=30.0, show_default=True, help="隨機訂單的到達時間分布在幾天內")
+@click.option("--max-qty", default=10, show_default=True, help="隨機訂單的最大件數")
+@click.option("--seed", default=None, type=int, help="亂數種子（固定後結果可重現）")
+@click.option("--version", "version", default=None, type=int, help="模板版本（預設：DB 訂單用各自的版本，隨機訂單用目前版本）")
+@click.option("--set-time", "set_time", multiple=True, metavar="STEP=SEC", help="覆寫步驟秒數，可重複指定")
+@click.option("--due-hours", default=DEFAULT_DUE_HOURS, show_default=True, help="交期：到達（下單）後幾小時")
+@click.option("--failure-rate", default=None, type=float, help="完工失敗機率（預設 FACTORY_FAILURE_RATE）")
+@click.option("--ignore-downtime", is_flag=True, help="不套用 station_downtime 裡排定的停機")
+@click.option("--bucket-hours", default=DEFAULT_BUCKET_HOURS, show_default=True, help="吞吐曲線的區間長度（小時）")
+@click.option("--json", "as_json", is_flag=True, help="輸出 JSON")
+def simulate_batch_command(synthetic, days, max_qty, seed, version, set_time, due_hours, failure_rate,
+                           ignore_downtime, bucket_hours, as_json):
+    """批次模擬：flask factory simulate-batch --synthetic 500 --days 30 --set-time 3=40"""
+    times = _parse_step_times(set_time)
+    start_ms = to_ms(_now())
 
-# Debug：看 station 是否占用 / 是否有 running
-@factory_bp.route("/api/debug/state", methods=["GET"])
-@login_required
-def api_debug_state():
     order_db = _conn(_db_path(_ORDER_DB_FILENAME))
+    product_db = _conn(_db_path(_PRODUCT_DB_FILENAME))
     try:
-        _ensure_tables(order_db)
-        stations = [dict(r) for r in order_db.execute("""
-            SELECT station, current_order_id, current_piece_no, current_step_order, busy_until
-            FROM station_state
-            ORDER BY station
-        """).fetchall()]
-        running = [dict(r) for r in order_db.execute("""
-            SELECT order_id, piece_no, step_order, state
-            FROM piece_step_progress
-            WHERE state='running'
-            ORDER BY order_id, piece_no, step_order
-        """).fetchall()]
-        return jsonify({"stations": stations, "running": running})
+        ensure_order_list_schema(order_db)
+        ensure_order_items_schema(order_db)
+        ensure_process_template_schema(product_db)
+        ensure_downtime_schema(order_db)
+
+        if synthetic > 0:
+            step_defs = override_times(get_step_defs(product_db, version or current_version(product_db)), times)
+            orders = synthesize_orders(step_defs, synthetic, start_ms, days, max_qty, due_hours, seed)
+        else:
+            orders = _batch_orders_from_db(order_db, product_db, start_ms, version, times, due_hours)
+        windows = {} if ignore_downtime else load_availability(order_db, start_ms).windows
     finally:
         order_db.close()
+        product_db.close()
 
+    if not orders:
+        raise click.ClickException("沒有可模擬的訂單（DB 沒有 active 訂單時請用 --synthetic N）")
+
+    result = run_batch(
+        orders,
+        start_ms,
+        windows,
+        failure_rate=current_app.config.get("FACTORY_FAILURE_RATE", 0.0) if failure_rate is None else failure_rate,
+        max_attempts=int(current_app.config.get("FACTORY_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        bucket_sec=int(bucket_hours * 3600),
+        seed=seed,
+    )
+
+    if as_json:
+        click.echo(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+
+    click.echo(f"模擬 {result['orders']} 張訂單：{result['start']} ～ {result['end']}"
+               f"（makespan {result['makespan_sec'] / 3600:.1f} 小時，事件 {result['events']} 個，耗時 {result['wall_sec']} 秒）")
+    click.echo(f"完成訂單 {result['orders_completed']}，完成件數 {result['pieces_completed']}，報廢件數 {result['pieces_scrapped']}")
+    late = result["lateness_sec"]
+    if late["count"]:
+        click.echo(f"延遲訂單 {result['late_orders']}；延遲秒數 平均 {late['mean']} / p50 {late['p50']} / p95 {late['p95']}")
+    click.echo("")
+    click.echo("站點稼動率：")
+    for s in result["stations"]:
+        click.echo(f"  {s['utilization'] * 100:6.1f}%  加工 {s['busy_sec']:>10} 秒  停機 {s['down_sec']:>8} 秒  {s['station']}")
+    click.echo("")
+    click.echo("吞吐曲線（每區間完成件數 / 累計）：")
+    for b in result["throughput"]:
+        click.echo(f"  {b['bucket_start']}  {b['pieces_done']:>6}  {b['cumulative']:>8}")
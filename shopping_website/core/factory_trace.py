@@ -0,0 +1,117 @@
+# core/factory_trace.py
+# 產線執行時序匯出（Chrome trace-event JSON，可用 chrome://tracing 或 Perfetto 開啟）：
+# - 每個站點一條 track（tid），每個 piece-step 一個 slice（ph="X"）
+# - 資料來自 piece_step_progress 的 started_at_ms / finished_at_ms；還在加工中的件用
+#   station_state.busy_until_ms 當預計結束時間
+# - 可以匯出一張訂單，或一段時間窗內所有訂單
+# - cursor fetchmany 逐批輸出，slice 再多也不會整批讀進記憶體
+
+from __future__ import annotations
+
+import json
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+from .process_templates import ensure_process_template_schema, get_step_defs
+from .timeutil import to_ms
+
+FETCH_SIZE = 2000
+# 所有站點放在同一個 process（pid）底下
+TRACE_PID = 1
+UNKNOWN_STATION = "(未指定站點)"
+
+
+def iter_trace(
+    order_db,
+    product_db,
+    order_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Iterator[str]:
+    """
+    逐段 yield trace JSON 字串（串起來就是完整的 {"traceEvents": [...]}）。
+    - order_id：只匯出這張訂單
+    - start / end：只匯出和 [start, end) 有重疊的 piece-step
+    呼叫端負責關閉連線。
+    """
+    where = ["p.started_at_ms IS NOT NULL"]
+    params = []
+    if order_id:
+        where.append("p.order_id = ?")
+        params.append(order_id)
+    if end is not None:
+        where.append("p.started_at_ms < ?")
+        params.append(to_ms(end))
+    if start is not None:
+        where.append("COALESCE(p.finished_at_ms, ss.busy_until_ms) >= ?")
+        params.append(to_ms(start))
+
+    ensure_process_template_schema(product_db)
+    cur = order_db.cursor()
+    cur.execute(f"""
+        SELECT
+          p.order_id, p.piece_no, p.step_order, p.state,
+          p.started_at_ms AS s,
+          COALESCE(p.finished_at_ms, ss.busy_until_ms) AS f,
+          o.process_version
+        FROM piece_step_progress p
+        JOIN order_list o ON o.order_id = p.order_id
+        LEFT JOIN station_state ss
+          ON ss.current_order_id = p.order_id
+         AND ss.current_piece_no = p.piece_no
+         AND ss.current_step_order = p.step_order
+        WHERE {" AND ".join(where)}
+        ORDER BY p.started_at_ms
+    """, params)
+
+    yield '{"displayTimeUnit": "ms", "traceEvents": [\n'
+    yield json.dumps({
+        "ph": "M", "pid": TRACE_PID, "name": "process_name",
+        "args": {"name": f"訂單 {order_id}" if order_id else "產線"},
+    }, ensure_ascii=False)
+
+    # 站點第一次出現時才送 thread_name（track 名稱），tid 依出現順序編號
+    tids: Dict[str, int] = {}
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+
+        out = []
+        for r in rows:
+            d = get_step_defs(product_db, r["process_version"]).get(int(r["step_order"]))
+            station = d.station if d and d.station else UNKNOWN_STATION
+            tid = tids.get(station)
+            if tid is None:
+                tid = tids[station] = len(tids) + 1
+                out.append(json.dumps({
+                    "ph": "M", "pid": TRACE_PID, "tid": tid, "name": "thread_name",
+                    "args": {"name": station},
+                }, ensure_ascii=False))
+                out.append(json.dumps({
+                    "ph": "M", "pid": TRACE_PID, "tid": tid, "name": "thread_sort_index",
+                    "args": {"sort_index": tid},
+                }))
+
+            s = int(r["s"])
+            f = int(r["f"]) if r["f"] is not None else s
+            out.append(json.dumps({
+                "ph": "X",
+                "pid": TRACE_PID,
+                "tid": tid,
+                "name": f"{r['order_id']} #{r['piece_no']} 步驟{r['step_order']}",
+                "cat": d.step_name if d else "step",
+                # trace-event 的時間單位是微秒
+                "ts": s * 1000,
+                "dur": max(0, f - s) * 1000,
+                "args": {
+                    "order_id": r["order_id"],
+                    "piece_no": r["piece_no"],
+                    "step_order": r["step_order"],
+                    "state": r["state"],
+                },
+            }, ensure_ascii=False))
+
+        yield ",\n" + ",\n".join(out)
+
+    yield "\n]}\n"
@@ -0,0 +1,162 @@
+# core/floor_state.py
+# 產線即時狀態（管理者看板用）：
+# - 每個 station 目前在做哪張單 / 第幾件 / 哪一步 / 何時做完，以及排隊中的件數
+# - 第一次讀取時從 SQL 建一次（station_state + pending 的 piece rows），之後由派工程式
+#   在狀態改變時送事件進來增量更新，看板輪詢時直接讀記憶體，不再每次查 SQL
+# - 每個事件有遞增的 seq，看板用 ?since=<seq> 只拿新事件；落後太多（事件已被擠出緩衝）就重送 snapshot
+# - 狀態是每個 process 一份；多 worker 部署時只看得到本 process 派工的事件
+
+from __future__ import annotations
+
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from .process_templates import ensure_process_template_schema, get_step_defs
+from .timeutil import now_ms, to_ms
+
+# 事件緩衝最多保留幾筆
+EVENT_BUFFER = 1000
+
+
+class FloorState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.seq = 0
+        # station -> {"order_id", "piece_no", "step_order", "busy_until"}（閒置時值為 None）
+        self.stations: Dict[str, Optional[dict]] = {}
+        # station -> {order_id: 排隊中的 piece-step 數}
+        self.queue: Dict[str, Dict[str, int]] = {}
+        self.events: deque = deque(maxlen=EVENT_BUFFER)
+
+    # ---------- 初始載入 ----------
+    def ensure_loaded(self, order_db, product_db) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            self._load(order_db, product_db)
+            self.loaded = True
+
+    def _load(self, order_db, product_db) -> None:
+        self.stations = {}
+        for r in order_db.execute("""
+            SELECT station, current_order_id, current_piece_no, current_step_order, busy_until_ms
+            FROM station_state
+            ORDER BY station
+        """):
+            self.stations[r["station"]] = (
+                {
+                    "order_id": r["current_order_id"],
+                    "piece_no": r["current_piece_no"],
+                    "step_order": r["current_step_order"],
+                    "busy_until": r["busy_until_ms"],
+                }
+                if r["current_order_id"]
+                else None
+            )
+
+        ensure_process_template_schema(product_db)
+        self.queue = {st: {} for st in self.stations}
+        for r in order_db.execute("""
+            SELECT p.order_id, p.step_order, o.process_version, COUNT(*) AS c
+            FROM piece_step_progress p
+            JOIN order_list o ON o.order_id = p.order_id
+            WHERE p.state = 'pending' AND o.status = 'active'
+            GROUP BY p.order_id, p.step_order, o.process_version
+        """):
+            d = get_step_defs(product_db, r["process_version"]).get(int(r["step_order"]))
+            if d and d.station:
+                q = self.queue.setdefault(d.station, {})
+                q[r["order_id"]] = q.get(r["order_id"], 0) + int(r["c"])
+
+        # 重新載入後舊事件就沒有意義了，讓看板重抓 snapshot
+        self.events.clear()
+        self.seq += 1
+
+    def invalidate(self) -> None:
+        """下一次讀取時從 SQL 重建（例如直接改了 DB）"""
+        self.loaded = False
+
+    # ---------- 事件（由派工程式在 commit 之後呼叫） ----------
+    def _emit(self, event: dict) -> None:
+        self.seq += 1
+        event["seq"] = self.seq
+        event["ts"] = now_ms()
+        self.events.append(event)
+
+    def station_busy(self, station: str, order_id: str, piece_no: int, step_order: int, busy_until) -> None:
+        if not self.loaded:
+            return
+        with self.lock:
+            info = {
+                "order_id": order_id,
+                "piece_no": piece_no,
+                "step_order": step_order,
+                "busy_until": to_ms(busy_until),
+            }
+            self.stations[station] = info
+            q = self.queue.setdefault(station, {})
+            if q.get(order_id, 0) > 0:
+                q[order_id] -= 1
+                if not q[order_id]:
+                    del q[order_id]
+            self._emit({"type": "station", "station": station, "job": info, "queue": sum(q.values())})
+
+    def station_idle(self, station: str) -> None:
+        if not self.loaded:
+            return
+        with self.lock:
+            self.stations[station] = None
+            q = self.queue.setdefault(station, {})
+            self._emit({"type": "station", "station": station, "job": None, "queue": sum(q.values())})
+
+    def pieces_queued(self, order_id: str, station_counts: Dict[str, int]) -> None:
+        """新建立了 pending 的 piece rows（station -> 件數）"""
+        if not self.loaded or not station_counts:
+            return
+        with self.lock:
+            for station, n in station_counts.items():
+                if not n:
+                    continue
+                self.stations.setdefault(station, None)
+                q = self.queue.setdefault(station, {})
+                q[order_id] = q.get(order_id, 0) + n
+                self._emit({"type": "queue", "station": station, "queue": sum(q.values())})
+
+    def order_closed(self, order_id: str) -> None:
+        """訂單完成 / 取消 / 拒絕 / 重設：不再排隊"""
+        if not self.loaded:
+            return
+        with self.lock:
+            for station, q in self.queue.items():
+                if q.pop(order_id, None):
+                    self._emit({"type": "queue", "station": station, "queue": sum(q.values())})
+
+    # ---------- 讀取 ----------
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "seq": self.seq,
+                "stations": [
+                    {"station": st, "job": job, "queue": sum(self.queue.get(st, {}).values())}
+                    for st, job in sorted(self.stations.items())
+                ],
+            }
+
+    def events_since(self, since: int) -> Optional[List[dict]]:
+        """seq > since 的事件；since 已經被擠出緩衝（或重新載入過）時回傳 None，呼叫端改送 snapshot"""
+        with self.lock:
+            if since > self.seq:
+                # 前端的 seq 比目前還新：process 重啟過
+                return None
+            if since == self.seq:
+                return []
+            if not self.events or self.events[0]["seq"] > since + 1:
+                return None
+            return [e for e in self.events if e["seq"] > since]
+
+
+floor = FloorState()
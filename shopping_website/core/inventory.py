@@ -0,0 +1,260 @@
+# core/inventory.py
+# 庫存帳本（append-only）：
+# - 每一次庫存異動都記一筆 stock_ledger（下單扣庫存 / 取消、拒絕回補 / 管理者調整）
+# - products.stock 只是帳本的快取總和，跟帳本在同一個 transaction 內增量更新
+#   （同時 +1 catalog_version.stock_version，讓 core/catalog.py 的快取失效）
+# - stock_snapshot 定期記下每個產品的庫存，查「某時間點的庫存」只需要
+#   「最近一次 snapshot + 之後少量帳本」，不必從頭加總
+# - 對帳：snapshot + 之後的帳本 vs products.stock，一條 SQL 就能算出差異
+
+from __future__ import annotations
+
+import sqlite3
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .catalog import bump_stock_version, ensure_catalog_schema
+
+# 帳本原因
+REASON_OPENING = "opening"   # 帳本建立時的期初庫存
+REASON_ORDER = "order"       # 下單扣庫存
+REASON_CANCEL = "cancel"     # 客戶取消 → 回補
+REASON_REJECT = "reject"     # 工廠拒絕 → 回補
+REASON_ADJUST = "adjust"     # 管理者盤點 / 手動調整
+REASON_SIM_RESTORE = "sim_restore"  # 還原產線模擬快照：訂單狀態回到快照當時，沖銷之後的訂單庫存異動
+
+# 每累積多少筆帳本就自動拍一次 snapshot（讓 as-of 查詢掃描的帳本筆數有上限）
+SNAPSHOT_EVERY = 1000
+
+# (product_id, delta, reason, ref_order_id, note)
+LedgerEntry = Tuple[int, int, str, Optional[str], Optional[str]]
+
+
+def _now_str() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def ensure_inventory_schema(conn: sqlite3.Connection) -> None:
+    """建立帳本 / snapshot 表；還沒有帳本的產品補一筆期初庫存（opening）"""
+    ensure_catalog_schema(conn)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_ledger (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          product_id INTEGER NOT NULL,
+          delta INTEGER NOT NULL,
+          reason TEXT NOT NULL,          -- opening/order/cancel/reject/adjust/sim_restore
+          ref_order_id TEXT,
+          note TEXT,
+          created_at TEXT NOT NULL
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_ledger_product ON stock_ledger(product_id, id);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_ledger_order ON stock_ledger(ref_order_id);")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshot (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          taken_at TEXT NOT NULL,
+          ledger_id INTEGER NOT NULL     -- 此 snapshot 已包含到哪一筆帳本
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshot_item (
+          snapshot_id INTEGER NOT NULL,
+          product_id INTEGER NOT NULL,
+          stock INTEGER NOT NULL,
+          PRIMARY KEY(snapshot_id, product_id)
+        );
+    """)
+
+    conn.execute("""
+        INSERT INTO stock_ledger(product_id, delta, reason, note, created_at)
+        SELECT p.id, CAST(p.stock AS INTEGER), ?, '帳本建立時的期初庫存', ?
+        FROM products p
+        WHERE NOT EXISTS (SELECT 1 FROM stock_ledger l WHERE l.product_id = p.id)
+    """, (REASON_OPENING, _now_str()))
+    conn.commit()
+
+
+def record_movements(conn: sqlite3.Connection, entries: Iterable[LedgerEntry]) -> int:
+    """
+    寫入帳本並增量更新 products.stock（不 commit，交給呼叫端和其他寫入一起 commit）。
+    回傳寫入筆數。
+    """
+    entries = [e for e in entries if int(e[1]) != 0]
+    if not entries:
+        return 0
+
+    now = _now_str()
+    conn.executemany(
+        """
+        INSERT INTO stock_ledger(product_id, delta, reason, ref_order_id, note, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [(int(pid), int(delta), reason, ref, note, now) for pid, delta, reason, ref, note in entries],
+    )
+
+    # 同一產品合併成一次 UPDATE
+    totals: Dict[int, int] = {}
+    for pid, delta, *_ in entries:
+        totals[int(pid)] = totals.get(int(pid), 0) + int(delta)
+    conn.executemany(
+        "UPDATE products SET stock = stock + ? WHERE id = ?",
+        [(delta, pid) for pid, delta in totals.items() if delta],
+    )
+    # 讓各 worker 的產品目錄快取知道庫存變了
+    bump_stock_version(conn)
+
+    maybe_snapshot(conn)
+    return len(entries)
+
+
+def restock_orders(conn: sqlite3.Connection, order_ids: List[str], reason: str, note: Optional[str] = None) -> int:
+    """
+    取消 / 拒絕時把訂單扣掉的庫存加回來（不 commit）。
+    直接把該訂單在帳本上的淨異動反向寫一次，所以重複呼叫不會重複回補。
+    帳本建立前的舊訂單沒有扣庫存紀錄，不會回補。
+    """
+    if not order_ids:
+        return 0
+
+    placeholders = ",".join(["?"] * len(order_ids))
+    rows = conn.execute(f"""
+        SELECT ref_order_id, product_id, SUM(delta) AS net
+        FROM stock_ledger
+        WHERE ref_order_id IN ({placeholders})
+        GROUP BY ref_order_id, product_id
+        HAVING SUM(delta) != 0
+    """, list(order_ids)).fetchall()
+
+    return record_movements(
+        conn,
+        [(r["product_id"], -int(r["net"]), reason, r["ref_order_id"], note) for r in rows],
+    )
+
+
+# -------------------------
+# snapshot / as-of / 對帳
+# -------------------------
+def _latest_snapshot(conn: sqlite3.Connection, as_of: Optional[str] = None) -> Optional[sqlite3.Row]:
+    if as_of is None:
+        return conn.execute("SELECT id, taken_at, ledger_id FROM stock_snapshot ORDER BY id DESC LIMIT 1").fetchone()
+    return conn.execute("""
+        SELECT id, taken_at, ledger_id
+        FROM stock_snapshot
+        WHERE taken_at <= ?
+        ORDER BY id DESC
+        LIMIT 1
+    """, (as_of,)).fetchone()
+
+
+def ledger_stock(conn: sqlite3.Connection, as_of: Optional[str] = None) -> Dict[int, int]:
+    """
+    依帳本算出每個產品的庫存；as_of 給 'YYYY-MM-DD HH:MM:SS' 就是該時間點的庫存。
+    從最近一次 snapshot 起算，只需要加總 snapshot 之後的帳本。
+    """
+    snap = _latest_snapshot(conn, as_of)
+    stock: Dict[int, int] = {}
+    after_id = 0
+    if snap:
+        after_id = int(snap["ledger_id"])
+        for r in conn.execute(
+            "SELECT product_id, stock FROM stock_snapshot_item WHERE snapshot_id = ?", (snap["id"],)
+        ):
+            stock[int(r["product_id"])] = int(r["stock"])
+
+    sql = "SELECT product_id, SUM(delta) AS s FROM stock_ledger WHERE id > ?"
+    params: list = [after_id]
+    if as_of is not None:
+        sql += " AND created_at <= ?"
+        params.append(as_of)
+    sql += " GROUP BY product_id"
+
+    for r in conn.execute(sql, params):
+        pid = int(r["product_id"])
+        stock[pid] = stock.get(pid, 0) + int(r["s"] or 0)
+    return stock
+
+
+def take_snapshot(conn: sqlite3.Connection) -> int:
+    """把目前帳本庫存記成一個 snapshot（不 commit），回傳 snapshot id"""
+    last = conn.execute("SELECT COALESCE(MAX(id), 0) AS m FROM stock_ledger").fetchone()["m"]
+    stock = ledger_stock(conn)
+
+    cur = conn.execute(
+        "INSERT INTO stock_snapshot(taken_at, ledger_id) VALUES (?, ?)",
+        (_now_str(), int(last)),
+    )
+    snap_id = cur.lastrowid
+    conn.executemany(
+        "INSERT INTO stock_snapshot_item(snapshot_id, product_id, stock) VALUES (?, ?, ?)",
+        [(snap_id, pid, s) for pid, s in stock.items()],
+    )
+    return snap_id
+
+
+def maybe_snapshot(conn: sqlite3.Connection, every: int = SNAPSHOT_EVERY) -> Optional[int]:
+    """距離上次 snapshot 累積超過 every 筆帳本才拍新的 snapshot"""
+    snap = _latest_snapshot(conn)
+    after_id = int(snap["ledger_id"]) if snap else 0
+    r = conn.execute(
+        "SELECT COUNT(*) AS c FROM (SELECT 1 FROM stock_ledger WHERE id > ? LIMIT ?)",
+        (after_id, every),
+    ).fetchone()
+    if int(r["c"] or 0) >= every:
+        return take_snapshot(conn)
+    return None
+
+
+def ledger_position(conn: sqlite3.Connection) -> int:
+    """帳本目前最後一筆的 id（產線模擬快照記下這個位置，還原時沖銷這之後的訂單異動）"""
+    return int(conn.execute("SELECT COALESCE(MAX(id), 0) AS m FROM stock_ledger").fetchone()["m"])
+
+
+def reverse_order_movements(
+    conn: sqlite3.Connection, after_id: int, order_ids: Iterable[str], reason: str, note: Optional[str] = None
+) -> int:
+    """
+    把這些訂單在帳本 after_id 之後的淨異動反向寫一次（不 commit），回傳寫入筆數。
+    帳本是 append-only：不刪任何一筆，手動調整（沒有 ref_order_id）不受影響；
+    反向之後這段區間的淨異動是 0，重複呼叫不會重複沖銷。
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return 0
+    # order_id 可能很多：用暫存表 JOIN，不組超長的 IN (...)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _reverse_orders (order_id TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM _reverse_orders")
+    conn.executemany("INSERT OR IGNORE INTO _reverse_orders(order_id) VALUES (?)", [(o,) for o in order_ids])
+    rows = conn.execute("""
+        SELECT l.ref_order_id, l.product_id, SUM(l.delta) AS net
+        FROM stock_ledger l
+        JOIN _reverse_orders r ON r.order_id = l.ref_order_id
+        WHERE l.id > ?
+        GROUP BY l.ref_order_id, l.product_id
+        HAVING SUM(l.delta) != 0
+    """, (int(after_id),)).fetchall()
+    conn.execute("DELETE FROM _reverse_orders")
+
+    return record_movements(
+        conn,
+        [(r["product_id"], -int(r["net"]), reason, r["ref_order_id"], note) for r in rows],
+    )
+
+
+def reconcile(conn: sqlite3.Connection) -> List[dict]:
+    """對帳：products.stock（快取）vs 帳本計算值，回傳每個產品的結果"""
+    ledger = ledger_stock(conn)
+    out = []
+    for r in conn.execute("SELECT id, name, stock FROM products ORDER BY id"):
+        pid = int(r["id"])
+        cached = int(r["stock"] or 0)
+        expected = ledger.get(pid, 0)
+        out.append({
+            "product_id": pid,
+            "name": r["name"],
+            "cached": cached,
+            "ledger": expected,
+            "diff": cached - expected,
+        })
+    return out
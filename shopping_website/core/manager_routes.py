@@ -1,9 +1,52 @@
 # shopping_website/core/manager_routes.py
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from datetime import datetime
+import csv
+import io
+import json
+import shutil
+import tempfile
+
+import click
+from flask import (
+    Blueprint,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    flash,
+    jsonify,
+    Response,
+    stream_with_context,
+    abort,
+    current_app,
+)
+from datetime import datetime, timedelta
 from . import manager_required
 from .db import get_product_db, get_order_mgmt_db
+from .catalog import get_products
+from .factory_routes import _ensure_tables, _retry_order_errors, invalidate_ticks
+from .admission import DEFAULT_HORIZON_SEC, admission
+from .capacity_plan import DEFAULT_BUCKET_SEC as PLAN_DEFAULT_BUCKET_SEC, DEFAULT_DAYS as PLAN_DEFAULT_DAYS
+from .capacity_plan import compute_plan, invalidate as invalidate_plan
+from .floor_state import floor
+from .factory_model import factory_model
+from .factory_metrics import DEFAULT_BUCKET_SEC, DEFAULT_WINDOW_SEC, compute_metrics
+from .factory_trace import iter_trace
+from .order_routes import ORDER_LIST_MS_COLUMNS
+from .timeutil import ensure_ms_columns, from_ms, now_ms, to_ms
+from .station_availability import add_downtime, end_downtime, list_downtime
+from .process_templates import create_version, current_version, ensure_process_template_schema, list_versions
+from .order_import import DEFAULT_CHUNK_SIZE, detect_format, iter_import_rows, import_orders
+from .inventory import (
+    REASON_ADJUST,
+    REASON_REJECT,
+    ensure_inventory_schema,
+    ledger_stock,
+    reconcile,
+    record_movements,
+    restock_orders,
+    take_snapshot,
+)
 
 manager_bp = Blueprint("manager", __name__, url_prefix="/manager")
 
@@ -13,7 +56,7 @@ manager_bp = Blueprint("manager", __name__, url_prefix="/manager")
 # -----------------------------
 def ensure_order_list_schema(conn):
     """
-    確保 order_list 有 status / rejected_at / cancelled_at 欄位（沒有就自動補上）
+    確保 order_list 有 status / rejected_at / cancelled_at / process_version / step_deps 欄位（沒有就自動補上）
     """
     cur = conn.cursor()
     try:
@@ -32,6 +75,21 @@ def ensure_order_list_schema(conn):
             cur.execute("ALTER TABLE order_list ADD COLUMN cancelled_at TEXT")
             changed = True
 
+        # 下單當時的製程模板版本（見 core/process_templates.py）
+        if "process_version" not in cols:
+            cur.execute("ALTER TABLE order_list ADD COLUMN process_version INTEGER")
+            changed = True
+
+        # 製程路線的前置步驟集合 JSON（見 core/process_dag.py）
+        if "step_deps" not in cols:
+            cur.execute("ALTER TABLE order_list ADD COLUMN step_deps TEXT")
+            changed = True
+
+        # 整數 epoch 毫秒時間欄位（見 core/timeutil.py），舊資料補欄位時一次換算
+        if ensure_ms_columns(conn, "order_list", ORDER_LIST_MS_COLUMNS):
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_order_list_date_ms ON order_list(date_ms)")
+            changed = True
+
         if changed:
             conn.commit()
     except Exception:
@@ -42,6 +100,26 @@ def ensure_order_list_schema(conn):
 # -----------------------------
 # 庫存管理（新版：直接讀寫 products.stock）
 # -----------------------------
+def _read_stock_csv(upload):
+    """
+    盤點 CSV → {product_id(str): new_stock}
+    欄位：product_id（或 id）, stock（或 new_stock）；逐行讀，不整份載入
+    """
+    stream = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(stream)
+    new_map = {}
+    for row in reader:
+        pid = (row.get("product_id") or row.get("id") or "").strip()
+        raw = (row.get("stock") or row.get("new_stock") or "").strip()
+        if not pid:
+            continue
+        try:
+            new_map[str(int(pid))] = int(raw)
+        except ValueError:
+            raise ValueError(f"第 {reader.line_num} 行格式錯誤（product_id={pid}, stock={raw}）")
+    return new_map
+
+
 @manager_bp.route("/inventory", methods=["GET", "POST"])
 @manager_required
 def manager_inventory():
@@ -49,29 +127,89 @@ def manager_inventory():
     success_message = None
 
     conn = get_product_db()
+    ensure_inventory_schema(conn)
     cur = conn.cursor()
 
     if request.method == "POST":
-        try:
-            product_id = int(request.form.get("product_id", "0"))
-            new_stock = int(request.form.get("new_stock", "0"))
-            if new_stock < 0:
-                new_stock = 0
+        action = request.form.get("action", "")
 
-            cur.execute("UPDATE products SET stock = ? WHERE id = ?", (new_stock, product_id))
-            conn.commit()
-            success_message = "✅ 庫存已更新"
-        except Exception as e:
-            conn.rollback()
-            error_message = f"❌ 更新失敗：{e}"
+        # ✅ 批次更新：表格整批送出 / 上傳盤點 CSV，只寫有變動的列
+        if action in ("bulk_update_stock", "upload_csv"):
+            try:
+                if action == "upload_csv":
+                    upload = request.files.get("stock_csv")
+                    if not upload or not upload.filename:
+                        raise ValueError("請選擇要上傳的 CSV 檔")
+                    new_map = _read_stock_csv(upload)
+                else:
+                    new_map = {}
+                    for k, v in request.form.items():
+                        if not k.startswith("stock_"):
+                            continue
+                        new_map[k.split("_", 1)[1]] = int((v or "0").strip() or 0)
+
+                cur.execute("SELECT id, stock FROM products")
+                old_map = {str(r["id"]): int(r["stock"] or 0) for r in cur.fetchall()}
+
+                unknown = [pid for pid in new_map if pid not in old_map]
+                note = "盤點 CSV" if action == "upload_csv" else "庫存管理批次調整"
+                changes = []
+                for pid, new_stock in new_map.items():
+                    if pid not in old_map:
+                        continue
+                    new_stock = max(0, new_stock)
+                    if new_stock != old_map[pid]:
+                        changes.append((int(pid), new_stock - old_map[pid], REASON_ADJUST, None, note))
 
-    cur.execute("SELECT id, name, base_price, stock FROM products ORDER BY id ASC")
-    products = cur.fetchall()
+                # 帳本記差額，products.stock 增量更新
+                record_movements(conn, changes)
+                conn.commit()
+
+                success_message = f"✅ 已更新 {len(changes)} 筆庫存"
+                if unknown:
+                    success_message += f"（略過不存在的產品 ID：{', '.join(unknown)}）"
+            except Exception as e:
+                conn.rollback()
+                error_message = f"❌ 更新失敗：{e}"
+
+        # 單筆更新（舊版表單）
+        else:
+            try:
+                product_id = int(request.form.get("product_id", "0"))
+                new_stock = int(request.form.get("new_stock", "0"))
+                if new_stock < 0:
+                    new_stock = 0
+
+                cur.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
+                row = cur.fetchone()
+                if not row:
+                    raise ValueError(f"找不到產品 ID: {product_id}")
+                delta = new_stock - int(row["stock"] or 0)
+                record_movements(conn, [(product_id, delta, REASON_ADJUST, None, "庫存管理調整")])
+                conn.commit()
+                success_message = "✅ 庫存已更新"
+            except Exception as e:
+                conn.rollback()
+                error_message = f"❌ 更新失敗：{e}"
+
+    products = get_products()
+
+    # 對帳（快取 vs 帳本）+ 指定時間點的庫存
+    recon = {r["product_id"]: r for r in reconcile(conn)}
+    as_of = (request.args.get("as_of") or "").strip().replace("T", " ")
+    as_of_stock = None
+    if as_of:
+        if len(as_of) == 16:  # datetime-local 只有到分鐘
+            as_of += ":59"
+        as_of_stock = ledger_stock(conn, as_of)
     conn.close()
 
     return render_template(
         "manager/inventory.html",
         products=products,
+        recon=recon,
+        as_of=as_of,
+        as_of_stock=as_of_stock,
         error_message=error_message,
         success_message=success_message,
     )
@@ -87,6 +225,7 @@ def manager_process_templates():
     success_message = None
 
     conn = get_product_db()
+    ensure_process_template_schema(conn)
     cur = conn.cursor()
 
     if request.method == "POST":
@@ -119,8 +258,9 @@ def manager_process_templates():
                     """,
                     (step_order, step_name, station, description, estimated_time_sec),
                 )
+                version = create_version(conn, f"新增步驟 {step_order}：{step_name}")
                 conn.commit()
-                success_message = "✅ 已新增製程步驟"
+                success_message = f"✅ 已新增製程步驟（模板版本 v{version}）"
             except Exception as e:
                 conn.rollback()
                 error_message = f"❌ 新增失敗：{e}"
@@ -151,8 +291,12 @@ def manager_process_templates():
                         )
                         changed += 1
 
+                # 有變更才建立新版本（進行中的訂單仍用原本的版本）
+                version = create_version(conn, f"批次更新 {changed} 筆秒數") if changed else None
                 conn.commit()
                 success_message = f"✅ 已更新 {changed} 筆秒數"
+                if version:
+                    success_message += f"（模板版本 v{version}）"
             except Exception as e:
                 conn.rollback()
                 error_message = f"❌ 更新失敗：{e}"
@@ -165,43 +309,51 @@ def manager_process_templates():
         """
     )
     steps = cur.fetchall()
+    version = current_version(conn)
+    versions = list_versions(conn)
     conn.close()
 
     return render_template(
         "manager/process_templates.html",
         steps=steps,
+        version=version,
+        versions=versions,
         error_message=error_message,
         success_message=success_message,
     )
 
 
 # -----------------------------
-# ✅ 訂單總覽（支援 rowid 搜尋 + step 篩選 + 勾選顯示 rejected/cancelled/completed）
-# 預設只顯示 active
+# 訂單查詢共用：欄位 + 篩選條件（訂單總覽 / 匯出都用這組）
 # -----------------------------
-@manager_bp.route("/orders", methods=["GET"])
-@manager_required
-def manager_orders():
-    q = request.args.get("q", "").strip()
-    step = request.args.get("step", "").strip()
+_ORDER_COLUMNS = """
+    rowid AS id,
+    order_id, date, customer_name, product, amount, total_price,
+    step_name, note, status, rejected_at, cancelled_at
+"""
 
-    # ✅ 三個勾選：顯示 rejected / cancelled / completed
-    show_rejected = request.args.get("show_rejected") == "1"
-    show_cancelled = request.args.get("show_cancelled") == "1"
-    show_completed = request.args.get("show_completed") == "1"
+# 匯出時的欄位順序（和 _ORDER_COLUMNS 一致）
+_EXPORT_FIELDS = [
+    "id", "order_id", "date", "customer_name", "product", "amount", "total_price",
+    "step_name", "note", "status", "rejected_at", "cancelled_at",
+]
+_EXPORT_FETCH_SIZE = 1000
 
-    conn = get_order_mgmt_db()
-    ensure_order_list_schema(conn)
-    cur = conn.cursor()
 
-    base_sql = """
-        SELECT
-            rowid AS id,
-            order_id, date, customer_name, product, amount, total_price,
-            step_name, note, status, rejected_at, cancelled_at
-        FROM order_list
-        WHERE 1=1
+def _order_filters(args):
+    """
+    從 query string 讀出 q / step / show_* 條件，
+    回傳 (filters, where_sql, params)；訂單總覽與匯出共用同一套條件。
     """
+    q = args.get("q", "").strip()
+    step = args.get("step", "").strip()
+
+    # ✅ 三個勾選：顯示 rejected / cancelled / completed
+    show_rejected = args.get("show_rejected") == "1"
+    show_cancelled = args.get("show_cancelled") == "1"
+    show_completed = args.get("show_completed") == "1"
+
+    where_sql = " WHERE 1=1 "
     params = []
 
     # ✅ status：預設只 active，勾選才加入 rejected/cancelled/completed
@@ -213,14 +365,14 @@ def manager_orders():
     if show_completed:
         allowed_status.append("completed")
 
-    base_sql += f" AND status IN ({','.join(['?'] * len(allowed_status))}) "
+    where_sql += f" AND status IN ({','.join(['?'] * len(allowed_status))}) "
     params.extend(allowed_status)
 
     # ✅ 搜尋（訂單ID / 客戶 / 產品 / 備註 / ID(rowid)）
     if q:
         like = f"%{q}%"
         if q.isdigit():
-            base_sql += """
+            where_sql += """
               AND (
                 rowid = ?
                 OR order_id LIKE ?
@@ -231,7 +383,7 @@ def manager_orders():
             """
             params += [int(q), like, like, like, like]
         else:
-            base_sql += """
+            where_sql += """
               AND (
                 order_id LIKE ?
                 OR customer_name LIKE ?
@@ -243,12 +395,33 @@ def manager_orders():
 
     # ✅ step 篩選
     if step:
-        base_sql += " AND step_name = ?"
+        where_sql += " AND step_name = ?"
         params.append(step)
 
-    base_sql += " ORDER BY date DESC"
+    filters = {
+        "q": q,
+        "step": step,
+        "show_rejected": show_rejected,
+        "show_cancelled": show_cancelled,
+        "show_completed": show_completed,
+    }
+    return filters, where_sql, params
+
+
+# -----------------------------
+# ✅ 訂單總覽（支援 rowid 搜尋 + step 篩選 + 勾選顯示 rejected/cancelled/completed）
+# 預設只顯示 active
+# -----------------------------
+@manager_bp.route("/orders", methods=["GET"])
+@manager_required
+def manager_orders():
+    filters, where_sql, params = _order_filters(request.args)
+
+    conn = get_order_mgmt_db()
+    ensure_order_list_schema(conn)
+    cur = conn.cursor()
 
-    cur.execute(base_sql, params)
+    cur.execute(f"SELECT {_ORDER_COLUMNS} FROM order_list {where_sql} ORDER BY date_ms DESC", params)
     orders = cur.fetchall()
 
     # step 下拉選單（抓所有不同 step_name）
@@ -267,12 +440,59 @@ def manager_orders():
     return render_template(
         "manager/orders.html",
         orders=orders,
-        q=q,
-        step=step,
         steps=steps,
-        show_rejected=show_rejected,
-        show_cancelled=show_cancelled,
-        show_completed=show_completed,  # ✅ 一定要傳給前端
+        **filters,  # ✅ q / step / show_* 一定要傳給前端
+    )
+
+
+# -----------------------------
+# ✅ 訂單匯出（CSV / NDJSON），條件和訂單總覽相同
+# 直接從 cursor fetchmany 串流輸出，不會把整張表讀進記憶體
+# -----------------------------
+@manager_bp.route("/orders/export", methods=["GET"])
+@manager_required
+def manager_orders_export():
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in ("csv", "ndjson"):
+        fmt = "csv"
+
+    _, where_sql, params = _order_filters(request.args)
+
+    conn = get_order_mgmt_db()
+    ensure_order_list_schema(conn)
+    cur = conn.cursor()
+    cur.execute(f"SELECT {_ORDER_COLUMNS} FROM order_list {where_sql} ORDER BY date_ms DESC", params)
+
+    def generate():
+        try:
+            if fmt == "csv":
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                # BOM 讓 Excel 正確判斷 UTF-8（中文客戶名 / 備註）
+                writer.writerow(_EXPORT_FIELDS)
+                yield "\ufeff" + buf.getvalue()
+
+            while True:
+                rows = cur.fetchmany(_EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+
+                if fmt == "csv":
+                    buf.seek(0)
+                    buf.truncate()
+                    writer.writerows(tuple(r) for r in rows)
+                    yield buf.getvalue()
+                else:
+                    yield "".join(json.dumps(dict(r), ensure_ascii=False) + "\n" for r in rows)
+        finally:
+            conn.close()
+
+    filename = f"orders_{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(
+        generate(),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
 
 
@@ -283,22 +503,28 @@ def manager_order_detail(order_id):
     ensure_order_list_schema(conn)
     cur = conn.cursor()
 
-    cur.execute(
-        """
-        SELECT
-            rowid AS id,
-            order_id, date, customer_name, product, amount, total_price,
-            step_name, note, status, rejected_at, cancelled_at
-        FROM order_list
-        WHERE order_id = ?
-        """,
-        (order_id,),
-    )
+    cur.execute(f"SELECT {_ORDER_COLUMNS} FROM order_list WHERE order_id = ?", (order_id,))
     order = cur.fetchone()
     conn.close()
     return render_template("manager/order_detail.html", order=order)
 
 
+def _filter_redirect_kwargs(form):
+    """POST 表單帶回來的查詢條件 → redirect 回訂單總覽用的 kwargs"""
+    q = (form.get("q") or "").strip()
+    step = (form.get("step") or "").strip()
+
+    kwargs = {}
+    if q:
+        kwargs["q"] = q
+    if step:
+        kwargs["step"] = step
+    for key in ("show_rejected", "show_cancelled", "show_completed"):
+        if (form.get(key) or "") == "1":
+            kwargs[key] = "1"
+    return kwargs
+
+
 # ✅ 管理者：拒絕訂單（保留紀錄）
 # ✅ 重點：cancelled / completed 的單不能再拒絕
 @manager_bp.route("/orders/<order_id>/delete", methods=["POST"])
@@ -310,23 +536,7 @@ def manager_order_delete(order_id):
         return redirect(url_for("manager.manager_orders"))
 
     # ✅ 保留原查詢條件 + 勾選狀態
-    q = (request.form.get("q") or "").strip()
-    step = (request.form.get("step") or "").strip()
-    show_rejected = (request.form.get("show_rejected") or "") == "1"
-    show_cancelled = (request.form.get("show_cancelled") or "") == "1"
-    show_completed = (request.form.get("show_completed") or "") == "1"
-
-    kwargs = {}
-    if q:
-        kwargs["q"] = q
-    if step:
-        kwargs["step"] = step
-    if show_rejected:
-        kwargs["show_rejected"] = "1"
-    if show_cancelled:
-        kwargs["show_cancelled"] = "1"
-    if show_completed:
-        kwargs["show_completed"] = "1"
+    kwargs = _filter_redirect_kwargs(request.form)
 
     conn = get_order_mgmt_db()
     ensure_order_list_schema(conn)
@@ -358,20 +568,540 @@ def manager_order_delete(order_id):
         return redirect(url_for("manager.manager_orders", **kwargs))
 
     note_text = f"你的訂單已被工廠拒絕：{reason}"
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.now()
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
     cur.execute(
         """
         UPDATE order_list
         SET status = 'rejected',
             note = ?,
-            rejected_at = ?
+            rejected_at = ?,
+            rejected_at_ms = ?
         WHERE order_id = ?
         """,
-        (note_text, now_str, order_id),
+        (note_text, now_str, to_ms(now), order_id),
     )
-    conn.commit()
-    conn.close()
+
+    # 拒絕 → 把這張訂單扣掉的庫存加回來
+    conn_prod = get_product_db()
+    try:
+        ensure_inventory_schema(conn_prod)
+        restock_orders(conn_prod, [order_id], REASON_REJECT, note_text)
+        conn_prod.commit()
+        conn.commit()
+        floor.order_closed(order_id)
+        admission.order_closed(order_id)
+        invalidate_plan()
+    except Exception:
+        conn_prod.rollback()
+        conn.rollback()
+        raise
+    finally:
+        conn_prod.close()
+        conn.close()
 
     flash("✅ 已拒絕訂單（保留紀錄）", "success")
     return redirect(url_for("manager.manager_orders", **kwargs))
+
+
+# ✅ 管理者：批次拒絕 / 批次完成（訂單總覽勾選多筆）
+# 一條 UPDATE ... IN (...) AND status='active' RETURNING 完成轉換並取回實際改到的訂單（回補、收尾、回報都只看這些），只 commit 一次
+_BULK_ACTIONS = {
+    # action: (新狀態, 時間欄位)
+    "reject": ("rejected", "rejected_at"),
+    "complete": ("completed", None),
+}
+
+
+@manager_bp.route("/orders/bulk", methods=["POST"])
+@manager_required
+def manager_orders_bulk():
+    wants_json = request.is_json or request.accept_mimetypes.best == "application/json"
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+
+    action = (data.get("action") or "").strip()
+    reason = (data.get("reason") or "").strip()
+    if request.is_json:
+        order_ids = [str(x).strip() for x in (data.get("order_ids") or [])]
+    else:
+        order_ids = [x.strip() for x in request.form.getlist("order_ids")]
+    # 去重但保留順序
+    order_ids = list(dict.fromkeys(x for x in order_ids if x))
+
+    kwargs = _filter_redirect_kwargs(data)
+
+    error = None
+    if action not in _BULK_ACTIONS:
+        error = "❌ 未知的批次操作"
+    elif not order_ids:
+        error = "❌ 請至少勾選一筆訂單"
+    elif action == "reject" and not reason:
+        error = "❌ 請選擇拒絕原因"
+
+    if error:
+        if wants_json:
+            return jsonify({"success": False, "message": error}), 400
+        flash(error, "danger")
+        return redirect(url_for("manager.manager_orders", **kwargs))
+
+    new_status, ts_col = _BULK_ACTIONS[action]
+    placeholders = ",".join(["?"] * len(order_ids))
+    now = datetime.now()
+
+    conn = get_order_mgmt_db()
+    ensure_order_list_schema(conn)
+    cur = conn.cursor()
+    conn_prod = get_product_db()
+    try:
+        ensure_inventory_schema(conn_prod)
+        set_sql = "status = ?"
+        params = [new_status]
+        if action == "reject":
+            set_sql += ", note = ?"
+            params.append(f"你的訂單已被工廠拒絕：{reason}")
+        if ts_col:
+            # TEXT 欄位給畫面顯示，_ms 欄位給查詢 / 統計
+            set_sql += f", {ts_col} = ?, {ts_col}_ms = ?"
+            params += [now.strftime("%Y-%m-%d %H:%M:%S"), to_ms(now)]
+
+        # 以 UPDATE 實際改到的訂單為準（先 SELECT 再 UPDATE 時，中間被別的 request 改掉的會被誤算進來）
+        cur.execute(
+            f"""
+            UPDATE order_list
+            SET {set_sql}
+            WHERE order_id IN ({placeholders}) AND status = 'active'
+            RETURNING order_id
+            """,
+            params + order_ids,
+        )
+        changed = {r["order_id"] for r in cur.fetchall()}
+        targets = [oid for oid in order_ids if oid in changed]
+
+        # 沒改到的訂單：同一個寫入 transaction 內讀目前狀態（回報 skipped 的原因）
+        cur.execute(
+            f"SELECT order_id, status FROM order_list WHERE order_id IN ({placeholders})",
+            order_ids,
+        )
+        current = {r["order_id"]: (r["status"] or "active") for r in cur.fetchall()}
+
+        # 批次拒絕 → 一次回補實際拒絕的訂單庫存
+        if action == "reject" and targets:
+            restock_orders(conn_prod, targets, REASON_REJECT, f"批次拒絕：{reason}")
+        conn_prod.commit()
+        conn.commit()
+        for oid in targets:
+            floor.order_closed(oid)
+            admission.order_closed(oid)
+        invalidate_plan()
+    except Exception as e:
+        conn_prod.rollback()
+        conn.rollback()
+        conn_prod.close()
+        conn.close()
+        if wants_json:
+            return jsonify({"success": False, "message": f"批次操作失敗：{e}"}), 500
+        flash(f"❌ 批次操作失敗：{e}", "danger")
+        return redirect(url_for("manager.manager_orders", **kwargs))
+    conn_prod.close()
+    conn.close()
+
+    # 每筆訂單的結果：rejected / completed / not_found / skipped:<原狀態>
+    outcomes = {}
+    for oid in order_ids:
+        if oid in changed:
+            outcomes[oid] = new_status
+        elif oid not in current:
+            outcomes[oid] = "not_found"
+        else:
+            outcomes[oid] = f"skipped:{current[oid]}"
+
+    done = [oid for oid, out in outcomes.items() if out == new_status]
+    skipped = [oid for oid, out in outcomes.items() if out != new_status]
+
+    if wants_json:
+        return jsonify({"success": True, "action": action, "changed": len(done), "outcomes": outcomes})
+
+    label = "拒絕" if action == "reject" else "完成"
+    flash(f"✅ 已批次{label} {len(done)} 筆訂單", "success")
+    if skipped:
+        detail = "、".join(f"{oid}（{outcomes[oid]}）" for oid in skipped)
+        flash(f"以下訂單未變更：{detail}", "warning")
+    return redirect(url_for("manager.manager_orders", **kwargs))
+
+
+# -----------------------------
+# ✅ 批次匯入訂單（ERP 用，CSV / NDJSON）
+# 回應是 NDJSON：每一筆一行結果，最後一行是 summary
+# -----------------------------
+@manager_bp.route("/orders/import", methods=["POST"])
+@manager_required
+def manager_orders_import():
+    upload = request.files.get("file")
+    if upload:
+        # 上傳檔在 view return 後就會被 Flask 關掉，先轉存到暫存檔（在磁碟上，不佔記憶體）
+        stream = tempfile.TemporaryFile()
+        shutil.copyfileobj(upload.stream, stream)
+        stream.seek(0)
+        fmt = request.form.get("format") or detect_format(upload.filename, upload.mimetype)
+    else:
+        # 也允許直接把檔案內容當 request body 丟上來
+        stream = request.stream
+        fmt = request.args.get("format") or detect_format(content_type=request.content_type)
+
+    try:
+        chunk_size = int(request.args.get("chunk_size") or DEFAULT_CHUNK_SIZE)
+    except ValueError:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
+    # 和結帳同一個產能控管水位
+    horizon = float(current_app.config.get("FACTORY_ADMISSION_HORIZON_SEC", DEFAULT_HORIZON_SEC))
+
+    def generate():
+        ok = failed = 0
+        try:
+            for result in import_orders(iter_import_rows(stream, fmt), chunk_size=chunk_size, horizon_sec=horizon):
+                if result["ok"]:
+                    ok += 1
+                else:
+                    failed += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            if upload:
+                stream.close()
+        yield json.dumps({"summary": True, "imported": ok, "failed": failed}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# -----------------------------
+# ✅ 產線看板：各站目前的訂單 / 件號 / 步驟 / 剩餘時間 + 排隊件數
+# 第一次載入給 snapshot，之後前端用 ?since=<seq> 輪詢增量事件（資料來自 core/floor_state.py 的記憶體狀態）
+# -----------------------------
+def _load_floor():
+    conn_order = get_order_mgmt_db()
+    conn_prod = get_product_db()
+    try:
+        _ensure_tables(conn_order)
+        if not floor.loaded:
+            # 看板從 DB 建初始狀態，先把記憶體模型還沒寫回的變動寫進去
+            factory_model.flush(conn_order)
+        floor.ensure_loaded(conn_order, conn_prod)
+    finally:
+        conn_order.close()
+        conn_prod.close()
+
+
+@manager_bp.route("/floor", methods=["GET"])
+@manager_required
+def manager_floor():
+    _load_floor()
+    return render_template("manager/floor.html", snapshot=floor.snapshot())
+
+
+@manager_bp.route("/api/floor", methods=["GET"])
+@manager_required
+def manager_floor_api():
+    _load_floor()
+    since = request.args.get("since", type=int)
+    if since is not None:
+        events = floor.events_since(since)
+        if events is not None:
+            return jsonify({"seq": events[-1]["seq"] if events else since, "events": events})
+    # 第一次載入，或落後太多（事件已被擠出緩衝）→ 送完整 snapshot
+    return jsonify({"snapshot": floor.snapshot()})
+
+
+# -----------------------------
+# ✅ 站點停機 / 異常件：排定或提前結束停機時段，超過重試上限的件重新排程
+# 停機中的站點不派工，正在做的件會退回排隊（見 core/factory_routes.py）
+# -----------------------------
+@manager_bp.route("/stations", methods=["GET", "POST"])
+@manager_required
+def manager_stations():
+    error_message = None
+    success_message = None
+
+    conn_order = get_order_mgmt_db()
+    conn_prod = get_product_db()
+    try:
+        _ensure_tables(conn_order)
+
+        if request.method == "POST":
+            action = request.form.get("action", "")
+
+            # ✅ 新增停機時段（開始時間空白 = 立即）
+            if action == "add_downtime":
+                try:
+                    station = (request.form.get("station") or "").strip()
+                    minutes = int((request.form.get("minutes") or "0").strip() or 0)
+                    reason = (request.form.get("reason") or "").strip()
+                    start_text = (request.form.get("start") or "").strip()
+                    if not station:
+                        raise ValueError("請選擇站點")
+                    if minutes <= 0:
+                        raise ValueError("停機分鐘數必須為正整數")
+                    start_ms = to_ms(start_text) if start_text else now_ms()
+                    if start_ms is None:
+                        raise ValueError(f"時間格式錯誤：{start_text}")
+
+                    add_downtime(conn_order, station, start_ms, start_ms + minutes * 60 * 1000, reason)
+                    conn_order.commit()
+                    invalidate_plan()
+                    invalidate_ticks()
+                    success_message = f"✅ 已排定 {station} 停機 {minutes} 分鐘"
+                except Exception as e:
+                    conn_order.rollback()
+                    error_message = f"❌ 新增停機失敗：{e}"
+
+            # ✅ 提前結束 / 取消停機
+            elif action == "end_downtime":
+                try:
+                    end_downtime(conn_order, int(request.form.get("downtime_id") or 0), now_ms())
+                    conn_order.commit()
+                    invalidate_plan()
+                    invalidate_ticks()
+                    success_message = "✅ 已結束停機時段"
+                except Exception as e:
+                    conn_order.rollback()
+                    error_message = f"❌ 結束停機失敗：{e}"
+
+            # ✅ 異常件重新排程
+            elif action == "retry":
+                order_id = (request.form.get("order_id") or "").strip()
+                retried = _retry_order_errors(conn_order, conn_prod, order_id)
+                if retried is None:
+                    error_message = f"❌ 找不到訂單 {order_id}"
+                else:
+                    success_message = f"✅ 訂單 {order_id} 已重新排程 {retried} 件"
+
+        stations = sorted(
+            {r["station"] for r in conn_order.execute("SELECT station FROM station_state")}
+            | {r["station"] for r in conn_prod.execute(
+                "SELECT DISTINCT station FROM standard_process WHERE station IS NOT NULL AND station <> ''"
+            )}
+        )
+        downtime = list_downtime(conn_order, now_ms())
+
+        # 異常件以 DB 為準，先把記憶體模型還沒寫回的變動寫進去
+        factory_model.flush(conn_order)
+        error_orders = conn_order.execute("""
+            SELECT order_id, COUNT(*) AS pieces, MAX(attempts) AS attempts
+            FROM piece_step_progress
+            WHERE state='error'
+            GROUP BY order_id
+            ORDER BY order_id
+        """).fetchall()
+    finally:
+        conn_order.close()
+        conn_prod.close()
+
+    return render_template(
+        "manager/stations.html",
+        stations=stations,
+        downtime=downtime,
+        error_orders=error_orders,
+        error_message=error_message,
+        success_message=success_message,
+    )
+
+
+# -----------------------------
+# ✅ 產線指標報表：站點稼動率 / 步驟 cycle time 百分位數 / 排隊等待 / WIP
+# 計算在 core/factory_metrics.py（NumPy + 依時間 bucket 快取）
+# -----------------------------
+# 報表可選的時間窗（分鐘）與 bucket 長度（秒）
+METRICS_WINDOWS = (15, 60, 240, 1440)
+METRICS_BUCKETS = (60, 300, 900, 3600)
+
+
+def _metrics_args(args):
+    window_min = args.get("window", type=int) or DEFAULT_WINDOW_SEC // 60
+    bucket_sec = args.get("bucket", type=int) or DEFAULT_BUCKET_SEC
+    if window_min not in METRICS_WINDOWS:
+        window_min = DEFAULT_WINDOW_SEC // 60
+    if bucket_sec not in METRICS_BUCKETS:
+        bucket_sec = DEFAULT_BUCKET_SEC
+    return window_min, min(bucket_sec, window_min * 60)
+
+
+def _load_metrics(window_min: int, bucket_sec: int) -> dict:
+    conn_order = get_order_mgmt_db()
+    conn_prod = get_product_db()
+    try:
+        ensure_order_list_schema(conn_order)
+        _ensure_tables(conn_order)
+        factory_model.flush(conn_order)
+        return compute_metrics(conn_order, conn_prod, window_sec=window_min * 60, bucket_sec=bucket_sec)
+    finally:
+        conn_order.close()
+        conn_prod.close()
+
+
+@manager_bp.route("/metrics", methods=["GET"])
+@manager_required
+def manager_metrics():
+    window_min, bucket_sec = _metrics_args(request.args)
+    return render_template(
+        "manager/metrics.html",
+        metrics=_load_metrics(window_min, bucket_sec),
+        window_min=window_min,
+        bucket_sec=bucket_sec,
+        windows=METRICS_WINDOWS,
+        buckets=METRICS_BUCKETS,
+    )
+
+
+@manager_bp.route("/api/metrics", methods=["GET"])
+@manager_required
+def manager_metrics_api():
+    window_min, bucket_sec = _metrics_args(request.args)
+    return jsonify(_load_metrics(window_min, bucket_sec))
+
+
+# -----------------------------
+# ✅ 產能規劃：active 訂單剩餘的件投影到未來 N 天的時間 bucket，列出超載的 bucket
+# 計算在 core/capacity_plan.py（NumPy + 快取，訂單 / 停機異動時失效）
+# -----------------------------
+PLAN_DAYS = (1, 3, 7, 14)
+PLAN_BUCKETS = (900, 3600, 4 * 3600, 24 * 3600)
+# 頁面最多列出幾個超載 bucket（完整資料看 JSON）
+PLAN_MAX_ROWS = 200
+
+
+def _plan_args(args):
+    days = args.get("days", type=int) or PLAN_DEFAULT_DAYS
+    bucket_sec = args.get("bucket", type=int) or PLAN_DEFAULT_BUCKET_SEC
+    if days not in PLAN_DAYS:
+        days = PLAN_DEFAULT_DAYS
+    if bucket_sec not in PLAN_BUCKETS:
+        bucket_sec = PLAN_DEFAULT_BUCKET_SEC
+    return days, bucket_sec
+
+
+def _load_plan(days: int, bucket_sec: int) -> dict:
+    conn_order = get_order_mgmt_db()
+    conn_prod = get_product_db()
+    try:
+        ensure_order_list_schema(conn_order)
+        _ensure_tables(conn_order)
+        return compute_plan(conn_order, conn_prod, days=days, bucket_sec=bucket_sec)
+    finally:
+        conn_order.close()
+        conn_prod.close()
+
+
+@manager_bp.route("/capacity", methods=["GET"])
+@manager_required
+def manager_capacity():
+    days, bucket_sec = _plan_args(request.args)
+    return render_template(
+        "manager/capacity.html",
+        plan=_load_plan(days, bucket_sec),
+        days=days,
+        bucket_sec=bucket_sec,
+        days_options=PLAN_DAYS,
+        buckets=PLAN_BUCKETS,
+        max_rows=PLAN_MAX_ROWS,
+    )
+
+
+@manager_bp.route("/api/capacity", methods=["GET"])
+@manager_required
+def manager_capacity_api():
+    days, bucket_sec = _plan_args(request.args)
+    return jsonify(_load_plan(days, bucket_sec))
+
+
+# -----------------------------
+# ✅ 執行時序匯出（Chrome trace-event JSON）：一張訂單，或一段時間窗（start / end）
+# 沒帶任何條件時匯出最近一小時
+# -----------------------------
+def _parse_trace_time(value):
+    """接受 datetime-local（YYYY-MM-DDTHH:MM）或 YYYY-MM-DD HH:MM:SS"""
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"時間格式錯誤：{value}")
+
+
+@manager_bp.route("/trace", methods=["GET"])
+@manager_required
+def manager_trace_export():
+    order_id = (request.args.get("order_id") or "").strip() or None
+    start = _parse_trace_time(request.args.get("start"))
+    end = _parse_trace_time(request.args.get("end"))
+    if not order_id and start is None and end is None:
+        end = from_ms(now_ms())  # 產線事件用模擬時鐘（快轉後也看得到最近一小時）
+        start = end - timedelta(hours=1)
+
+    conn_order = get_order_mgmt_db()
+    conn_prod = get_product_db()
+    ensure_order_list_schema(conn_order)
+    _ensure_tables(conn_order)
+    factory_model.flush(conn_order)
+
+    def generate():
+        try:
+            yield from iter_trace(conn_order, conn_prod, order_id=order_id, start=start, end=end)
+        finally:
+            conn_order.close()
+            conn_prod.close()
+
+    label = order_id or (start or end).strftime("%Y%m%d%H%M%S")
+    return Response(
+        generate(),
+        mimetype="application/json",
+        headers={"Content-Disposition": f"attachment; filename=trace_{label}.json"},
+    )
+
+
+@manager_bp.cli.command("import-orders")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default=None, help="預設依副檔名判斷")
+@click.option("--chunk-size", default=DEFAULT_CHUNK_SIZE, show_default=True, help="每幾筆 commit 一次")
+def import_orders_command(path, fmt, chunk_size):
+    """批次匯入訂單：flask manager import-orders orders.csv"""
+    fmt = fmt or detect_format(path)
+    ok = failed = 0
+    with open(path, "rb") as f:
+        for result in import_orders(iter_import_rows(f, fmt), chunk_size=chunk_size):
+            if result["ok"]:
+                ok += 1
+                click.echo(f"line {result['line']}: OK {result['order_id']}")
+            else:
+                failed += 1
+                click.echo(f"line {result['line']}: FAILED {result['message']}", err=True)
+    click.echo(f"匯入完成：成功 {ok} 筆，失敗 {failed} 筆")
+
+
+@manager_bp.cli.command("stock-snapshot")
+def stock_snapshot_command():
+    """拍一次庫存 snapshot（可排進 cron 定期執行）"""
+    conn = get_product_db()
+    try:
+        ensure_inventory_schema(conn)
+        snap_id = take_snapshot(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo(f"已建立庫存 snapshot #{snap_id}")
+
+
+@manager_bp.cli.command("stock-reconcile")
+def stock_reconcile_command():
+    """對帳：列出 products.stock 和帳本不一致的產品"""
+    conn = get_product_db()
+    try:
+        ensure_inventory_schema(conn)
+        rows = reconcile(conn)
+    finally:
+        conn.close()
+
+    bad = [r for r in rows if r["diff"]]
+    for r in bad:
+        click.echo(f"#{r['product_id']} {r['name']}: products.stock={r['cached']} 帳本={r['ledger']} 差異={r['diff']}")
+    click.echo(f"對帳完成：{len(rows)} 個產品，{len(bad)} 個不一致")
@@ -0,0 +1,397 @@
+# core/order_import.py
+# 批次匯入訂單（ERP 一次丟上百筆用）：
+# - 逐行串流解析 CSV / NDJSON，不把整份檔案讀進記憶體
+# - 庫存與製程步驟先抓一次到記憶體 snapshot，逐筆驗證
+# - 每 chunk 筆用 executemany 一次寫入 order_list / order_items / products.stock / piece_step_progress；
+#   先 commit 訂單 DB 再 commit 庫存，庫存 commit 失敗時刪掉這個 chunk 的訂單（不會有扣了庫存卻沒有訂單的情況）
+# - 和結帳一樣經過產能控管（core/admission.py 的 try_admit）：加上這筆後任何一站的待做工作超過
+#   horizon_sec 就不匯入該筆，結果行帶 capacity_full / earliest_slot（ERP 可以晚點重送）
+# - 每一筆都回報結果（generator），呼叫端可以直接串流輸出
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .db import get_product_db, get_order_mgmt_db
+from .order_routes import ensure_order_items_schema, ensure_order_list_schema
+from .factory_routes import _ensure_tables, _parse_step_chain
+from .process_dag import RouteError, build_route, dumps_route, format_route, parse_stages, route_from_stages
+from .admission import DEFAULT_HORIZON_SEC, admission, order_work
+from .capacity_plan import invalidate as invalidate_plan
+from .floor_state import floor
+from .inventory import REASON_ORDER, ensure_inventory_schema, record_movements
+from .process_templates import current_version, ensure_process_template_schema, get_step_defs
+from .timeutil import fmt_ms, now_ms, to_ms
+
+DEFAULT_CHUNK_SIZE = 500
+IMPORT_NOTE = "ERP 批次匯入"
+
+# 欄位別名：ERP 匯出的欄位名稱不一定一致
+_FIELD_ALIASES = {
+    "customer": ("customer", "customer_name"),
+    "product_id": ("product_id", "id"),
+    "qty": ("qty", "quantity", "amount"),
+    "steps": ("steps", "step_chain", "step_name"),
+}
+
+
+class ImportRowError(ValueError):
+    """單筆資料驗證失敗（只影響該筆，不中斷整批匯入）"""
+
+
+def detect_format(filename: str = "", content_type: str = "") -> str:
+    """依副檔名 / Content-Type 判斷格式，預設 csv"""
+    name = (filename or "").lower()
+    ctype = (content_type or "").lower()
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in ctype or "jsonlines" in ctype:
+        return "ndjson"
+    return "csv"
+
+
+def iter_import_rows(stream, fmt: str) -> Iterator[Tuple[int, object]]:
+    """
+    串流讀取上傳內容，一次 yield 一筆 (line_no, row)。
+    - stream 可以是 bytes 或 text 的 file-like 物件
+    - NDJSON 某行不是合法 JSON 時，row 會是 ImportRowError（交給下游回報）
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+    if fmt == "ndjson":
+        for line_no, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, ImportRowError(f"JSON 格式錯誤：{e}")
+                continue
+            if not isinstance(row, dict):
+                yield line_no, ImportRowError("每一行必須是 JSON 物件")
+                continue
+            yield line_no, row
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # line_num 是目前讀到的實際行號（含標題列）
+            yield reader.line_num, row
+
+
+def _pick(row: dict, field: str):
+    for key in _FIELD_ALIASES[field]:
+        if key in row and row[key] not in (None, ""):
+            return row[key]
+    return None
+
+
+def _parse_steps(raw) -> List[int]:
+    if isinstance(raw, list):
+        try:
+            return [int(x) for x in raw]
+        except (TypeError, ValueError):
+            raise ImportRowError("steps 必須是整數陣列")
+    return _parse_step_chain(str(raw or ""))
+
+
+def _parse_route(row: dict):
+    """
+    製程路線：
+    - steps 字串可用「|」表示並行，例如 "1 -> 4 | 5 -> 9"
+    - steps 陣列為線性流程
+    - 另外給 step_deps（{"9": [4, 5]}，JSON 物件或字串）時以它為準
+    """
+    raw = _pick(row, "steps")
+    chain = _parse_steps(raw)
+    deps = row.get("step_deps")
+    try:
+        if isinstance(deps, str) and deps.strip():
+            deps = json.loads(deps)
+        if deps:
+            if not isinstance(deps, dict):
+                raise ImportRowError("step_deps 必須是 JSON 物件")
+            return build_route(chain, deps)
+        if isinstance(raw, list):
+            return build_route(chain)
+        return route_from_stages(parse_stages(str(raw or "")))
+    except ImportRowError:
+        raise
+    except (RouteError, ValueError) as e:
+        raise ImportRowError(f"製程路線錯誤：{e}")
+
+
+class _OrderIdAllocator:
+    """
+    和 generate_order_id 同格式（YYYYMMDDHHMM + 3 位流水號），
+    但流水號只查一次 DB，之後在記憶體遞增，避免同一分鐘內大量匯入時重複查詢。
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.prefix: Optional[str] = None
+        self.seq = 0
+
+    def next_id(self) -> str:
+        prefix = datetime.now().strftime("%Y%m%d%H%M")
+        if prefix != self.prefix:
+            self.prefix = prefix
+            self.seq = 0
+            # 流水號可能超過 3 位，用 LENGTH 排序才抓得到真正最大值
+            row = self.conn.execute(
+                """
+                SELECT order_id FROM order_list
+                WHERE order_id LIKE ?
+                ORDER BY LENGTH(order_id) DESC, order_id DESC
+                LIMIT 1
+                """,
+                (f"{prefix}%",),
+            ).fetchone()
+            if row:
+                try:
+                    self.seq = int(row["order_id"][len(prefix):])
+                except ValueError:
+                    self.seq = 0
+        self.seq += 1
+        return f"{self.prefix}{str(self.seq).zfill(3)}"
+
+
+def import_orders(
+    rows: Iterable[Tuple[int, object]],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    horizon_sec: float = DEFAULT_HORIZON_SEC,
+) -> Iterator[dict]:
+    """
+    匯入訂單並逐筆 yield 結果：
+      {"line": 3, "ok": True, "order_id": "..."} 或 {"line": 4, "ok": False, "message": "..."}
+      產能已滿：{"line": 5, "ok": False, "capacity_full": True, "earliest_slot": "...", "message": "..."}
+
+    - 驗證失敗的列立即回報；通過的列先累積到 chunk，整個 chunk 寫入並 commit 後才回報 ok
+    - 某個 chunk 寫入失敗時整個 chunk rollback，記憶體中的庫存 snapshot 也一起還原
+    """
+    chunk_size = max(1, int(chunk_size or DEFAULT_CHUNK_SIZE))
+
+    conn_prod = get_product_db()
+    conn_order = get_order_mgmt_db()
+    try:
+        ensure_order_list_schema(conn_order)
+        ensure_order_items_schema(conn_order)
+        _ensure_tables(conn_order)
+        ensure_inventory_schema(conn_prod)
+        ensure_process_template_schema(conn_prod)
+
+        # 產品 / 製程步驟都很小，一次載入到記憶體
+        products: Dict[int, dict] = {
+            int(r["id"]): {
+                "name": r["name"],
+                "base_price": r["base_price"] or 0,
+                "stock": int(r["stock"] or 0),
+            }
+            for r in conn_prod.execute("SELECT id, name, base_price, stock FROM products")
+        }
+        # 整批訂單都固定在匯入當下的製程模板版本
+        process_version = current_version(conn_prod)
+        valid_steps = set(get_step_defs(conn_prod, process_version))
+
+        id_alloc = _OrderIdAllocator(conn_order)
+        pending: List[dict] = []
+        # chunk 開始前的庫存，失敗時用來還原
+        stock_before: Dict[int, int] = {}
+
+        def flush() -> Iterator[dict]:
+            if not pending:
+                return
+            try:
+                _write_chunk(conn_prod, conn_order, pending)
+                # 先 commit 訂單 DB：失敗時兩邊都還沒生效，直接 rollback
+                conn_order.commit()
+                try:
+                    conn_prod.commit()
+                except Exception:
+                    # 訂單已寫入但扣庫存沒生效：把這個 chunk 的訂單刪掉，不留下沒扣庫存的訂單
+                    conn_prod.rollback()
+                    _undo_chunk(conn_order, pending)
+                    raise
+                # 大量新增 piece rows：看板下次讀取時直接從 SQL 重建（產能控管在 try_admit 時已經預留）
+                floor.invalidate()
+                invalidate_plan()
+                results = [{"line": p["line"], "ok": True, "order_id": p["order_id"]} for p in pending]
+            except Exception as e:
+                conn_prod.rollback()
+                conn_order.rollback()
+                for pid, stock in stock_before.items():
+                    products[pid]["stock"] = stock
+                # 產能控管已經預留的工作也要放掉
+                for p in pending:
+                    admission.order_closed(p["order_id"])
+                results = [{"line": p["line"], "ok": False, "message": f"寫入失敗：{e}"} for p in pending]
+            pending.clear()
+            stock_before.clear()
+            yield from results
+
+        for line_no, row in rows:
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                order = _validate_row(row, products, valid_steps)
+            except ImportRowError as e:
+                yield {"line": line_no, "ok": False, "message": str(e)}
+                continue
+
+            order_id = id_alloc.next_id()
+            work = order_work(conn_prod, process_version, [(order["qty"], order["route"])])
+            admission.ensure_loaded(conn_order, conn_prod)
+            earliest = admission.try_admit(conn_order, order_id, work, horizon_sec, now_ms())
+            if earliest is not None:
+                yield {
+                    "line": line_no,
+                    "ok": False,
+                    "capacity_full": True,
+                    "earliest_slot": fmt_ms(earliest),
+                    "message": f"產線產能已滿，最早可下單時間約為 {fmt_ms(earliest)}",
+                }
+                continue
+
+            pid = order["product_id"]
+            stock_before.setdefault(pid, products[pid]["stock"])
+            products[pid]["stock"] -= order["qty"]
+
+            order["line"] = line_no
+            order["order_id"] = order_id
+            order["process_version"] = process_version
+            pending.append(order)
+
+            if len(pending) >= chunk_size:
+                yield from flush()
+
+        yield from flush()
+
+    finally:
+        conn_prod.close()
+        conn_order.close()
+
+
+def _validate_row(row: dict, products: Dict[int, dict], valid_steps: set) -> dict:
+    customer = str(_pick(row, "customer") or "").strip()
+    if not customer:
+        raise ImportRowError("缺少 customer")
+
+    try:
+        product_id = int(_pick(row, "product_id"))
+    except (TypeError, ValueError):
+        raise ImportRowError("product_id 必須是整數")
+    prod = products.get(product_id)
+    if not prod:
+        raise ImportRowError(f"找不到產品 ID: {product_id}")
+
+    try:
+        qty = int(_pick(row, "qty"))
+    except (TypeError, ValueError):
+        raise ImportRowError("qty 必須是整數")
+    if qty <= 0:
+        raise ImportRowError("qty 必須大於 0")
+
+    route = _parse_route(row)
+    if not route:
+        raise ImportRowError("缺少製程步驟（steps）")
+    unknown = [s for s in route if s not in valid_steps]
+    if unknown:
+        raise ImportRowError(f"未知的製程步驟：{unknown}")
+
+    if prod["stock"] < qty:
+        raise ImportRowError(f"產品 {prod['name']} 庫存不足 (剩餘 {prod['stock']})")
+
+    return {
+        "customer": customer,
+        "product_id": product_id,
+        "product_name": prod["name"],
+        "qty": qty,
+        "total_price": prod["base_price"] * qty,
+        "route": route,
+    }
+
+
+def _undo_chunk(conn_order, orders: List[dict]) -> None:
+    """已 commit 的 chunk 訂單整批刪掉並 commit（扣庫存寫入失敗時用）"""
+    ids = [(o["order_id"],) for o in orders]
+    conn_order.executemany("DELETE FROM piece_step_progress WHERE order_id = ?", ids)
+    conn_order.executemany("DELETE FROM order_items WHERE order_id = ?", ids)
+    conn_order.executemany("DELETE FROM order_list WHERE order_id = ?", ids)
+    conn_order.commit()
+
+
+def _write_chunk(conn_prod, conn_order, orders: List[dict]) -> None:
+    """一個 chunk：訂單 / 品項 / 庫存帳本 / piece rows 各一次 executemany，不 commit（交給呼叫端）"""
+    now = datetime.now()
+    order_date = now.strftime("%Y-%m-%d %H:%M:%S")
+    order_date_ms = to_ms(now)
+
+    conn_order.executemany(
+        """
+        INSERT INTO order_list (
+            order_id, date, customer_name, product, amount, total_price, step_name, note,
+            process_version, step_deps, date_ms
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            (
+                o["order_id"],
+                order_date,
+                o["customer"],
+                f"{o['product_name']} x {o['qty']}",
+                o["qty"],
+                o["total_price"],
+                format_route(o["route"]),
+                IMPORT_NOTE,
+                o["process_version"],
+                dumps_route(o["route"]),
+                order_date_ms,
+            )
+            for o in orders
+        ),
+    )
+
+    # 每張匯入訂單只有一個品項：件號 1~qty
+    conn_order.executemany(
+        """
+        INSERT INTO order_items (
+            order_id, line_no, product_id, product_name, quantity,
+            piece_from, piece_to, step_name, step_deps
+        ) VALUES (?, 1, ?, ?, ?, 1, ?, ?, ?)
+        """,
+        (
+            (
+                o["order_id"],
+                o["product_id"],
+                o["product_name"],
+                o["qty"],
+                o["qty"],
+                format_route(o["route"]),
+                dumps_route(o["route"]),
+            )
+            for o in orders
+        ),
+    )
+
+    # 扣庫存：每張訂單一筆帳本，products.stock 由 record_movements 合併更新
+    record_movements(
+        conn_prod,
+        ((o["product_id"], -o["qty"], REASON_ORDER, o["order_id"], IMPORT_NOTE) for o in orders),
+    )
+
+    # piece rows 用 generator 餵給 executemany，數量再大也不會整批展開在記憶體
+    conn_order.executemany(
+        """
+        INSERT OR IGNORE INTO piece_step_progress(order_id, piece_no, step_order, state)
+        VALUES (?, ?, ?, 'pending')
+        """,
+        (
+            (o["order_id"], piece_no, step_no)
+            for o in orders
+            for piece_no in range(1, o["qty"] + 1)
+            for step_no in o["route"]
+        ),
+    )
@@ -11,22 +11,50 @@ from flask import (
     jsonify,
     flash,
     abort,
+    Response,
+    current_app,
 )
 from datetime import datetime
+import sqlite3
 import time
 
 from . import login_required
+from .admission import DEFAULT_HORIZON_SEC, admission, order_work
+from .capacity_plan import invalidate as invalidate_plan
 from .db import get_product_db, get_order_mgmt_db
+from .catalog import (
+    catalog_etag,
+    catalog_last_modified,
+    get_product,
+    get_products,
+    get_stock,
+    products_api_body,
+)
+from .process_templates import current_version, ensure_process_template_schema, get_step_defs, get_step_list
+from .floor_state import floor
+from .process_dag import RouteError, build_route, dumps_route, format_route
+from .station_availability import ensure_downtime_schema
+from .timeutil import ensure_ms_columns, fmt_ms, now_ms, to_ms
+from .inventory import (
+    REASON_CANCEL,
+    REASON_ORDER,
+    ensure_inventory_schema,
+    record_movements,
+    restock_orders,
+)
 
 order_bp = Blueprint("order", __name__)
 
+# order_list 的 TEXT 時間欄位 → 整數毫秒欄位
+ORDER_LIST_MS_COLUMNS = {"date": "date_ms", "rejected_at": "rejected_at_ms", "cancelled_at": "cancelled_at_ms"}
+
 
 # -----------------------------
 # 自動補欄位：避免 no such column: status
 # -----------------------------
 def ensure_order_list_schema(conn):
     """
-    確保 order_list 有 status / rejected_at / cancelled_at 欄位（沒有就自動補上）
+    確保 order_list 有 status / rejected_at / cancelled_at / process_version / step_deps 欄位（沒有就自動補上）
     """
     cur = conn.cursor()
     try:
@@ -45,6 +73,21 @@ def ensure_order_list_schema(conn):
             cur.execute("ALTER TABLE order_list ADD COLUMN cancelled_at TEXT")
             changed = True
 
+        # 下單當時的製程模板版本（見 core/process_templates.py）
+        if "process_version" not in cols:
+            cur.execute("ALTER TABLE order_list ADD COLUMN process_version INTEGER")
+            changed = True
+
+        # 製程路線的前置步驟集合 JSON（見 core/process_dag.py）
+        if "step_deps" not in cols:
+            cur.execute("ALTER TABLE order_list ADD COLUMN step_deps TEXT")
+            changed = True
+
+        # 整數 epoch 毫秒時間欄位（見 core/timeutil.py），舊資料補欄位時一次換算
+        if ensure_ms_columns(conn, "order_list", ORDER_LIST_MS_COLUMNS):
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_order_list_date_ms ON order_list(date_ms)")
+            changed = True
+
         if changed:
             conn.commit()
     except Exception:
@@ -52,6 +95,39 @@ def ensure_order_list_schema(conn):
         pass
 
 
+def ensure_order_items_schema(conn):
+    """
+    訂單明細：每個購物車品項一列，各自帶製程路線與件號範圍（piece_from ~ piece_to），
+    工廠派工 / 進度彙總都以件號範圍對應到品項
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+          order_id TEXT NOT NULL,
+          line_no INTEGER NOT NULL,
+          product_id INTEGER,
+          product_name TEXT,
+          quantity INTEGER NOT NULL,
+          piece_from INTEGER NOT NULL,
+          piece_to INTEGER NOT NULL,
+          step_name TEXT,
+          step_deps TEXT,
+          PRIMARY KEY(order_id, line_no)
+        );
+    """)
+    conn.commit()
+
+
+def order_route_summary(routes):
+    """
+    訂單層級的 step_name / step_deps：
+    所有品項路線相同時就是該路線；不同時 step_name 列出各路線、step_deps 留空（以 order_items 為準）
+    """
+    names = list(dict.fromkeys(format_route(r) for r in routes))
+    if len(names) == 1:
+        return names[0], dumps_route(routes[0])
+    return " / ".join(names), None
+
+
 @order_bp.route("/order", methods=["GET", "POST"])
 @login_required
 def order_page():
@@ -61,35 +137,8 @@ def order_page():
     - POST:檢查每個產品的數量，存到 session["current_order_items"]，然後導到製程規劃頁
     """
 
-    # 先把產品列表抓出來（不管 GET / POST 都會用到）
-    conn = get_product_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            id,
-            name,
-            description,
-            base_price,
-            stock
-        FROM products
-        ORDER BY id
-        """
-    )
-    rows = cur.fetchall()
-    conn.close()
-
-    # 把資料整理成給模板用的格式
-    products = [
-        {
-            "id": row["id"],
-            "name": row["name"],
-            "description": row["description"],
-            "base_price": row["base_price"],
-            "stock": row["stock"],
-        }
-        for row in rows
-    ]
+    # 產品列表從目錄快取拿（不管 GET / POST 都會用到，不必每次查 DB）
+    products = get_products()
 
     error_message = None
 
@@ -141,6 +190,30 @@ def order_page():
     )
 
 
+# -----------------------------------------------------------
+#  API：產品清單（給購物車 widget 輪詢用）
+#  ETag / Last-Modified 跟著目錄版本走，沒變就回 304
+# -----------------------------------------------------------
+@order_bp.route("/api/products", methods=["GET"])
+@login_required
+def products_api():
+    etag = catalog_etag()
+    last_modified = catalog_last_modified()
+
+    # 先用 header 判斷，沒變就不必拿 body
+    resp = Response(status=200, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True  # 可以快取，但每次都要帶 If-None-Match 回來確認
+    resp.make_conditional(request)
+    if resp.status_code == 304:
+        return resp
+
+    resp.set_data(products_api_body())
+    return resp
+
+
 @order_bp.route("/process-plan", methods=["GET", "POST"])
 @login_required
 def process_plan():
@@ -149,36 +222,12 @@ def process_plan():
     - 從 session["current_order_items"] 讀取本次訂單摘要
     - 若 session 沒東西，退回 demo 資料（避免直接輸入網址爆掉）
     """
-    # 1. 從資料庫讀取製程步驟
+    # 1. 讀取目前版本的製程步驟（每個版本的內容只讀一次 DB，之後走記憶體快取）
     conn = get_product_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT
-            step_order,
-            step_name,
-            station,
-            description,
-            estimated_time_sec
-        FROM standard_process
-        ORDER BY step_order ASC
-        """
-    )
-    rows = cur.fetchall()
+    ensure_process_template_schema(conn)
+    standard_steps = get_step_list(conn, current_version(conn))
     conn.close()
 
-    # 將資料庫 Row 物件轉為字典列表，傳給前端
-    standard_steps = [
-        {
-            "step_order": row["step_order"],
-            "step_name": row["step_name"],
-            "station": row["station"],
-            "description": row["description"],
-            "estimated_time_sec": row["estimated_time_sec"],
-        }
-        for row in rows
-    ]
-
     # 2. 讀取 Session 中的訂單摘要
     order_items_summary = session.get("current_order_items")
     if not order_items_summary:
@@ -230,6 +279,8 @@ def generate_order_id(conn):
 def submit_order_api():
     conn_order = None
     conn_prod = None
+    # 已在產能控管預留工作的訂單 ID（下單失敗時要釋放）
+    admitted_id = None
 
     try:
         data = request.get_json()
@@ -239,53 +290,121 @@ def submit_order_api():
         if not cart_items:
             return jsonify({"success": False, "message": "購物車逾時，請重新下單"}), 400
 
+        # 製程路線（DAG）：step_deps = {步驟: [前置步驟...]}；沒給就是依選取順序的線性流程
+        # items[i] 可以給第 i 個品項自己的 selected_steps / step_deps，沒給就用訂單層級的路線
+        item_specs = data.get("items") or []
+        routes = []
+        for idx, item in enumerate(cart_items):
+            spec = item_specs[idx] if idx < len(item_specs) and isinstance(item_specs[idx], dict) else {}
+            if "selected_steps" not in spec:
+                spec = {"selected_steps": selected_steps_ids, "step_deps": data.get("step_deps")}
+            try:
+                route = build_route(spec.get("selected_steps") or [], spec.get("step_deps"))
+            except (RouteError, TypeError, ValueError) as e:
+                return jsonify({"success": False, "message": f"{item['name']} 的製程路線錯誤：{e}"}), 400
+            if not route:
+                return jsonify({"success": False, "message": f"{item['name']} 請至少選擇一個製程步驟"}), 400
+            routes.append(route)
+
         customer_name = session.get("account", "Guest")
 
         conn_prod = get_product_db()
         conn_order = get_order_mgmt_db()
         ensure_order_list_schema(conn_order)  # 先補欄位（status/rejected_at/cancelled_at）
+        ensure_order_items_schema(conn_order)
+        ensure_inventory_schema(conn_prod)
+        ensure_process_template_schema(conn_prod)
+        ensure_downtime_schema(conn_order)
 
         cur_prod = conn_prod.cursor()
         cur_order = conn_order.cursor()
 
+        # 訂單 ID 先產生，庫存帳本要記是哪張訂單扣的
+        custom_order_id = generate_order_id(conn_order)
+
+        # 訂單固定在下單當下的製程模板版本，之後改模板不影響這張單
+        process_version = current_version(conn_prod)
+        valid_steps = set(get_step_defs(conn_prod, process_version))
+        unknown = sorted({s for r in routes for s in r} - valid_steps)
+        if unknown:
+            raise Exception(f"未知的製程步驟：{unknown}")
+
         # --- 重新計算總價並確認庫存充足 ---
         total_price = 0
         product_names = []
+        movements = []
+        # 每個品項依序分配件號範圍（例如 藍x2 → 1~2、白x3 → 3~5）
+        item_rows = []
+        next_piece = 1
 
         for item in cart_items:
-            cur_prod.execute(
-                "SELECT name, base_price, stock FROM products WHERE id = ?",
-                (item["id"],),
-            )
-            prod_row = cur_prod.fetchone()
-
-            if not prod_row:
+            # 名稱 / 單價從目錄快取拿，不必逐項查 DB
+            prod = get_product(item["id"])
+            if not prod:
                 raise Exception(f"找不到產品 ID: {item['id']}")
 
-            current_stock = prod_row["stock"]
+            # 先用快取庫存擋掉明顯不足的情況（真正的檢查在下面扣完庫存之後）
+            current_stock = get_stock(item["id"])
             if current_stock < item["quantity"]:
-                raise Exception(f"產品 {prod_row['name']} 庫存不足 (剩餘 {current_stock})，下單失敗")
+                raise Exception(f"產品 {prod.name} 庫存不足 (剩餘 {current_stock})，下單失敗")
 
-            price = prod_row["base_price"] if prod_row["base_price"] is not None else 0
-            total_price += price * item["quantity"]
+            total_price += prod.base_price * item["quantity"]
 
-            product_names.append(f"{prod_row['name']} x {item['quantity']}")
+            product_names.append(f"{prod.name} x {item['quantity']}")
 
-            # 扣庫存（尚未 commit 前不會真的生效）
-            cur_prod.execute(
-                "UPDATE products SET stock = stock - ? WHERE id = ?",
-                (item["quantity"], item["id"]),
-            )
+            movements.append((item["id"], -item["quantity"], REASON_ORDER, custom_order_id, None))
+
+            route = routes[len(item_rows)]
+            item_rows.append((
+                custom_order_id,
+                len(item_rows) + 1,
+                item["id"],
+                prod.name,
+                item["quantity"],
+                next_piece,
+                next_piece + item["quantity"] - 1,
+                format_route(route),
+                dumps_route(route),
+            ))
+            next_piece += item["quantity"]
+
+        # 產能控管：加上這張單後任何一站的待做工作超過水位就不接單，回報最早可接單時間
+        admission.ensure_loaded(conn_order, conn_prod)
+        work = order_work(conn_prod, process_version, [(item["quantity"], route) for item, route in zip(cart_items, routes)])
+        horizon = float(current_app.config.get("FACTORY_ADMISSION_HORIZON_SEC", DEFAULT_HORIZON_SEC))
+        earliest = admission.try_admit(conn_order, custom_order_id, work, horizon, now_ms())
+        if earliest is not None:
+            retry_after = max(1, (earliest - now_ms()) // 1000)
+            return jsonify({
+                "success": False,
+                "capacity_full": True,
+                "earliest_slot": fmt_ms(earliest),
+                "message": f"產線產能已滿，最早可下單時間約為 {fmt_ms(earliest)}",
+            }), 429, {"Retry-After": str(retry_after)}
+        admitted_id = custom_order_id
+
+        # 扣庫存：寫帳本 + 增量更新 products.stock（尚未 commit 前不會真的生效）
+        record_movements(conn_prod, movements)
+
+        # 快取可能稍舊，以 transaction 內的實際庫存為準：扣完變負數就整筆 rollback
+        ids = [item["id"] for item in cart_items]
+        cur_prod.execute(
+            f"SELECT name, stock FROM products WHERE id IN ({','.join(['?'] * len(ids))}) AND stock < 0",
+            ids,
+        )
+        short = cur_prod.fetchone()
+        if short:
+            raise Exception(f"產品 {short['name']} 庫存不足，下單失敗")
 
         product_str = ", ".join(product_names)
         total_amount = sum(item["quantity"] for item in cart_items)
 
-        # 只存步驟 ID 串接（依你原本要求）
-        step_name_str = " -> ".join(map(str, selected_steps_ids))
+        # step_name 存給人看的路線字串（"1 -> 4 | 5 -> 9"），精確的前置步驟集合存 step_deps
+        step_name_str, step_deps_str = order_route_summary(routes)
 
-        order_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        order_dt = datetime.now()
+        order_date = order_dt.strftime("%Y-%m-%d %H:%M:%S")
         note = "無備註"
-        custom_order_id = generate_order_id(conn_order)
 
         sql_order = """
             INSERT INTO order_list (
@@ -296,8 +415,11 @@ def submit_order_api():
                 amount,
                 total_price,
                 step_name,
-                note
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                note,
+                process_version,
+                step_deps,
+                date_ms
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
 
         cur_order.execute(
@@ -311,11 +433,25 @@ def submit_order_api():
                 total_price,
                 step_name_str,
                 note,
+                process_version,
+                step_deps_str,
+                to_ms(order_dt),
             ),
         )
 
+        cur_order.executemany(
+            """
+            INSERT INTO order_items (
+                order_id, line_no, product_id, product_name, quantity,
+                piece_from, piece_to, step_name, step_deps
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            item_rows,
+        )
+
         conn_prod.commit()
         conn_order.commit()
+        invalidate_plan()
 
         session.pop("current_order_items", None)
 
@@ -332,6 +468,8 @@ def submit_order_api():
             conn_prod.rollback()
         if conn_order:
             conn_order.rollback()
+        if admitted_id:
+            admission.order_closed(admitted_id)
         print(f"Error during submit_order: {str(e)}")
         return jsonify({"success": False, "message": f"下單失敗: {str(e)}"}), 500
 
@@ -361,17 +499,80 @@ def order_history():
         """
         SELECT
             order_id, date, customer_name, product, amount, total_price,
-            step_name, note, status, rejected_at, cancelled_at
+            step_name, note, status, rejected_at, cancelled_at, process_version
         FROM order_list
         WHERE customer_name = ?
-        ORDER BY date DESC
+        ORDER BY date_ms DESC
         """,
         (customer_name,),
     )
     orders = cur.fetchall()
+    progress = _order_progress(conn, customer_name)
     conn.close()
 
-    return render_template("order/orders_history.html", orders=orders)
+    # 目前步驟的名稱（模板版本內容有記憶體快取）
+    conn_prod = get_product_db()
+    try:
+        ensure_process_template_schema(conn_prod)
+        for o in orders:
+            p = progress.get(o["order_id"])
+            if p and p["current_step"] is not None:
+                d = get_step_defs(conn_prod, o["process_version"]).get(p["current_step"])
+                p["current_step_name"] = d.step_name if d else ""
+    finally:
+        conn_prod.close()
+
+    return render_template("order/orders_history.html", orders=orders, progress=progress)
+
+
+def _order_progress(conn, customer_name):
+    """
+    這位客戶所有訂單的進度（一條 GROUP BY，不必逐張開模擬頁）：
+    order_id -> {pieces_done, pieces_total, steps_done, steps_total, current_step}
+    - 一件的所有步驟都 finished 才算完成
+    - current_step：進行中的最小步驟；沒有進行中就是待加工的最小步驟
+    - 還沒開始模擬（沒有 piece rows）的訂單不會出現在結果裡
+    """
+    try:
+        rows = conn.execute(
+            """
+            WITH piece AS (
+                SELECT p.order_id, p.piece_no,
+                       COUNT(*) AS steps_total,
+                       SUM(p.state = 'finished') AS steps_done,
+                       MIN(CASE WHEN p.state = 'running' THEN p.step_order END) AS running_step,
+                       MIN(CASE WHEN p.state = 'pending' THEN p.step_order END) AS pending_step
+                FROM piece_step_progress p
+                JOIN order_list o ON o.order_id = p.order_id
+                WHERE o.customer_name = ?
+                GROUP BY p.order_id, p.piece_no
+            )
+            SELECT order_id,
+                   COUNT(*) AS pieces_total,
+                   SUM(steps_done = steps_total) AS pieces_done,
+                   SUM(steps_total) AS steps_total,
+                   SUM(steps_done) AS steps_done,
+                   COALESCE(MIN(running_step), MIN(pending_step)) AS current_step
+            FROM piece
+            GROUP BY order_id
+            """,
+            (customer_name,),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # piece_step_progress 還沒建立（從來沒跑過模擬）
+        return {}
+
+    return {
+        r["order_id"]: {
+            "pieces_total": int(r["pieces_total"] or 0),
+            "pieces_done": int(r["pieces_done"] or 0),
+            "steps_total": int(r["steps_total"] or 0),
+            "steps_done": int(r["steps_done"] or 0),
+            "current_step": r["current_step"],
+            "current_step_name": "",
+        }
+        for r in rows
+    }
 
 
 # -----------------------------------------------------------
@@ -406,28 +607,51 @@ def cancel_my_order(order_id):
 
     status = (row["status"] or "active")
 
-    # 已拒絕/已取消不能再取消
-    if status in ("rejected", "cancelled"):
+    # 已完成 / 已拒絕 / 已取消不能再取消（已完成的件已經做出來，不能回補庫存）
+    if status in ("completed", "rejected", "cancelled"):
         conn.close()
-        flash("此訂單目前無法取消（可能已被拒絕或已取消）", "warning")
+        flash("此訂單目前無法取消（可能已完成、已被拒絕或已取消）", "warning")
         return redirect(url_for("order.order_history"))
 
     note_text = f"客戶取消：{reason}"
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.now()
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
     cur.execute(
         """
         UPDATE order_list
         SET status = 'cancelled',
             note = ?,
-            cancelled_at = ?
-        WHERE order_id = ? AND customer_name = ?
+            cancelled_at = ?,
+            cancelled_at_ms = ?
+        WHERE order_id = ? AND customer_name = ? AND COALESCE(status, 'active') = 'active'
         """,
-        (note_text, now_str, order_id, customer_name),
+        (note_text, now_str, to_ms(now), order_id, customer_name),
     )
+    if cur.rowcount != 1:
+        # 讀狀態之後被別的 request 改掉（例如剛完成 / 被拒絕）：不取消也不回補
+        conn.rollback()
+        conn.close()
+        flash("此訂單目前無法取消（可能已完成、已被拒絕或已取消）", "warning")
+        return redirect(url_for("order.order_history"))
 
-    conn.commit()
-    conn.close()
+    # 取消 → 把這張訂單扣掉的庫存加回來
+    conn_prod = get_product_db()
+    try:
+        ensure_inventory_schema(conn_prod)
+        restock_orders(conn_prod, [order_id], REASON_CANCEL, note_text)
+        conn_prod.commit()
+        conn.commit()
+        floor.order_closed(order_id)
+        admission.order_closed(order_id)
+        invalidate_plan()
+    except Exception:
+        conn_prod.rollback()
+        conn.rollback()
+        raise
+    finally:
+        conn_prod.close()
+        conn.close()
 
     flash("已取消訂單（已保留紀錄）", "success")
     return redirect(url_for("order.order_history"))
@@ -0,0 +1,144 @@
+# core/process_dag.py
+# 製程路線（DAG）：
+# - 每個步驟有自己的前置步驟集合（predecessor set），所有前置步驟完成才可開始
+# - 沒有相依關係的步驟（例如貼標與電測）可以在不同站點同時進行
+# - order_list.step_deps 存 JSON：{"4": [1], "5": [1], "9": [4, 5]}
+# - order_list.step_name 仍是給人看的字串，用「->」分階段、「|」分並行：
+#     "1 -> 4 | 5 -> 9"（舊訂單的 "1 -> 2 -> 5" 就是每階段一個步驟的特例）
+
+from __future__ import annotations
+
+import json
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+# step_order -> 前置步驟（已排序）
+Route = Dict[int, Tuple[int, ...]]
+
+
+class RouteError(ValueError):
+    """路線不合法（未知的前置步驟、循環相依…）"""
+
+
+def parse_stages(s: str) -> List[List[int]]:
+    """'1 -> 4 | 5 -> 9' → [[1], [4, 5], [9]]（忽略非數字的片段）"""
+    stages: List[List[int]] = []
+    for part in (s or "").split("->"):
+        stage = [int(x.strip()) for x in part.split("|") if x.strip().isdigit()]
+        if stage:
+            stages.append(stage)
+    return stages
+
+
+def route_from_stages(stages: Iterable[Iterable[int]]) -> Route:
+    """每個步驟的前置 = 上一階段的所有步驟"""
+    route: Route = {}
+    prev: Tuple[int, ...] = ()
+    for stage in stages:
+        cur = tuple(sorted({int(x) for x in stage} - set(route)))
+        if not cur:
+            continue
+        for step_no in cur:
+            route[step_no] = prev
+        prev = cur
+    return route
+
+
+def build_route(steps: Iterable[int], deps: Optional[Mapping] = None) -> Route:
+    """
+    由步驟清單 + 前置步驟集合建立路線並檢查：
+    - deps 為 None 時視為線性（依 steps 順序，每步的前置是上一步）
+    - 前置步驟必須也在 steps 裡，且不能有循環
+    """
+    steps = list(dict.fromkeys(int(x) for x in steps))
+    if deps is None:
+        return route_from_stages([s] for s in steps)
+
+    step_set = set(steps)
+    route: Route = {}
+    for step_no in steps:
+        raw = deps.get(str(step_no), deps.get(step_no, [])) or []
+        try:
+            preds = {int(x) for x in raw}
+        except (TypeError, ValueError):
+            raise RouteError(f"步驟 {step_no} 的前置步驟必須是整數")
+        unknown = preds - step_set
+        if unknown:
+            raise RouteError(f"步驟 {step_no} 的前置步驟 {sorted(unknown)} 不在選取的步驟中")
+        if step_no in preds:
+            raise RouteError(f"步驟 {step_no} 不能以自己為前置步驟")
+        route[step_no] = tuple(sorted(preds))
+
+    topo_order(route)  # 有循環會丟 RouteError
+    return route
+
+
+def topo_order(route: Route) -> List[int]:
+    """拓撲排序（同一層依 step_order 由小到大），有循環時丟 RouteError"""
+    return [s for level in levels(route) for s in level]
+
+
+def levels(route: Route) -> List[List[int]]:
+    """
+    依相依深度分層：第 0 層沒有前置，第 k 層的前置最深在第 k-1 層。
+    同一層的步驟彼此沒有相依，可以並行。
+    """
+    depth: Dict[int, int] = {}
+    remaining = dict(route)
+    while remaining:
+        ready = [s for s, preds in remaining.items() if all(p in depth for p in preds)]
+        if not ready:
+            raise RouteError(f"製程路線有循環相依：{sorted(remaining)}")
+        for s in ready:
+            depth[s] = 1 + max((depth[p] for p in remaining[s]), default=-1)
+            del remaining[s]
+
+    out: List[List[int]] = []
+    for s, d in sorted(depth.items(), key=lambda kv: (kv[1], kv[0])):
+        while len(out) <= d:
+            out.append([])
+        out[d].append(s)
+    return out
+
+
+def successors(route: Route, step_no: int) -> List[int]:
+    """直接或間接以 step_no 為前置的所有步驟（依拓撲順序）"""
+    reached = {step_no}
+    out: List[int] = []
+    for s in topo_order(route):
+        if any(p in reached for p in route[s]):
+            reached.add(s)
+            out.append(s)
+    return out
+
+
+def format_route(route: Route) -> str:
+    """給人看的字串：'1 -> 4 | 5 -> 9'（精確的相依關係以 step_deps 為準）"""
+    return " -> ".join(" | ".join(map(str, level)) for level in levels(route))
+
+
+def dumps_route(route: Route) -> str:
+    return json.dumps({str(s): list(preds) for s, preds in route.items()}, sort_keys=True)
+
+
+def load_route(step_name: Optional[str], step_deps: Optional[str] = None) -> Route:
+    """
+    讀訂單的路線：有 step_deps 就用它，否則由 step_name 的階段字串推得
+    （舊訂單只有 "1 -> 2 -> 5"，結果和原本的線性流程相同）。
+    """
+    if step_deps:
+        try:
+            raw = json.loads(step_deps)
+        except ValueError:
+            raw = None
+        if isinstance(raw, dict):
+            return {int(s): tuple(int(p) for p in preds) for s, preds in raw.items()}
+    return route_from_stages(parse_stages(step_name or ""))
+
+
+def critical_path_sec(route: Route, durations: Mapping[int, int]) -> int:
+    """單件最短完成時間（最長路徑上的秒數總和），並行的分支只算最慢的那條"""
+    finish: Dict[int, int] = {}
+    for s in topo_order(route):
+        start = max((finish[p] for p in route[s]), default=0)
+        finish[s] = start + int(durations.get(s, 0))
+    return max(finish.values(), default=0)
@@ -0,0 +1,132 @@
+# core/process_templates.py
+# 製程模板版本化：
+# - standard_process 仍是管理者編輯用的「目前模板」
+# - 每次 add_step / bulk_update_time 成功後，把整份 standard_process 複製成一個新版本
+#   （process_template_version + process_template_step），版本一旦建立就不再修改
+# - 訂單下單時記下當時的版本（order_list.process_version），之後改模板不會影響進行中的訂單
+# - 版本內容不會變，所以每個版本的步驟定義讀一次就永久快取在記憶體
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+# 沒有秒數時的預設值（和原本 _get_est_sec 一致）
+DEFAULT_EST_SEC = 5
+
+
+class StepDef(NamedTuple):
+    step_order: int
+    step_name: str
+    station: str
+    description: Optional[str]
+    estimated_time_sec: int
+
+
+# version -> {step_order: StepDef}
+_STEP_DEFS_CACHE: Dict[int, Dict[int, StepDef]] = {}
+_cache_lock = threading.Lock()
+
+
+def ensure_process_template_schema(conn: sqlite3.Connection) -> None:
+    """建立版本表；還沒有任何版本時，把目前的 standard_process 存成第 1 版"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS process_template_version (
+          version INTEGER PRIMARY KEY AUTOINCREMENT,
+          created_at TEXT NOT NULL,
+          note TEXT
+        );
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS process_template_step (
+          version INTEGER NOT NULL,
+          step_order INTEGER NOT NULL,
+          step_name TEXT NOT NULL,
+          station TEXT,
+          description TEXT,
+          estimated_time_sec INTEGER,
+          PRIMARY KEY(version, step_order)
+        );
+    """)
+    if conn.execute("SELECT 1 FROM process_template_version LIMIT 1").fetchone() is None:
+        create_version(conn, "初始版本（由 standard_process 建立）")
+    conn.commit()
+
+
+def create_version(conn: sqlite3.Connection, note: Optional[str] = None) -> int:
+    """把目前的 standard_process 存成新版本（不 commit，和模板修改同一個 transaction）"""
+    cur = conn.execute(
+        "INSERT INTO process_template_version(created_at, note) VALUES (?, ?)",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), note),
+    )
+    version = int(cur.lastrowid)
+    # 同一個 step_order 有多筆時取 id 最小的一筆（和 ORDER BY step_order, id 的顯示一致）
+    conn.execute("""
+        INSERT INTO process_template_step(version, step_order, step_name, station, description, estimated_time_sec)
+        SELECT ?, step_order, step_name, station, description, estimated_time_sec
+        FROM standard_process
+        WHERE id IN (SELECT MIN(id) FROM standard_process GROUP BY step_order)
+    """, (version,))
+    return version
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """目前最新的模板版本（呼叫前要先 ensure_process_template_schema）"""
+    r = conn.execute("SELECT MAX(version) AS v FROM process_template_version").fetchone()
+    return int(r["v"] or 1)
+
+
+def get_step_defs(conn: sqlite3.Connection, version: Optional[int]) -> Dict[int, StepDef]:
+    """
+    取得某版本的所有步驟（step_order -> StepDef）。
+    version 為 None（版本化之前的舊訂單）時視為第 1 版。
+    """
+    version = int(version or 1)
+    defs = _STEP_DEFS_CACHE.get(version)
+    if defs is not None:
+        return defs
+
+    rows = conn.execute("""
+        SELECT step_order, step_name, station, description, estimated_time_sec
+        FROM process_template_step
+        WHERE version = ?
+        ORDER BY step_order
+    """, (version,)).fetchall()
+
+    defs = {}
+    for r in rows:
+        try:
+            est = int(r["estimated_time_sec"] or DEFAULT_EST_SEC)
+        except (TypeError, ValueError):
+            est = DEFAULT_EST_SEC
+        defs[int(r["step_order"])] = StepDef(
+            int(r["step_order"]),
+            r["step_name"],
+            (r["station"] or "").strip(),
+            r["description"],
+            est,
+        )
+
+    # 版本不存在（空結果）時不快取，避免之後建立了同號版本卻一直拿到空的
+    if defs:
+        with _cache_lock:
+            _STEP_DEFS_CACHE[version] = defs
+    return defs
+
+
+def get_step_list(conn: sqlite3.Connection, version: Optional[int]) -> List[StepDef]:
+    """依 step_order 排好的步驟清單（製程規劃頁 / 模擬頁顯示用）"""
+    return sorted(get_step_defs(conn, version).values(), key=lambda s: s.step_order)
+
+
+def list_versions(conn: sqlite3.Connection, limit: int = 20) -> List[sqlite3.Row]:
+    return conn.execute("""
+        SELECT v.version, v.created_at, v.note, COUNT(s.step_order) AS step_count
+        FROM process_template_version v
+        LEFT JOIN process_template_step s ON s.version = v.version
+        GROUP BY v.version
+        ORDER BY v.version DESC
+        LIMIT ?
+    """, (limit,)).fetchall()
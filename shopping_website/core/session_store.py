@@ -0,0 +1,246 @@
+# core/session_store.py
+# 伺服器端 session：
+# - cookie 只放一個短的隨機 session id，購物車等內容存在 session.db（不再每個 request 上傳 / 驗簽整包 cookie）
+# - 常用的 session 快取在記憶體（LRU），用 version 欄位確認和 DB 一致，只有版本不同才重新反序列化
+# - 過期的 session 定期清掉（寫入時順便檢查，最多每 SWEEP_INTERVAL 秒一次；也可用 flask sweep-sessions）
+# - 對外介面就是 Flask 的 session，order_page → process_plan → submit_order_api 不用改
+
+from __future__ import annotations
+
+import copy
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import click
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from .db import get_session_db
+
+# session 閒置多久過期（秒）；可用 app.config["SESSION_TTL_SEC"] 覆蓋
+DEFAULT_TTL_SEC = 2 * 60 * 60
+# 多久清一次過期 session（秒）
+SWEEP_INTERVAL = 60
+# 記憶體快取最多幾個 session
+CACHE_SIZE = 1024
+# 剩餘時間少於 TTL 的這個比例才延長到期時間（避免每個 request 都寫 DB）
+_TOUCH_RATIO = 0.9
+
+
+def ensure_session_schema(conn) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS web_session (
+          sid TEXT PRIMARY KEY,
+          data TEXT NOT NULL,
+          version INTEGER NOT NULL DEFAULT 1,
+          expires_at REAL NOT NULL        -- epoch 秒
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_web_session_expires ON web_session(expires_at);")
+    conn.commit()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid: Optional[str] = None, version: int = 0, new: bool = False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.new = new
+        self.modified = False
+        # regenerate() 換掉的舊 sid（存檔時刪掉舊紀錄）
+        self.replaced_sid: Optional[str] = None
+
+    def regenerate(self) -> None:
+        """換一個新的 sid（登入 / 權限改變時呼叫，避免沿用登入前被植入的 sid：session fixation）"""
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(16)
+        self.version = 0
+        self.new = True
+        self.modified = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, ttl_sec: int = DEFAULT_TTL_SEC):
+        self.ttl_sec = int(ttl_sec)
+        self.lock = threading.Lock()
+        # sid -> (version, expires_at, data)
+        self.cache: "OrderedDict[str, Tuple[int, float, dict]]" = OrderedDict()
+        self.last_sweep = 0.0
+        self.schema_ready = False
+
+    # ---------- DB ----------
+    def _db(self):
+        conn = get_session_db()
+        if not self.schema_ready:
+            ensure_session_schema(conn)
+            self.schema_ready = True
+        return conn
+
+    def _cache_put(self, sid: str, version: int, expires_at: float, data: dict) -> None:
+        with self.lock:
+            self.cache[sid] = (version, expires_at, data)
+            self.cache.move_to_end(sid)
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+    def _cache_drop(self, sid: str) -> None:
+        with self.lock:
+            self.cache.pop(sid, None)
+
+    # ---------- SessionInterface ----------
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession(sid=secrets.token_urlsafe(16), new=True)
+
+        conn = self._db()
+        try:
+            row = conn.execute(
+                "SELECT version, expires_at FROM web_session WHERE sid = ?", (sid,)
+            ).fetchone()
+            if row is None or row["expires_at"] < time.time():
+                return ServerSession(sid=secrets.token_urlsafe(16), new=True)
+
+            version = int(row["version"])
+            cached = self.cache.get(sid)
+            if cached and cached[0] == version:
+                data = cached[2]
+            else:
+                r = conn.execute("SELECT data FROM web_session WHERE sid = ?", (sid,)).fetchone()
+                if r is None:
+                    return ServerSession(sid=secrets.token_urlsafe(16), new=True)
+                data = self.serializer.loads(r["data"])
+            self._cache_put(sid, version, float(row["expires_at"]), data)
+        finally:
+            conn.close()
+
+        # 給 request 一份自己的副本，修改不會直接動到快取
+        return ServerSession(copy.deepcopy(data), sid=sid, version=version)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+
+        if session.replaced_sid:
+            conn = self._db()
+            try:
+                conn.execute("DELETE FROM web_session WHERE sid = ?", (session.replaced_sid,))
+                conn.commit()
+            finally:
+                conn.close()
+            self._cache_drop(session.replaced_sid)
+            session.replaced_sid = None
+
+        if not session:
+            # 清空（登出）→ 刪掉 DB 紀錄與 cookie
+            if session.modified and not session.new:
+                conn = self._db()
+                try:
+                    conn.execute("DELETE FROM web_session WHERE sid = ?", (session.sid,))
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._cache_drop(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        expires_at = now + self.ttl_sec
+        cached = self.cache.get(session.sid)
+        needs_touch = cached is None or cached[1] - now < self.ttl_sec * _TOUCH_RATIO
+
+        if session.modified or session.new:
+            data = dict(session)
+            conn = self._db()
+            try:
+                # 版本在 SQL 裡 +1：同一個 sid 同時有兩個 request 寫入時，兩次寫入的版本也不同，
+                # 快取不會把另一個 request 寫的內容當成同一版
+                version = int(conn.execute(
+                    """
+                    INSERT INTO web_session(sid, data, version, expires_at) VALUES (?, ?, 1, ?)
+                    ON CONFLICT(sid) DO UPDATE SET
+                      data = excluded.data, version = web_session.version + 1, expires_at = excluded.expires_at
+                    RETURNING version
+                    """,
+                    (session.sid, self.serializer.dumps(data), expires_at),
+                ).fetchone()[0])
+                conn.commit()
+                self._maybe_sweep(conn, now)
+            finally:
+                conn.close()
+            self._cache_put(session.sid, version, expires_at, copy.deepcopy(data))
+        elif needs_touch:
+            # 只延長到期時間，不重寫內容
+            conn = self._db()
+            try:
+                conn.execute("UPDATE web_session SET expires_at = ? WHERE sid = ?", (expires_at, session.sid))
+                conn.commit()
+                self._maybe_sweep(conn, now)
+            finally:
+                conn.close()
+            if cached:
+                self._cache_put(session.sid, cached[0], expires_at, cached[2])
+        else:
+            return
+
+        response.set_cookie(
+            name,
+            session.sid,
+            max_age=self.ttl_sec,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    # ---------- 過期清理 ----------
+    def _maybe_sweep(self, conn, now: float) -> None:
+        if now - self.last_sweep < SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        self.sweep(conn, now)
+
+    def sweep(self, conn=None, now: Optional[float] = None) -> int:
+        """刪除過期 session（DB + 記憶體快取），回傳刪除筆數"""
+        now = time.time() if now is None else now
+        own = conn is None
+        if own:
+            conn = self._db()
+        try:
+            cur = conn.execute("DELETE FROM web_session WHERE expires_at < ?", (now,))
+            conn.commit()
+            removed = cur.rowcount
+        finally:
+            if own:
+                conn.close()
+
+        with self.lock:
+            for sid in [sid for sid, (_, exp, _) in self.cache.items() if exp < now]:
+                del self.cache[sid]
+        return removed
+
+
+def init_session_store(app) -> SqliteSessionInterface:
+    """把 Flask 的 session 換成伺服器端 session，並註冊 flask sweep-sessions 指令"""
+    interface = SqliteSessionInterface(app.config.get("SESSION_TTL_SEC", DEFAULT_TTL_SEC))
+    app.session_interface = interface
+
+    @app.cli.command("sweep-sessions")
+    def sweep_sessions_command():
+        """刪除過期的伺服器端 session"""
+        removed = interface.sweep()
+        click.echo(f"已刪除 {removed} 筆過期 session")
+
+    return interface
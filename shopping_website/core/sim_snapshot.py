@@ -0,0 +1,146 @@
+# core/sim_snapshot.py
+# 產線模擬狀態的快照 / 還原（展示或 what-if 實驗用）：
+# - 快照 = 用 SQLite backup API 把整個 order_management.db（訂單狀態、站點占用、piece 進度、停機時段）
+#   複製成 database/snapshots/<名稱>.db；建立前先把記憶體模型還沒寫回的變動寫進 DB
+# - 還原只換回模擬狀態（SIM_TABLES：站點占用、piece 進度、模擬時鐘）和訂單的 status，在同一個 transaction 內；
+#   訂單本身、停機時段等其他資料不動。快照之後有新訂單時拒絕還原（不會蓋掉真實的客戶訂單）
+# - 還原後記憶體模型、driver 的工作、看板 / 產能控管 / 報表快取都要重建（見 core/factory_routes.py）
+# - 庫存：快照檔另外記下當時庫存帳本（stock_ledger）的最後一筆 id；還原時把這些訂單在那之後的淨庫存異動
+#   反向寫成 sim_restore 帳本（帳本 append-only，不刪任何一筆，手動調整 / 補貨不受影響）
+# - 兩個 DB：先寫帳本、最後才換訂單 DB；訂單 DB 失敗就把沖銷再沖回。
+#   中途當掉時重新還原同一個快照即可補完（已沖銷的訂單淨異動是 0，不會重複沖銷）
+
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+from typing import List
+
+from .inventory import REASON_SIM_RESTORE, ledger_position, reverse_order_movements
+
+SNAPSHOT_SUFFIX = ".db"
+# 快照檔裡記錄庫存帳本位置的表
+_META_TABLE = "sim_snapshot_meta"
+# 還原時從快照整表換回的模擬狀態；訂單本身只換回 order_list.status，停機時段（管理者設定）不動
+SIM_TABLES = ("station_state", "piece_step_progress", "sim_clock")
+_NAME_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def snapshot_dir(app) -> str:
+    """快照存放目錄；可用 app.config["FACTORY_SNAPSHOT_DIR"] 覆蓋"""
+    return app.config.get("FACTORY_SNAPSHOT_DIR") or os.path.join(app.root_path, "database", "snapshots")
+
+
+def default_name() -> str:
+    return datetime.now().strftime("snap_%Y%m%d_%H%M%S")
+
+
+def snapshot_path(directory: str, name: str) -> str:
+    """名稱只允許英數、底線、減號（避免路徑穿越）"""
+    if not _NAME_RE.match(name or ""):
+        raise ValueError(f"快照名稱不合法：{name!r}（只能用英數、底線、減號）")
+    return os.path.join(directory, name + SNAPSHOT_SUFFIX)
+
+
+def save_snapshot(order_db: sqlite3.Connection, product_db: sqlite3.Connection, path: str) -> int:
+    """整個訂單 DB + 庫存帳本位置備份到 path（先寫到暫存檔再換名，不會留下寫一半的快照），回傳檔案大小"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    dst = sqlite3.connect(tmp)
+    try:
+        order_db.backup(dst)
+        dst.execute(f"CREATE TABLE {_META_TABLE} (ledger_id INTEGER NOT NULL)")
+        dst.execute(f"INSERT INTO {_META_TABLE}(ledger_id) VALUES (?)", (ledger_position(product_db),))
+        dst.commit()
+    finally:
+        dst.close()
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def restore_snapshot(order_db: sqlite3.Connection, product_db: sqlite3.Connection, path: str) -> None:
+    """
+    從快照換回模擬狀態（呼叫端負責重建記憶體狀態）：SIM_TABLES 整表換回、訂單只換回 status，
+    這些訂單在快照之後的庫存異動寫沖銷帳本。
+    沒有記錄帳本位置的舊快照、快照之後有新訂單時丟 ValueError，不做任何還原。
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    order_db.commit()  # ATTACH 不能在 transaction 裡
+    order_db.execute("ATTACH DATABASE ? AS snap", (path,))
+    try:
+        try:
+            row = order_db.execute(f"SELECT ledger_id FROM snap.{_META_TABLE}").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if row is None:
+            raise ValueError("快照沒有記錄庫存帳本位置，無法和庫存一起還原")
+        newer = order_db.execute("""
+            SELECT order_id FROM main.order_list
+            WHERE order_id NOT IN (SELECT order_id FROM snap.order_list)
+            LIMIT 1
+        """).fetchone()
+        if newer is not None:
+            raise ValueError(f"快照之後有新的訂單（{newer[0]}），還原會和真實訂單衝突，請重新建立快照")
+        order_ids = [r[0] for r in order_db.execute(
+            "SELECT order_id FROM main.order_list WHERE order_id IN (SELECT order_id FROM snap.order_list)"
+        )]
+
+        # 1) 先寫帳本：沖銷快照之後的訂單庫存異動（重複還原同一個快照時沖銷量是 0）
+        note = f"還原模擬快照 {os.path.basename(path)[: -len(SNAPSHOT_SUFFIX)]}"
+        before = ledger_position(product_db)
+        reverse_order_movements(product_db, int(row[0]), order_ids, REASON_SIM_RESTORE, note)
+        product_db.commit()
+
+        # 2) 最後才換訂單 DB（單一 transaction）；失敗就把剛寫的沖銷再沖回，兩邊維持一致
+        try:
+            _replace_sim_tables(order_db)
+            order_db.commit()
+        except Exception:
+            order_db.rollback()
+            reverse_order_movements(product_db, before, order_ids, REASON_SIM_RESTORE, note + "（失敗，沖回）")
+            product_db.commit()
+            raise
+    finally:
+        order_db.execute("DETACH DATABASE snap")
+
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _replace_sim_tables(order_db: sqlite3.Connection) -> None:
+    """不 commit；欄位取快照和目前 DB 都有的（快照之後補的欄位用預設值）"""
+    for table in SIM_TABLES:
+        order_db.execute(f"DELETE FROM main.{table}")
+        cols = [c for c in _columns(order_db, "snap", table) if c in set(_columns(order_db, "main", table))]
+        if not cols:
+            continue
+        col_sql = ", ".join(cols)
+        # 快照之後被刪掉的訂單不再放回進度
+        where = " WHERE order_id IN (SELECT order_id FROM main.order_list)" if "order_id" in cols else ""
+        order_db.execute(f"INSERT INTO main.{table} ({col_sql}) SELECT {col_sql} FROM snap.{table}{where}")
+    order_db.execute("""
+        UPDATE main.order_list
+        SET status = (SELECT s.status FROM snap.order_list s WHERE s.order_id = main.order_list.order_id)
+        WHERE order_id IN (SELECT order_id FROM snap.order_list)
+    """)
+
+
+def list_snapshots(directory: str) -> List[dict]:
+    if not os.path.isdir(directory):
+        return []
+    out = []
+    for fn in os.listdir(directory):
+        if not fn.endswith(SNAPSHOT_SUFFIX):
+            continue
+        st = os.stat(os.path.join(directory, fn))
+        out.append({
+            "name": fn[: -len(SNAPSHOT_SUFFIX)],
+            "bytes": st.st_size,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(st.st_mtime)),
+        })
+    return sorted(out, key=lambda s: s["created_at"], reverse=True)
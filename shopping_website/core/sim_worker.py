@@ -0,0 +1,340 @@
+# core/sim_worker.py
+# 產線模擬引擎獨立 process（本機 Unix socket）：
+# - 模擬（派工 / 完工 / 寫回 DB）放在網站以外的 process 跑，網站 worker 的 CPU 和 SQLite 寫入不再被模擬占用
+# - 由 app.config["FACTORY_SIM_ENGINE"] 決定：
+#     inline：和原本一樣在 request 裡跑（預設）
+#     worker：網站只當 client，引擎另外用 `flask factory sim-worker` 啟動
+#     spawn：同 worker，但 create_app 時自己開一個 `flask factory sim-worker` 子 process
+# - 協定：每行一個 JSON（和 core/station_drivers.py 的 SocketDriver 一樣）
+#     client → 引擎：{"id", "cmd", "args", "reply"}；reply=false 的是「通知」（例如 tick），不等結果，
+#       同一個通知還在排隊時重複的直接丟掉
+#     引擎 → client：{"id", "ok", "result"} 或 {"id", "ok": false, "status", "message"}
+#     引擎 → 所有 client（發布）：{"event", ...}，例如模擬狀態版本變了推 {"event": "version", ...}、
+#       訂單畫面資料有變動時推 {"event": "views", "views": {...}}
+# - 命令在引擎的命令執行緒依序執行（標成 slow 的長命令另外開執行緒，不擋後面的命令）；
+#   實際內容（init / reset / tick / fast-forward ...）由 core/factory_routes.py 提供。
+#   引擎還有主迴圈（推進到點事件、發布）和 station driver 的事件執行緒也會改模擬狀態，
+#   三者之間的互斥由 handler 自己負責（core/factory_routes.py 的 _sim_lock），這裡不保證只有一個執行緒
+# - client 收到發布就更新自己的快取，網站頁面直接讀快取，不必等引擎
+
+from __future__ import annotations
+
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+DEFAULT_ENGINE = "inline"
+# 等引擎回覆的秒數（fast-forward 等較久的命令由呼叫端另外指定）
+DEFAULT_TIMEOUT_SEC = 10.0
+
+log = logging.getLogger(__name__)
+
+# (cmd, args) -> result；失敗時丟 SimWorkerError
+CommandHandler = Callable[[str, dict], dict]
+
+
+class SimWorkerError(Exception):
+    """引擎執行命令失敗（status 沿用 HTTP 狀態碼，網站直接 abort(status, message)）"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = int(status)
+        self.message = message
+
+
+class SimWorkerUnavailable(ConnectionError):
+    """連不上引擎 / 等回覆逾時"""
+
+
+def _encode(msg: dict) -> bytes:
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def socket_path(app) -> str:
+    """引擎的 Unix socket；可用 app.config["FACTORY_SIM_SOCKET"] 覆蓋"""
+    return app.config.get("FACTORY_SIM_SOCKET") or os.path.join(app.root_path, "database", "sim_worker.sock")
+
+
+def _alive(path: str) -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+        return True
+    except OSError:
+        return False
+
+
+# -------------------------
+# 引擎端
+# -------------------------
+class SimWorkerServer:
+    def __init__(self, path: str, handler: CommandHandler, slow: Iterable[str] = ()):
+        """slow：要跑很久的命令（例如 fast_forward），各自開執行緒跑，不擋住後面排隊的命令"""
+        self.path = path
+        self.handler = handler
+        self.slow = frozenset(slow)
+        self._commands: "queue.Queue[tuple]" = queue.Queue()
+        # 還在排隊的通知（重複的不再放進 queue）
+        self._queued_notes = set()
+        self._notes_lock = threading.Lock()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._server: Optional[socket.socket] = None
+
+    def start(self) -> None:
+        if os.path.exists(self.path):
+            if _alive(self.path):
+                raise RuntimeError(f"模擬引擎已經在執行：{self.path}")
+            os.unlink(self.path)  # 上次沒清掉的 socket 檔
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen()
+        atexit.register(self.close)
+        threading.Thread(target=self._accept, name="sim-worker-accept", daemon=True).start()
+        threading.Thread(target=self._run, name="sim-worker-engine", daemon=True).start()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def publish(self, event: dict) -> None:
+        """推給所有連線中的 client"""
+        line = _encode(event)
+        with self._clients_lock:
+            for conn in list(self._clients):
+                try:
+                    conn.sendall(line)
+                except OSError:
+                    self._clients.remove(conn)
+
+    def _accept(self) -> None:
+        while self._server is not None:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            with self._clients_lock:
+                self._clients.append(conn)
+            threading.Thread(target=self._read, args=(conn,), name="sim-worker-read", daemon=True).start()
+
+    def _read(self, conn: socket.socket) -> None:
+        try:
+            for line in conn.makefile("r", encoding="utf-8"):
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    log.warning("bad sim worker command line: %r", line)
+                    continue
+                if not msg.get("reply", True):
+                    key = (msg.get("cmd"), json.dumps(msg.get("args") or {}, sort_keys=True))
+                    with self._notes_lock:
+                        if key in self._queued_notes:
+                            continue
+                        self._queued_notes.add(key)
+                    msg["_note"] = key
+                self._commands.put((conn, msg))
+        except OSError:
+            pass
+        finally:
+            with self._clients_lock:
+                if conn in self._clients:
+                    self._clients.remove(conn)
+            conn.close()
+
+    def _run(self) -> None:
+        while True:
+            conn, msg = self._commands.get()
+            note = msg.pop("_note", None)
+            if note is not None:
+                with self._notes_lock:
+                    self._queued_notes.discard(note)
+            if msg.get("cmd") in self.slow:
+                threading.Thread(target=self._execute, args=(conn, msg, note), name="sim-worker-slow", daemon=True).start()
+            else:
+                self._execute(conn, msg, note)
+
+    def _execute(self, conn: socket.socket, msg: dict, note) -> None:
+        try:
+            reply = {"id": msg.get("id"), "ok": True, "result": self.handler(msg.get("cmd"), msg.get("args") or {})}
+        except SimWorkerError as e:
+            reply = {"id": msg.get("id"), "ok": False, "status": e.status, "message": e.message}
+        except Exception as e:
+            log.exception("sim worker command failed: %s", msg)
+            reply = {"id": msg.get("id"), "ok": False, "status": 500, "message": str(e)}
+        if note is not None:
+            return
+        # slow 命令的回覆和發布 / 其他回覆可能同時寫同一條連線，一次只讓一個寫
+        with self._clients_lock:
+            try:
+                conn.sendall(_encode(reply))
+            except OSError:
+                pass
+
+
+# -------------------------
+# 網站端
+# -------------------------
+class _Pending:
+    def __init__(self):
+        self.done = threading.Event()
+        self.reply: Optional[dict] = None
+
+
+class SimWorkerClient:
+    """一個 process 共用一條連線；命令依 id 對應回覆，發布的事件交給 on_event（在讀取執行緒呼叫）"""
+
+    def __init__(self, path: str, on_event: Optional[Callable[[dict], None]] = None):
+        self.path = path
+        self.on_event = on_event
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._conn: Optional[socket.socket] = None
+        self._pending: Dict[int, _Pending] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def call(self, cmd: str, timeout: float = DEFAULT_TIMEOUT_SEC, **args) -> dict:
+        """送出命令並等回覆；引擎回報失敗丟 SimWorkerError，連不上 / 逾時丟 SimWorkerUnavailable"""
+        msg_id = next(self._ids)
+        pending = self._pending[msg_id] = _Pending()
+        try:
+            self._send({"id": msg_id, "cmd": cmd, "args": args, "reply": True})
+            if not pending.done.wait(timeout):
+                raise SimWorkerUnavailable(f"模擬引擎 {timeout} 秒內沒有回覆：{cmd}")
+        finally:
+            self._pending.pop(msg_id, None)
+        reply = pending.reply
+        if reply is None:
+            raise SimWorkerUnavailable("和模擬引擎的連線中斷")
+        if not reply.get("ok"):
+            raise SimWorkerError(reply.get("status") or 500, reply.get("message") or "")
+        return reply.get("result") or {}
+
+    def notify(self, cmd: str, **args) -> None:
+        """送出通知，不等結果"""
+        self._send({"cmd": cmd, "args": args, "reply": False})
+
+    def _send(self, msg: dict) -> None:
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            try:
+                self._conn.sendall(_encode(msg))
+            except OSError as e:
+                self._drop(self._conn)
+                raise SimWorkerUnavailable(f"無法送出命令到模擬引擎：{e}") from e
+
+    def _connect(self) -> None:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+        except OSError as e:
+            conn.close()
+            raise SimWorkerUnavailable(f"連不上模擬引擎（{self.path}）：{e}") from e
+        self._conn = conn
+        threading.Thread(target=self._read, args=(conn,), name="sim-worker-client", daemon=True).start()
+        if self.on_event:
+            # 新連線：舊的快取可能漏掉斷線期間的發布
+            self.on_event({"event": "connected"})
+
+    def _drop(self, conn: socket.socket) -> None:
+        if self._conn is conn:
+            self._conn = None
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def _read(self, conn: socket.socket) -> None:
+        try:
+            for line in conn.makefile("r", encoding="utf-8"):
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                if "event" in msg:
+                    if self.on_event:
+                        try:
+                            self.on_event(msg)
+                        except Exception:
+                            log.exception("sim worker event handler failed: %s", msg.get("event"))
+                    continue
+                pending = self._pending.get(msg.get("id"))
+                if pending is not None:
+                    pending.reply = msg
+                    pending.done.set()
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._drop(conn)
+            # 還在等的命令不會有回覆了
+            for pending in list(self._pending.values()):
+                pending.done.set()
+            if self.on_event:
+                self.on_event({"event": "disconnected"})
+
+
+# -------------------------
+# 每個 process 一份：engine 設定 / client / 自己是不是引擎
+# -------------------------
+_client: Optional[SimWorkerClient] = None
+_client_lock = threading.Lock()
+_serving = False
+
+
+def mark_serving() -> None:
+    """`flask factory sim-worker` 啟動時呼叫：這個 process 就是引擎，模擬直接在本 process 跑"""
+    global _serving
+    _serving = True
+
+
+def get_sim_client(app, on_event: Optional[Callable[[dict], None]] = None) -> Optional[SimWorkerClient]:
+    """模擬交給獨立 process 時回傳 client；inline 模式或本 process 就是引擎時回傳 None"""
+    global _client
+    if _serving or app.config.get("FACTORY_SIM_ENGINE", DEFAULT_ENGINE) == "inline":
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SimWorkerClient(socket_path(app), on_event)
+    return _client
+
+
+def init_sim_worker(app) -> Optional[subprocess.Popen]:
+    """FACTORY_SIM_ENGINE=spawn：開一個 `flask factory sim-worker` 子 process（已經有引擎在跑就不開）"""
+    engine = app.config.get("FACTORY_SIM_ENGINE", DEFAULT_ENGINE)
+    if engine not in ("inline", "worker", "spawn"):
+        raise ValueError(f"unknown FACTORY_SIM_ENGINE: {engine}")
+    # debug reloader 的子 process 不再開（由外層 process 開的那一個負責）
+    if engine != "spawn" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        return None
+    path = socket_path(app)
+    if _alive(path):
+        return None
+
+    env = dict(os.environ, FACTORY_SIM_ENGINE="worker", FACTORY_SIM_SOCKET=path)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "flask", "--app", "app:create_app", "factory", "sim-worker"],
+        cwd=app.root_path,
+        env=env,
+    )
+    atexit.register(proc.terminate)
+    log.info("sim worker started: pid=%s socket=%s", proc.pid, path)
+    return proc
@@ -0,0 +1,129 @@
+# core/station_availability.py
+# 站點停機時段（維修 / 保養）：
+# - station_downtime 存每個站點不可用的時間窗 [start_ms, end_ms)
+# - 每次 tick 只查一次「現在之後還有效的時段」建成 Availability 快照，派工 / 中斷 / ETA 都用它判斷，
+#   不會每個站點、每個步驟各查一次
+# - 指標報表用 downtime_between 算時間窗內各站的停機秒數（稼動率分母扣掉停機）
+
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from .timeutil import fmt_ms
+
+
+def ensure_downtime_schema(conn) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS station_downtime (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          station TEXT NOT NULL,
+          start_ms INTEGER NOT NULL,
+          end_ms INTEGER NOT NULL,
+          reason TEXT,
+          created_at TEXT DEFAULT (datetime('now', 'localtime'))
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_station_downtime_end ON station_downtime(end_ms);")
+    conn.commit()
+
+
+class Availability:
+    """某個時間點的停機快照：station -> 依開始時間排序的 [(start_ms, end_ms)]（只含尚未結束的時段）"""
+
+    def __init__(self, now_ms: int, windows: Dict[str, List[Tuple[int, int]]]):
+        self.now_ms = now_ms
+        self.windows = windows
+
+    def down_until(self, station: str, t_ms: int) -> Optional[int]:
+        """t_ms 時站點停機的話回傳恢復時間，否則 None"""
+        for start, end in self.windows.get(station, ()):
+            if start <= t_ms < end:
+                return end
+        return None
+
+    def is_down(self, station: str, t_ms: Optional[int] = None) -> bool:
+        return self.down_until(station, self.now_ms if t_ms is None else t_ms) is not None
+
+    def fits(self, station: str, start_ms: int, duration_ms: int) -> bool:
+        """[start_ms, start_ms + duration_ms) 之間沒有停機（開工後不會被停機打斷）"""
+        end_ms = start_ms + max(1, duration_ms)
+        return not any(s < end_ms and e > start_ms for s, e in self.windows.get(station, ()))
+
+    def finish_after(self, station: str, start_ms: int, work_ms: int) -> int:
+        """從 start_ms 開始累積 work_ms 的可用時間，回傳完成時間（停機時段不計入）"""
+        t = start_ms
+        remaining = max(0, work_ms)
+        for s, e in self.windows.get(station, ()):
+            if e <= t:
+                continue
+            if s > t:
+                if t + remaining <= s:
+                    break
+                remaining -= s - t
+            t = max(t, e)
+        return t + remaining
+
+
+def load_availability(conn, now_ms: int) -> Availability:
+    """每次 tick 唯一的一次查詢：現在之後仍有效的所有停機時段"""
+    windows: Dict[str, List[Tuple[int, int]]] = {}
+    for r in conn.execute("""
+        SELECT station, start_ms, end_ms
+        FROM station_downtime
+        WHERE end_ms > ? AND end_ms > start_ms
+        ORDER BY start_ms
+    """, (now_ms,)):
+        windows.setdefault(r["station"], []).append((int(r["start_ms"]), int(r["end_ms"])))
+    return Availability(now_ms, windows)
+
+
+def add_downtime(conn, station: str, start_ms: int, end_ms: int, reason: str = "") -> int:
+    if end_ms <= start_ms:
+        raise ValueError("結束時間必須晚於開始時間")
+    cur = conn.execute(
+        "INSERT INTO station_downtime(station, start_ms, end_ms, reason) VALUES (?, ?, ?, ?)",
+        (station, int(start_ms), int(end_ms), reason or None),
+    )
+    return int(cur.lastrowid)
+
+
+def end_downtime(conn, downtime_id: int, now_ms: int) -> None:
+    """提前結束進行中的停機時段；尚未開始的直接刪除（不留下長度 0 的時段）"""
+    conn.execute("DELETE FROM station_downtime WHERE id = ? AND start_ms >= ?", (downtime_id, now_ms))
+    conn.execute("""
+        UPDATE station_downtime
+        SET end_ms = ?
+        WHERE id = ? AND start_ms < ? AND end_ms > ?
+    """, (now_ms, downtime_id, now_ms, now_ms))
+
+
+def list_downtime(conn, since_ms: int) -> List[dict]:
+    """since_ms 之後仍有效（進行中或排定）的停機時段，給管理頁面顯示"""
+    return [
+        {
+            "id": r["id"],
+            "station": r["station"],
+            "start": fmt_ms(r["start_ms"]),
+            "end": fmt_ms(r["end_ms"]),
+            "active": r["start_ms"] <= since_ms,
+            "reason": r["reason"] or "",
+        }
+        for r in conn.execute("""
+            SELECT id, station, start_ms, end_ms, reason
+            FROM station_downtime
+            WHERE end_ms > ? AND end_ms > start_ms
+            ORDER BY start_ms
+        """, (since_ms,))
+    ]
+
+
+def downtime_between(conn, t0_ms: int, t1_ms: int) -> List[Tuple[str, int, int]]:
+    """和 [t0_ms, t1_ms) 有重疊的停機時段（指標報表用）"""
+    return [
+        (r["station"], int(r["start_ms"]), int(r["end_ms"]))
+        for r in conn.execute("""
+            SELECT station, start_ms, end_ms
+            FROM station_downtime
+            WHERE end_ms > ? AND start_ms < ?
+        """, (t0_ms, t1_ms))
+    ]
@@ -0,0 +1,297 @@
+# core/station_drivers.py
+# 站點驅動（station driver）：派工時把工作交給站點，站點做完後「主動」回報事件，排程器收到就立刻處理
+# - 排程器（core/factory_routes.py）呼叫 start_job / cancel_job；driver 用 bind 註冊的 handler 推送事件：
+#     {"type": "start",  "station", "order_id", "piece_no", "step_order", "at_ms"}
+#     {"type": "finish", "station", "order_id", "piece_no", "step_order", "ok", "at_ms"}
+# - SimulatedDriver：和原本一樣依 busy_until 計時完工；背景計時執行緒到點就推 finish，
+#   tick 時也會用 poll(now_ms) 補發已到點的工作（模擬頁面 / 測試可以用自己的時鐘快轉）
+# - QueueDriver：事件從 queue 進來（同一個 process 內的程式直接 put）；
+#   SocketDriver：本機 TCP 上的 JSON lines，站點程式（或 `flask factory station-standin` 替身）連進來，
+#   收 start / cancel 指令、回報 start / finish 事件
+# - 用哪一個由 app.config["FACTORY_STATION_DRIVER"] 決定（simulated / socket）
+
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from .timeutil import now_ms
+
+DEFAULT_DRIVER = "simulated"
+DEFAULT_SOCKET_HOST = "127.0.0.1"
+DEFAULT_SOCKET_PORT = 7070
+
+log = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], None]
+
+
+def _finish_event(station: str, job: dict, at_ms: int, ok: bool = True) -> dict:
+    return {
+        "type": "finish",
+        "station": station,
+        "order_id": job["order_id"],
+        "piece_no": job["piece_no"],
+        "step_order": job["step_order"],
+        "ok": ok,
+        "at_ms": at_ms,
+    }
+
+
+class StationDriver:
+    """站點驅動的共同介面"""
+
+    name = "base"
+
+    def __init__(self):
+        self.handler: Optional[EventHandler] = None
+
+    @property
+    def bound(self) -> bool:
+        return self.handler is not None
+
+    def bind(self, handler: EventHandler) -> None:
+        """排程器註冊事件 handler（driver 自己的執行緒會呼叫它）"""
+        self.handler = handler
+
+    def start_job(self, station: str, job: dict) -> None:
+        """派工：job = {"order_id", "piece_no", "step_order", "busy_until_ms"}"""
+        raise NotImplementedError
+
+    def cancel_job(self, station: str) -> None:
+        """站點停機 / 訂單重設時收回工作（之後這個工作的事件會被排程器忽略）"""
+        raise NotImplementedError
+
+    def poll(self, now_ms: int) -> List[dict]:
+        """tick 時同步取出到點的事件；事件驅動的 driver 不需要，回傳空清單"""
+        return []
+
+    def _emit(self, event: dict) -> None:
+        if self.handler is None:
+            return
+        try:
+            self.handler(event)
+        except Exception:
+            log.exception("station event handler failed: %s", event)
+
+
+class SimulatedDriver(StationDriver):
+    """計時模擬：busy_until 到點就完工；failure_rate 為每次完工失敗的機率"""
+
+    name = "simulated"
+
+    def __init__(self, failure_rate: float = 0.0):
+        super().__init__()
+        self.failure_rate = float(failure_rate)
+        self._jobs: Dict[str, dict] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_job(self, station: str, job: dict) -> None:
+        with self._cond:
+            self._jobs[station] = dict(job)
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="station-driver-sim", daemon=True)
+                self._thread.start()
+
+    def cancel_job(self, station: str) -> None:
+        with self._cond:
+            self._jobs.pop(station, None)
+
+    def poll(self, now_ms: int) -> List[dict]:
+        with self._cond:
+            due = [st for st, job in self._jobs.items() if job["busy_until_ms"] <= now_ms]
+            return [
+                _finish_event(st, self._jobs.pop(st), now_ms, ok=random.random() >= self.failure_rate)
+                for st in sorted(due)
+            ]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    t = now_ms()
+                    nxt = min((job["busy_until_ms"] for job in self._jobs.values()), default=None)
+                    if nxt is not None and nxt <= t:
+                        break
+                    self._cond.wait(None if nxt is None else (nxt - t) / 1000)
+            for event in self.poll(now_ms()):
+                self._emit(event)
+
+
+class QueueDriver(StationDriver):
+    """事件由外部放進 events queue；派工 / 收回指令放進 commands queue 給站點端取用"""
+
+    name = "queue"
+
+    def __init__(self):
+        super().__init__()
+        self.events: "queue.Queue[dict]" = queue.Queue()
+        self.commands: "queue.Queue[dict]" = queue.Queue()
+        # 目前交給站點的工作（站點端重新連線時重送）
+        self.jobs: Dict[str, dict] = {}
+        self._pump: Optional[threading.Thread] = None
+
+    def bind(self, handler: EventHandler) -> None:
+        super().bind(handler)
+        if self._pump is None:
+            self._pump = threading.Thread(target=self._run, name=f"station-driver-{self.name}", daemon=True)
+            self._pump.start()
+
+    def start_job(self, station: str, job: dict) -> None:
+        self.jobs[station] = dict(job)
+        self._send({"cmd": "start", "station": station, **job})
+
+    def cancel_job(self, station: str) -> None:
+        self.jobs.pop(station, None)
+        self._send({"cmd": "cancel", "station": station})
+
+    def _send(self, command: dict) -> None:
+        self.commands.put(command)
+
+    def _run(self) -> None:
+        while True:
+            event = self.events.get()
+            if event.get("type") in ("start", "finish") and event.get("station"):
+                if event["type"] == "finish":
+                    self.jobs.pop(event["station"], None)
+                self._emit(event)
+            else:
+                log.warning("ignored station event: %s", event)
+
+
+class SocketDriver(QueueDriver):
+    """本機 TCP JSON lines：每行一個 JSON；收到的事件放進 events，指令廣播給所有連線中的站點程式"""
+
+    name = "socket"
+
+    def __init__(self, host: str = DEFAULT_SOCKET_HOST, port: int = DEFAULT_SOCKET_PORT):
+        super().__init__()
+        self.host, self.port = host, int(port)
+        self._clients: List[socket.socket] = []
+        self._clients_lock = threading.Lock()
+        self._server: Optional[socket.socket] = None
+
+    def bind(self, handler: EventHandler) -> None:
+        super().bind(handler)
+        if self._server is None:
+            self._server = socket.create_server((self.host, self.port))
+            threading.Thread(target=self._accept, name="station-driver-accept", daemon=True).start()
+
+    def _send(self, command: dict) -> None:
+        line = (json.dumps(command, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._clients_lock:
+            for conn in list(self._clients):
+                try:
+                    conn.sendall(line)
+                except OSError:
+                    self._clients.remove(conn)
+
+    def _accept(self) -> None:
+        while True:
+            conn, _ = self._server.accept()
+            with self._clients_lock:
+                self._clients.append(conn)
+                for station, job in list(self.jobs.items()):
+                    conn.sendall((json.dumps({"cmd": "start", "station": station, **job}, ensure_ascii=False) + "\n").encode("utf-8"))
+            threading.Thread(target=self._read, args=(conn,), name="station-driver-read", daemon=True).start()
+
+    def _read(self, conn: socket.socket) -> None:
+        try:
+            for line in conn.makefile("r", encoding="utf-8"):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self.events.put(json.loads(line))
+                except ValueError:
+                    log.warning("bad station event line: %r", line)
+        finally:
+            with self._clients_lock:
+                if conn in self._clients:
+                    self._clients.remove(conn)
+            conn.close()
+
+
+# -------------------------
+# 全域 driver（每個 process 一份）
+# -------------------------
+_driver: Optional[StationDriver] = None
+
+
+def get_station_driver() -> StationDriver:
+    global _driver
+    if _driver is None:
+        _driver = SimulatedDriver()
+    return _driver
+
+
+def init_station_driver(app) -> StationDriver:
+    """依 app.config 建立 driver（simulated / socket）"""
+    global _driver
+    kind = app.config.get("FACTORY_STATION_DRIVER", DEFAULT_DRIVER)
+    if kind == "socket":
+        _driver = SocketDriver(
+            app.config.get("FACTORY_DRIVER_HOST", DEFAULT_SOCKET_HOST),
+            app.config.get("FACTORY_DRIVER_PORT", DEFAULT_SOCKET_PORT),
+        )
+    elif kind == "simulated":
+        _driver = SimulatedDriver(app.config.get("FACTORY_FAILURE_RATE", 0.0))
+    else:
+        raise ValueError(f"unknown FACTORY_STATION_DRIVER: {kind}")
+    return _driver
+
+
+# -------------------------
+# 站點替身：連上 SocketDriver，收到 start 就依 busy_until 計時，到點回報 finish
+# -------------------------
+def run_standin(host: str = DEFAULT_SOCKET_HOST, port: int = DEFAULT_SOCKET_PORT,
+                speed: float = 1.0, failure_rate: float = 0.0) -> None:
+    """speed > 1 時加工時間等比例縮短；failure_rate 為回報失敗的機率"""
+    conn = socket.create_connection((host, int(port)))
+    send_lock = threading.Lock()
+    cond = threading.Condition()
+    pending: list = []  # heap: (finish_at, seq, station, job)
+    active: Dict[str, int] = {}  # station -> 目前工作的 seq（收回後舊的計時作廢）
+
+    def send(event: dict) -> None:
+        with send_lock:
+            conn.sendall((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def timer() -> None:
+        while True:
+            with cond:
+                while not pending or pending[0][0] > time.time():
+                    cond.wait(timeout=(pending[0][0] - time.time()) if pending else None)
+                _, seq, station, job = heapq.heappop(pending)
+                if active.get(station) != seq:
+                    continue
+                del active[station]
+            send(_finish_event(station, job, now_ms(), ok=random.random() >= failure_rate))
+
+    threading.Thread(target=timer, name="station-standin-timer", daemon=True).start()
+
+    seq = 0
+    for line in conn.makefile("r", encoding="utf-8"):
+        cmd = json.loads(line)
+        station = cmd.get("station")
+        if cmd.get("cmd") == "start":
+            seq += 1
+            duration = max(0.0, cmd["busy_until_ms"] / 1000 - time.time()) / max(speed, 1e-6)
+            with cond:
+                active[station] = seq
+                heapq.heappush(pending, (time.time() + duration, seq, station, cmd))
+                cond.notify()
+            send({"type": "start", "station": station, "order_id": cmd["order_id"],
+                  "piece_no": cmd["piece_no"], "step_order": cmd["step_order"], "at_ms": now_ms()})
+        elif cmd.get("cmd") == "cancel":
+            with cond:
+                active.pop(station, None)
@@ -0,0 +1,81 @@
+# core/tick_gate.py
+# tick 合併（single-flight）：很多人同時開著 simulate 頁面時，每個頁面每秒都會打 /factory/api/tick
+# - 同一個 key（訂單）同時只跑一次 tick；執行中進來的請求等它跑完，直接共用同一份結果
+# - 一次 tick 從頭到尾產線狀態都沒變（沒派工、沒完工），代表「到下一個到點事件之前再 tick 也不會有事」：
+#   記下狀態版本與下一個到點時間（最早的 busy_until / 停機開始或結束），期間內的 tick 直接回傳這份結果，
+#   不開 DB、不跑派工
+# - 狀態版本由呼叫端提供（core/factory_model.py 每次改狀態 +1）；版本不同或時間到了就重新跑
+# - key 只負責合併同一張訂單的請求 / 回應；不同訂單的 tick 仍會同時進來，
+#   改共用站點狀態的完工 + 派工由呼叫端另外用全域的模擬狀態鎖串起來（core/factory_routes.py 的 _sim_lock）
+
+from __future__ import annotations
+
+import threading
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+# fn() -> (結果, 下一個到點時間 epoch 毫秒；None = 沒有排定的事件)
+TickFn = Callable[[], Tuple[dict, Optional[int]]]
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[dict] = None
+        self.error: Optional[BaseException] = None
+
+
+class TickGate:
+    def __init__(self, version_fn: Callable[[], int]):
+        self.version_fn = version_fn
+        self.lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        # key -> (狀態版本, 下一個到點時間, 結果)
+        self._idle: Dict[Hashable, Tuple[int, Optional[int], dict]] = {}
+
+    def run(self, key: Hashable, now_ms: int, fn: TickFn) -> Tuple[dict, str]:
+        """
+        回傳（結果, 來源）：
+        - "idle"：狀態沒變且還沒到下一個事件，直接用上次的結果
+        - "shared"：同一個 key 的 tick 正在跑，等它完成共用結果
+        - "run"：這個請求實際跑了 tick
+        """
+        with self.lock:
+            idle = self._idle.get(key)
+            if idle and idle[0] == self.version_fn() and (idle[1] is None or now_ms < idle[1]):
+                return idle[2], "idle"
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                version = self.version_fn()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, "shared"
+
+        try:
+            result, next_due_ms = fn()
+            flight.result = result
+            with self.lock:
+                # 只有整次 tick 期間狀態都沒變，才能斷定到下一個事件前都不會有事
+                if self.version_fn() == version:
+                    # 版本只會往上加，舊版本的結果不會再用到
+                    self._idle = {k: v for k, v in self._idle.items() if v[0] == version}
+                    self._idle[key] = (version, next_due_ms, result)
+                else:
+                    self._idle.pop(key, None)
+            return result, "run"
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self) -> None:
+        """狀態版本以外的輸入改變時呼叫（例如停機時段異動）"""
+        with self.lock:
+            self._idle.clear()
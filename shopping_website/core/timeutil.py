@@ -0,0 +1,133 @@
+# core/timeutil.py
+# 時間欄位：
+# - 原本的 TEXT 欄位（'YYYY-MM-DD HH:MM:SS' 本地時間）保留給畫面 / 匯出顯示
+# - 另外存一份整數 epoch 毫秒欄位（欄位名加 _ms），到點判斷 / 區間查詢 / 統計都用它，
+#   可以直接走索引，不需要在 SQL 或 Python 裡解析字串
+# - 寫入時兩個欄位一起寫；舊資料在補欄位時用 SQL 一次換算
+# - 模擬時鐘（產線快轉用）：比實際時間快多少毫秒存在 order_management.db 的 sim_clock 表（單一一列），
+#   now_ms() 已經加上這個差，所以重新啟動、網站 / 模擬引擎各 process 看到的都是同一個時鐘，
+#   不會把快轉後寫進 DB 的時間當成未來；每個 process 最多 CLOCK_REFRESH_SEC 秒重讀一次
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Mapping, Optional
+
+from .db import ORDER_MGMT_DB_PATH
+
+TEXT_FORMAT = "%Y-%m-%d %H:%M:%S"
+CLOCK_REFRESH_SEC = 1.0
+
+_clock_lock = threading.Lock()
+_clock_offset_ms = 0
+_clock_read_at: Optional[float] = None
+
+
+def ensure_sim_clock_schema(conn) -> None:
+    """建立 sim_clock（只有 id=1 一列；不 commit）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sim_clock (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          offset_ms INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    conn.execute("INSERT OR IGNORE INTO sim_clock(id, offset_ms) VALUES (1, 0)")
+
+
+def clock_offset_ms() -> int:
+    """模擬時鐘比實際時間快多少毫秒（還沒有 sim_clock 表就是 0）"""
+    global _clock_offset_ms, _clock_read_at
+    t = time.monotonic()
+    if _clock_read_at is not None and t - _clock_read_at < CLOCK_REFRESH_SEC:
+        return _clock_offset_ms
+    with _clock_lock:
+        if _clock_read_at is None or t - _clock_read_at >= CLOCK_REFRESH_SEC:
+            try:
+                conn = sqlite3.connect(ORDER_MGMT_DB_PATH)
+                try:
+                    row = conn.execute("SELECT offset_ms FROM sim_clock WHERE id = 1").fetchone()
+                finally:
+                    conn.close()
+                _clock_offset_ms = int(row[0]) if row else 0
+            except sqlite3.Error:
+                _clock_offset_ms = 0
+            _clock_read_at = t
+        return _clock_offset_ms
+
+
+def advance_clock(conn, delta_ms: int) -> int:
+    """模擬時鐘往前 delta_ms 毫秒並 commit（conn 是 order_management.db），回傳新的時鐘差"""
+    global _clock_offset_ms, _clock_read_at
+    ensure_sim_clock_schema(conn)
+    row = conn.execute(
+        "UPDATE sim_clock SET offset_ms = offset_ms + ? WHERE id = 1 RETURNING offset_ms", (int(delta_ms),)
+    ).fetchone()
+    conn.commit()
+    with _clock_lock:
+        _clock_offset_ms = int(row[0])
+        _clock_read_at = time.monotonic()
+    return _clock_offset_ms
+
+
+def reload_clock() -> None:
+    """sim_clock 被整個換掉時（還原快照）呼叫：下次 now_ms() 重讀"""
+    global _clock_read_at
+    with _clock_lock:
+        _clock_read_at = None
+
+
+def now_ms() -> int:
+    """目前時間（epoch 毫秒，含模擬時鐘差）"""
+    return int(time.time() * 1000) + clock_offset_ms()
+
+
+def to_ms(value) -> Optional[int]:
+    """datetime（本地時間）/ 'YYYY-MM-DD HH:MM:SS[.ffffff]' → epoch 毫秒"""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+    return int(value.timestamp() * 1000)
+
+
+def from_ms(ms: Optional[int]) -> Optional[datetime]:
+    """epoch 毫秒 → 本地時間 datetime"""
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000)
+
+
+def fmt_ms(ms: Optional[int]) -> str:
+    """epoch 毫秒 → 'YYYY-MM-DD HH:MM:SS'（本地時間，和 TEXT 欄位同格式）"""
+    dt = from_ms(ms)
+    return dt.strftime(TEXT_FORMAT) if dt else ""
+
+
+def text_to_ms_sql(column: str) -> str:
+    """SQL 運算式：本地時間字串欄位 → epoch 毫秒（只用在補欄位時換算舊資料）"""
+    return f"CAST(ROUND((julianday({column}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def ensure_ms_columns(conn, table: str, columns: Mapping[str, str]) -> bool:
+    """
+    為 table 補上整數毫秒欄位 {text 欄位: _ms 欄位}；新補的欄位順便由 text 欄位換算舊資料。
+    回傳是否有變更（呼叫端決定何時 commit）
+    """
+    cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    changed = False
+    for text_col, ms_col in columns.items():
+        if ms_col in cols:
+            continue
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {ms_col} INTEGER")
+        if text_col in cols:
+            conn.execute(
+                f"UPDATE {table} SET {ms_col} = {text_to_ms_sql(text_col)} WHERE {text_col} IS NOT NULL"
+            )
+        changed = True
+    return changed
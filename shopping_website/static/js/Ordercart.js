@@ -19,9 +19,9 @@ function loadProducts() {
             data.forEach(p => {
                 let option = document.createElement("option");
                 option.value = p.id;
-                option.text = `${p.name} (庫存: ${p.total}) - $${p.base_price}`;
+                option.text = `${p.name} (庫存: ${p.stock}) - $${p.base_price}`;
                 // 庫存為 0 就不能選
-                if (p.total <= 0) option.disabled = true;
+                if (p.stock <= 0) option.disabled = true;
                 select.add(option);
             });
         })
@@ -45,7 +45,7 @@ function addToCart() {
     
     // 檢查庫存 (從前端簡單檢查，後端會再擋一次)
     const productInfo = allProducts.find(p => p.id === pid);
-    if (qty > productInfo.total) {
+    if (qty > productInfo.stock) {
         alert("庫存不足！");
         return;
     }